@@ -11,6 +11,9 @@
 #include <map>
 #include <SPIFFS.h>
 #include <Update.h>
+#include <esp_ota_ops.h>
+#include <esp_partition.h>
+#include <rom/miniz.h>
 #include <mbedtls/entropy.h>
 #include <mbedtls/ctr_drbg.h>
 
@@ -48,6 +51,7 @@ void processSerialCommands();
 void checkDjangoOnline();
 
 void detectIPHandler(AsyncWebServerRequest *request);
+void logTrace(AsyncWebServerRequest *request);
 bool localServer = false; // Determines if the server is local (true) or Heroku (false)
 
 // Wi-Fi and Django configuration variables
@@ -560,12 +564,284 @@ void displayIP()
 
 //============================================================================
 
+/**
+ * @brief State of a delta firmware update ("firmware.hcd" upload, see
+ * firmware_manager/delta.py): a header, then a zlib stream of COPY, ADD and
+ * DIFF operations rebuilding the new image from the running one.
+ */
+#define DELTA_HEADER_SIZE 44
+#define DELTA_OP_COPY 1
+#define DELTA_OP_ADD 2
+#define DELTA_OP_DIFF 3
+
+struct DeltaUpdate
+{
+    bool failed = false;
+    uint8_t header[DELTA_HEADER_SIZE];
+    size_t headerLength = 0;
+    const esp_partition_t *base = nullptr; // The running image
+    tinfl_decompressor inflator;
+    int inflateStatus = TINFL_STATUS_NEEDS_MORE_INPUT;
+    uint8_t *window = nullptr; // Inflate output window, TINFL_LZ_DICT_SIZE
+    size_t windowOffset = 0;
+    uint8_t op[9]; // Header of the operation being parsed
+    size_t opLength = 0;
+    uint32_t baseOffset = 0; // Base offset of the current DIFF
+    uint32_t remaining = 0;  // Bytes left of the current ADD or DIFF
+};
+DeltaUpdate delta;
+uint8_t deltaBuffer[1024];
+
+uint32_t readUint32(const uint8_t *bytes)
+{
+    return bytes[0] | (bytes[1] << 8) | (bytes[2] << 16) | ((uint32_t)bytes[3] << 24);
+}
+
+String toHex(const uint8_t *bytes, size_t length)
+{
+    String hex = "";
+    char digits[3];
+    for (size_t i = 0; i < length; i++)
+    {
+        sprintf(digits, "%02x", bytes[i]);
+        hex += digits;
+    }
+    return hex;
+}
+
+/**
+ * @brief Aborts the delta update; Django then sends the full image.
+ */
+void deltaFail(const char *reason)
+{
+    if (!delta.failed)
+    {
+        Serial.printf("Delta update failed: %s\n", reason);
+        s_debug("Delta update failed");
+    }
+    delta.failed = true;
+    Update.abort();
+}
+
+/**
+ * @brief Writes bytes of the running image, plus the given differences if
+ * any, to the new image.
+ */
+void deltaWriteBase(uint32_t offset, uint32_t length, const uint8_t *diff)
+{
+    while (length > 0 && !delta.failed)
+    {
+        size_t n = length < sizeof(deltaBuffer) ? length : sizeof(deltaBuffer);
+        if (offset + n > ESP.getSketchSize() ||
+            esp_partition_read(delta.base, offset, deltaBuffer, n) != ESP_OK)
+        {
+            deltaFail("base read");
+            return;
+        }
+        if (diff)
+        {
+            for (size_t i = 0; i < n; i++)
+            {
+                deltaBuffer[i] += diff[i];
+            }
+            diff += n;
+        }
+        if (Update.write(deltaBuffer, n) != n)
+        {
+            deltaFail("write");
+            return;
+        }
+        offset += n;
+        length -= n;
+        yield();
+    }
+}
+
+/**
+ * @brief Applies inflated operation bytes, which may split operations
+ * anywhere.
+ */
+void deltaApply(const uint8_t *data, size_t length)
+{
+    while (length > 0 && !delta.failed)
+    {
+        if (delta.remaining == 0)
+        {
+            if (delta.opLength == 0 && (data[0] < DELTA_OP_COPY || data[0] > DELTA_OP_DIFF))
+            {
+                deltaFail("unknown operation");
+                return;
+            }
+            size_t needed = delta.opLength ? (delta.op[0] == DELTA_OP_ADD ? 5 : 9) : (data[0] == DELTA_OP_ADD ? 5 : 9);
+            size_t n = needed - delta.opLength < length ? needed - delta.opLength : length;
+            memcpy(delta.op + delta.opLength, data, n);
+            delta.opLength += n;
+            data += n;
+            length -= n;
+            if (delta.opLength < needed)
+            {
+                return;
+            }
+            delta.opLength = 0;
+            if (delta.op[0] == DELTA_OP_COPY)
+            {
+                deltaWriteBase(readUint32(delta.op + 1), readUint32(delta.op + 5), nullptr);
+            }
+            else if (delta.op[0] == DELTA_OP_ADD)
+            {
+                delta.remaining = readUint32(delta.op + 1);
+            }
+            else
+            {
+                delta.baseOffset = readUint32(delta.op + 1);
+                delta.remaining = readUint32(delta.op + 5);
+            }
+            continue;
+        }
+
+        size_t n = delta.remaining < length ? delta.remaining : length;
+        if (delta.op[0] == DELTA_OP_ADD)
+        {
+            if (Update.write((uint8_t *)data, n) != n)
+            {
+                deltaFail("write");
+                return;
+            }
+        }
+        else
+        {
+            deltaWriteBase(delta.baseOffset, n, data);
+            delta.baseOffset += n;
+        }
+        delta.remaining -= n;
+        data += n;
+        length -= n;
+    }
+}
+
+/**
+ * @brief Checks the patch header against the running image and starts
+ * the update.
+ */
+void deltaBegin()
+{
+    static const uint8_t noBase[16] = {0};
+    if (memcmp(delta.header, "HCD1", 4) != 0)
+    {
+        deltaFail("not a patch");
+        return;
+    }
+    uint32_t baseSize = readUint32(delta.header + 36);
+    uint32_t targetSize = readUint32(delta.header + 40);
+    if (memcmp(delta.header + 4, noBase, 16) != 0 &&
+        (baseSize != ESP.getSketchSize() || toHex(delta.header + 4, 16) != ESP.getSketchMD5()))
+    {
+        // Made for another image: Django falls back to the full image
+        deltaFail("base mismatch");
+        return;
+    }
+    if (!Update.begin(targetSize))
+    {
+        deltaFail(Update.errorString());
+        return;
+    }
+    // Update.end() rejects the image unless it rebuilds to this MD5
+    Update.setMD5(toHex(delta.header + 20, 16).c_str());
+}
+
+/**
+ * @brief Handles the chunks of a delta firmware upload: parses the header,
+ * inflates the operations and applies them while they arrive.
+ */
+void handleDeltaUpdate(uint8_t *data, size_t len, bool first, bool final)
+{
+    if (first)
+    {
+        s_debug("Delta update start:");
+        free(delta.window);
+        delta = DeltaUpdate();
+        delta.base = esp_ota_get_running_partition();
+        delta.window = (uint8_t *)malloc(TINFL_LZ_DICT_SIZE);
+        tinfl_init(&delta.inflator);
+        if (!delta.window)
+        {
+            deltaFail("out of memory");
+        }
+    }
+
+    if (delta.headerLength < DELTA_HEADER_SIZE && !delta.failed)
+    {
+        size_t n = DELTA_HEADER_SIZE - delta.headerLength < len ? DELTA_HEADER_SIZE - delta.headerLength : len;
+        memcpy(delta.header + delta.headerLength, data, n);
+        delta.headerLength += n;
+        data += n;
+        len -= n;
+        if (delta.headerLength == DELTA_HEADER_SIZE)
+        {
+            deltaBegin();
+        }
+    }
+
+    size_t inOffset = 0;
+    while (!delta.failed && delta.headerLength == DELTA_HEADER_SIZE &&
+           delta.inflateStatus != TINFL_STATUS_DONE &&
+           (inOffset < len || delta.inflateStatus == TINFL_STATUS_HAS_MORE_OUTPUT))
+    {
+        size_t inBytes = len - inOffset;
+        size_t outBytes = TINFL_LZ_DICT_SIZE - delta.windowOffset;
+        delta.inflateStatus = tinfl_decompress(
+            &delta.inflator, data + inOffset, &inBytes, delta.window,
+            delta.window + delta.windowOffset, &outBytes,
+            TINFL_FLAG_PARSE_ZLIB_HEADER | (final ? 0 : TINFL_FLAG_HAS_MORE_INPUT));
+        inOffset += inBytes;
+        deltaApply(delta.window + delta.windowOffset, outBytes);
+        delta.windowOffset = (delta.windowOffset + outBytes) & (TINFL_LZ_DICT_SIZE - 1);
+        if (delta.inflateStatus < 0)
+        {
+            deltaFail("corrupt patch");
+        }
+        else if (delta.inflateStatus == TINFL_STATUS_NEEDS_MORE_INPUT && inOffset >= len)
+        {
+            break;
+        }
+    }
+
+    if (final)
+    {
+        if (!delta.failed && (delta.inflateStatus != TINFL_STATUS_DONE || delta.remaining || delta.opLength))
+        {
+            deltaFail("truncated patch");
+        }
+        if (!delta.failed)
+        {
+            if (Update.end())
+            {
+                Serial.printf("Delta update success: %u\n", Update.progress());
+            }
+            else
+            {
+                deltaFail(Update.errorString());
+            }
+        }
+        free(delta.window);
+        delta.window = nullptr;
+    }
+}
+
+//============================================================================
+
 /**
  * @brief Handles OTA firmware updates from the server.
  * Prints progress and handles errors.
  */
 void handleUpdateStart(AsyncWebServerRequest *request, String filename, size_t index, uint8_t *data, size_t len, bool final)
 {
+    if (filename == "firmware.hcd")
+    {
+        handleDeltaUpdate(data, len, !index, final);
+        return;
+    }
+
     if (!index)
     {
         Serial.printf("Update Start: %s\n", filename.c_str());
@@ -633,6 +909,7 @@ void serverSetup()
     //============================================================================
     server.on("/control_led", HTTP_GET, [](AsyncWebServerRequest *request)
               {
+                  logTrace(request);
                   String room, light, action;
                   if (request->hasParam("room"))
                   {
@@ -656,6 +933,45 @@ void serverSetup()
 
     //============================================================================
 
+    // Applies several light commands in one request: repeated room, light
+    // and action parameters, one triplet per light, in order
+    server.on("/control_batch", HTTP_GET, [](AsyncWebServerRequest *request)
+              {
+                  logTrace(request);
+                  String room, light;
+                  int count = 0;
+                  for (int i = 0; i < request->params(); i++)
+                  {
+                      auto *param = request->getParam(i);
+                      if (param->name() == "room")
+                      {
+                          room = param->value();
+                      }
+                      else if (param->name() == "light")
+                      {
+                          light = param->value();
+                      }
+                      else if (param->name() == "action")
+                      {
+                          s_debug(room + " " + light + " is: " + param->value());
+                          count++;
+                      }
+                  }
+                  djangoOnline = true;
+                  request->send(200, "application/json", "{\"status\":\"success\",\"count\":" + String(count) + "}"); });
+
+    //============================================================================
+
+    // Reports the running image, so Django can send a patch from it
+    // instead of the full image ("hcd1" delta updates)
+    server.on("/firmware_info", HTTP_GET, [](AsyncWebServerRequest *request)
+              {
+                  djangoOnline = true;
+                  String body = "{\"md5\":\"" + ESP.getSketchMD5() + "\",\"size\":" + String(ESP.getSketchSize()) + ",\"formats\":[\"hcd1\"]}";
+                  request->send(200, "application/json", body); });
+
+    //============================================================================
+
     // Handler for OPTIONS requests (preflight request for CORS)
     server.on("/django_update_firmware", HTTP_OPTIONS, [](AsyncWebServerRequest *request)
               {
@@ -734,6 +1050,20 @@ void serverSetup()
 
 //============================================================================
 
+/**
+ * @brief Prints the trace ID Django sent with a command, to find its trace
+ * (see light_app/tracing.py) from the device log.
+ */
+void logTrace(AsyncWebServerRequest *request)
+{
+    if (request->hasHeader("traceparent"))
+    {
+        Serial.println("traceparent: " + request->header("traceparent"));
+    }
+}
+
+//============================================================================
+
 /**
  * @brief Prints a message to the serial console and the M5 display (if present).
  * @param msg Message to print.
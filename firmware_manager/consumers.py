@@ -2,9 +2,10 @@ import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings
 from asgiref.sync import sync_to_async
+from light_app.tracing import TracedConsumerMixin
 
 
-class MyWebSocketConsumer(AsyncWebsocketConsumer):
+class MyWebSocketConsumer(TracedConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
         await self.accept()
 
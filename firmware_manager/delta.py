@@ -0,0 +1,258 @@
+"""
+Binary delta format of firmware updates, applied by the device while it
+flashes (see `handleDeltaUpdate` in esp32_server/src/main.cpp).
+
+A patch is a header followed by a zlib stream of operations that rebuild
+the target image, in order, from the device's running image (the base):
+
+- header: b"HCD1", base MD5 (16 bytes, zeros if there is no base), target
+  MD5 (16 bytes), base size and target size (little-endian uint32);
+- COPY (1): base offset, length (uint32): copy bytes of the base as is;
+- ADD (2): length (uint32), then the bytes to write;
+- DIFF (3): base offset, length (uint32), then one byte per byte of the
+  base to add to it (mod 256). Recompiled code keeps its layout but
+  shifts the addresses it references, so most of these bytes are zeros
+  and compress very well (the idea behind bsdiff).
+
+Without a base, a patch is a single ADD of the whole image: the image is
+then only compressed.
+"""
+import hashlib
+import struct
+import zlib
+
+MAGIC = b"HCD1"
+HEADER = struct.Struct("<4s16s16sII")
+COPY = 1
+ADD = 2
+DIFF = 3
+COPY_OP = struct.Struct("<BII")
+ADD_OP = struct.Struct("<BI")
+DIFF_OP = struct.Struct("<BII")
+
+# Bytes of the base indexed per entry; shorter matches are written as is
+BLOCK_SIZE = 32
+# A DIFF stops once its mismatching bytes outnumber the matching ones by
+# this much
+MAX_DIFF_DEFICIT = 64
+# zlib level of patches; the device inflates any level equally fast
+COMPRESSION_LEVEL = 9
+
+
+class PatchMismatch(ValueError):
+    """Raised when a patch doesn't match its base or the rebuilt image."""
+
+
+def md5(data):
+    """Returns the MD5 digest of an image."""
+    return hashlib.md5(data).digest()
+
+
+def _index(base, block):
+    """Maps the aligned blocks of the base to their first offset."""
+    index = {}
+    for offset in range(0, len(base) - block + 1, block):
+        index.setdefault(base[offset:offset + block], offset)
+    return index
+
+
+def _common_length(a, a_start, b, b_start):
+    """Returns the length of the common prefix of a[a_start:], b[b_start:]."""
+    limit = min(len(a) - a_start, len(b) - b_start)
+    length = 0
+    step = 4096
+    while step:
+        while (length + step <= limit
+               and a[a_start + length:a_start + length + step]
+               == b[b_start + length:b_start + length + step]):
+            length += step
+        step //= 2
+    return length
+
+
+def _similar_length(base, b_start, target, t_start):
+    """
+    Returns how far target[t_start:] stays similar to base[b_start:]: the
+    length maximizing matching minus mismatching bytes, as bsdiff does.
+    """
+    limit = min(len(base) - b_start, len(target) - t_start)
+    score = best_score = best_length = 0
+    for k in range(limit):
+        score += 1 if base[b_start + k] == target[t_start + k] else -1
+        if score > best_score:
+            best_score, best_length = score, k + 1
+        elif score < best_score - MAX_DIFF_DEFICIT:
+            break
+    return best_length
+
+
+def diff_ops(base, target, block=BLOCK_SIZE):
+    """
+    Yields the operations rebuilding the target from the base.
+
+    Exact matches are found through an index of the base's aligned blocks,
+    extended both ways, then followed by a DIFF over the similar bytes
+    after them; the remaining bytes are added as is.
+
+    Args:
+        base (bytes): The image the device runs.
+        target (bytes): The image to flash.
+        block (int): Bytes per indexed block of the base.
+
+    Yields:
+        tuple: (COPY, offset, length), (ADD, data) or (DIFF, offset, data).
+    """
+    index = _index(base, block)
+    start = 0  # Start of the target bytes not covered yet
+    position = 0
+    end = len(target) - block
+    while position <= end:
+        offset = index.get(target[position:position + block])
+        if offset is None:
+            position += 1
+            continue
+
+        back = 0
+        while (back < position - start and back < offset
+               and target[position - back - 1] == base[offset - back - 1]):
+            back += 1
+        position -= back
+        offset -= back
+        length = _common_length(base, offset, target, position)
+
+        if position > start:
+            yield ADD, target[start:position]
+        yield COPY, offset, length
+        position += length
+        offset += length
+
+        similar = _similar_length(base, offset, target, position)
+        if similar:
+            yield DIFF, offset, bytes(
+                (new - old) & 0xFF for new, old in zip(
+                    target[position:position + similar],
+                    base[offset:offset + similar]))
+            position += similar
+        start = position
+
+    if start < len(target):
+        yield ADD, target[start:]
+
+
+def _encode(ops):
+    """Serializes operations, see `diff_ops`."""
+    for op in ops:
+        if op[0] == COPY:
+            yield COPY_OP.pack(*op)
+        elif op[0] == ADD:
+            yield ADD_OP.pack(ADD, len(op[1]))
+            yield op[1]
+        else:
+            yield DIFF_OP.pack(DIFF, op[1], len(op[2]))
+            yield op[2]
+
+
+def make_patch(target, base=None):
+    """
+    Builds the patch rebuilding a target image from a base image.
+
+    Args:
+        target (bytes): The image to flash.
+        base (bytes, optional): The image the device runs. Without it, the
+          patch is the compressed target.
+
+    Returns:
+        bytes: The patch.
+    """
+    if base:
+        ops = diff_ops(base, target)
+        base_md5, base_size = md5(base), len(base)
+    else:
+        ops = [(ADD, target)]
+        base_md5, base_size = bytes(16), 0
+
+    compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    chunks = [HEADER.pack(MAGIC, base_md5, md5(target), base_size,
+                          len(target))]
+    for chunk in _encode(ops):
+        chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return b"".join(chunks)
+
+
+def read_header(patch):
+    """
+    Returns the base MD5, target MD5, base size and target size of a patch.
+
+    Raises:
+        PatchMismatch: If it isn't a patch.
+    """
+    if len(patch) < HEADER.size:
+        raise PatchMismatch("Truncated patch.")
+    magic, base_md5, target_md5, base_size, target_size = (
+        HEADER.unpack_from(patch))
+    if magic != MAGIC:
+        raise PatchMismatch("Not a firmware patch.")
+    return base_md5, target_md5, base_size, target_size
+
+
+def apply_patch(patch, base=b""):
+    """
+    Rebuilds the target image from a patch, as the device does.
+
+    Args:
+        patch (bytes): The patch.
+        base (bytes): The image the patch was made against, if any.
+
+    Returns:
+        bytes: The target image.
+
+    Raises:
+        PatchMismatch: If the patch is corrupted or truncated, was made
+          against another base or doesn't rebuild the image it was made
+          for.
+    """
+    base_md5, target_md5, base_size, target_size = read_header(patch)
+    if base_size and (len(base) != base_size or md5(base) != base_md5):
+        raise PatchMismatch("The patch was made for another base image.")
+
+    try:
+        body = zlib.decompress(patch[HEADER.size:])
+    except zlib.error as e:
+        raise PatchMismatch(f"Corrupted patch: {e}") from e
+    try:
+        target = _apply_ops(body, base)
+    except struct.error as e:
+        raise PatchMismatch(f"Truncated patch operation: {e}") from e
+
+    if len(target) != target_size or md5(target) != target_md5:
+        raise PatchMismatch("The patch rebuilt a different image.")
+    return bytes(target)
+
+
+def _apply_ops(body, base):
+    """Runs the decompressed operations of a patch, see `apply_patch`."""
+    target = bytearray()
+    position = 0
+    while position < len(body):
+        op = body[position]
+        if op == COPY:
+            _, offset, length = COPY_OP.unpack_from(body, position)
+            target += base[offset:offset + length]
+            position += COPY_OP.size
+        elif op == ADD:
+            _, length = ADD_OP.unpack_from(body, position)
+            position += ADD_OP.size
+            target += body[position:position + length]
+            position += length
+        elif op == DIFF:
+            _, offset, length = DIFF_OP.unpack_from(body, position)
+            position += DIFF_OP.size
+            target += bytes(
+                (old + delta) & 0xFF for old, delta in zip(
+                    base[offset:offset + length],
+                    body[position:position + length]))
+            position += length
+        else:
+            raise PatchMismatch(f"Unknown patch operation {op}.")
+    return target
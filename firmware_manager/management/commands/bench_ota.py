@@ -0,0 +1,143 @@
+import os
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from firmware_manager.delta import make_patch
+from firmware_manager.ota import FirmwareStore, push_firmware
+from light_app.benchmarking import FakeDevice
+from light_app.rate_limit import limiter
+
+
+def synthetic_release(image, rng, inserted=2048, relocated=0.4,
+                      rewritten=8192):
+    """
+    Derives the next release of a synthetic firmware image: some new code
+    shifts what follows it, addresses change in part of the image (one
+    byte per 256) and a region is rewritten.
+
+    Args:
+        image (bytes): The previous release.
+        rng (random.Random): The random generator.
+        inserted (int): Bytes of new code.
+        relocated (float): Fraction of the image whose addresses change.
+        rewritten (int): Bytes of the rewritten region.
+
+    Returns:
+        bytes: The new release.
+    """
+    release = bytearray(image)
+    at = rng.randrange(len(release))
+    release[at:at] = rng.randbytes(inserted)
+    start = rng.randrange(int(len(release) * (1 - relocated)))
+    for position in range(start, start + int(len(release) * relocated), 256):
+        release[position] = (release[position] + 4) & 0xFF
+    at = rng.randrange(len(release) - rewritten)
+    release[at:at + rewritten] = rng.randbytes(rewritten)
+    return bytes(release)
+
+
+def synthetic_image(size, rng):
+    """Returns a code-like image: a random vocabulary of 4-byte words."""
+    words = [rng.randbytes(4) for _ in range(4096)]
+    return b"".join(rng.choice(words) for _ in range(size // 4))
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark a firmware rollout to N simulated devices, sending full "
+        "images (as before) then patches from the image each device runs. "
+        "Uses a synthetic image pair unless --images is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--devices", type=int, default=20,
+                            help="Number of simulated devices.")
+        parser.add_argument("--size", type=int, default=1536 * 1024,
+                            help="Size of the synthetic image in bytes.")
+        parser.add_argument("--images", nargs=2, metavar=("OLD", "NEW"),
+                            help="Real images to use: the one the devices "
+                                 "run and the one to roll out.")
+        parser.add_argument("--unknown-fraction", type=float, default=0.1,
+                            help="Fraction of devices running an image the "
+                                 "server doesn't have (compressed image).")
+        parser.add_argument("--upload-rate", type=float, default=200,
+                            help="Upload throughput of a device, in KB/s.")
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="Devices updated in parallel.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        # Each device is updated once per rollout: no pacing needed
+        limiter.rate = 0
+        rng = random.Random(options["seed"])
+        if options["images"]:
+            old, new = (open(path, "rb").read()
+                        for path in options["images"])
+        else:
+            old = synthetic_image(options["size"], rng)
+            new = synthetic_release(old, rng)
+        unknown = synthetic_release(old, rng)
+
+        start = perf_counter()
+        patch = make_patch(new, old)
+        diff_seconds = perf_counter() - start
+        start = perf_counter()
+        compressed = make_patch(new)
+        compress_seconds = perf_counter() - start
+        self.stdout.write(
+            f"Image {len(new)} bytes, compressed {len(compressed)} bytes "
+            f"({compress_seconds:.2f} s), patch {len(patch)} bytes "
+            f"({100 * len(patch) / len(new):.1f}%, built in "
+            f"{diff_seconds:.2f} s, once per pair of images)")
+
+        with tempfile.TemporaryDirectory() as root:
+            old_path = os.path.join(root, "old.bin")
+            new_path = os.path.join(root, "firmware.bin")
+            with open(old_path, "wb") as f:
+                f.write(old)
+            with open(new_path, "wb") as f:
+                f.write(new)
+
+            for label, capable in (("full images", False), ("delta", True)):
+                store = FirmwareStore(os.path.join(root, label), 10)
+                # The running image was rolled out through this server
+                store.add(old_path)
+                self.rollout(label, capable, store, new_path, old, unknown,
+                             options)
+
+    def rollout(self, label, capable, store, path, old, unknown, options):
+        """Updates every simulated device and reports the transfer."""
+        upload_rate = options["upload_rate"] * 1024
+        with ExitStack() as stack:
+            devices = []
+            for index in range(options["devices"]):
+                running = (unknown if index < options["devices"]
+                           * options["unknown_fraction"] else old)
+                devices.append(stack.enter_context(FakeDevice(
+                    firmware=running if capable else None,
+                    upload_rate=upload_rate)))
+
+            def update(device):
+                began = perf_counter()
+                mode, sent = push_firmware(device.address, path, store)
+                return mode, sent, perf_counter() - began
+
+            start = perf_counter()
+            with ThreadPoolExecutor(options["concurrency"]) as executor:
+                results = list(executor.map(update, devices))
+            elapsed = perf_counter() - start
+
+        modes = {}
+        for mode, sent, seconds in results:
+            modes[mode] = modes.get(mode, 0) + 1
+        sent = sum(result[1] for result in results)
+        per_device = sum(result[2] for result in results) / len(results)
+        self.stdout.write(
+            f"{label:<12} {len(results)} devices in {elapsed:.2f} s, "
+            f"{sent / 1024:.0f} KB sent, {per_device:.2f} s per device, "
+            f"modes {modes}")
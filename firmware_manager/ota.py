@@ -0,0 +1,224 @@
+import logging
+import os
+import shutil
+import threading
+
+import requests
+from django.conf import settings
+
+from light_app.device_client import device_request
+from light_app.metrics import FIRMWARE_BYTES_PUSHED, FIRMWARE_UPDATES
+
+from .delta import make_patch, md5
+
+logger = logging.getLogger("home_control.firmware")
+
+# Patch format the device must list in its /firmware_info "formats"
+PATCH_FORMAT = "hcd1"
+# Upload file names telling the device how to flash the upload
+PATCH_FILENAME = "firmware.hcd"
+IMAGE_FILENAME = "firmware.bin"
+
+
+class FirmwareRejected(Exception):
+    """Raised when a device fails to flash the full firmware image."""
+
+
+class FirmwareStore:
+    """
+    Directory of the firmware images pushed to devices, named by their MD5,
+    and of the patches between them, built once per pair of images.
+
+    Keeping past images lets the server patch a device from whatever image
+    it runs, as reported by the device. Only the `max_images` most recently
+    pushed images are kept, with the patches from and to them.
+
+    Attributes:
+        root (str): The directory of the store.
+        max_images (int): Images kept.
+    """
+
+    def __init__(self, root=None, max_images=None):
+        self.root = root or getattr(settings, "FIRMWARE_STORE_DIR", "")
+        self.max_images = max_images or getattr(
+            settings, "FIRMWARE_STORE_MAX_IMAGES", 10)
+        self._lock = threading.Lock()
+
+    def image_path(self, image_md5):
+        """Returns the path of an image of the store."""
+        return os.path.join(self.root, "images", f"{image_md5}.bin")
+
+    def patch_path(self, target_md5, base_md5=None):
+        """Returns the path of a patch of the store."""
+        return os.path.join(self.root, "patches",
+                            f"{base_md5 or 'none'}-{target_md5}.hcd")
+
+    def has(self, image_md5):
+        """Tells whether an image is in the store."""
+        return bool(image_md5) and os.path.exists(self.image_path(image_md5))
+
+    def add(self, path):
+        """
+        Adds an image to the store, or marks it as recently pushed.
+
+        Args:
+            path (str): The path of the image file.
+
+        Returns:
+            str: The hex MD5 of the image.
+        """
+        with open(path, "rb") as f:
+            image_md5 = md5(f.read()).hex()
+        with self._lock:
+            stored = self.image_path(image_md5)
+            if os.path.exists(stored):
+                os.utime(stored)
+            else:
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                shutil.copyfile(path, stored + ".tmp")
+                os.replace(stored + ".tmp", stored)
+                self._prune()
+        return image_md5
+
+    def patch(self, target_md5, base_md5=None):
+        """
+        Returns the patch turning an image of the store into another, built
+        and cached on first use.
+
+        Args:
+            target_md5 (str): The image to flash.
+            base_md5 (str, optional): The image the device runs. Without
+              it, the patch is the compressed target image.
+
+        Returns:
+            str: The path of the patch file.
+        """
+        path = self.patch_path(target_md5, base_md5)
+        with self._lock:
+            if os.path.exists(path):
+                return path
+            with open(self.image_path(target_md5), "rb") as f:
+                target = f.read()
+            base = None
+            if base_md5:
+                with open(self.image_path(base_md5), "rb") as f:
+                    base = f.read()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(make_patch(target, base))
+            os.replace(path + ".tmp", path)
+        return path
+
+    def _prune(self):
+        """Drops the least recently pushed images beyond `max_images`."""
+        images_dir = os.path.join(self.root, "images")
+        images = sorted(
+            (entry for entry in os.scandir(images_dir)
+             if entry.name.endswith(".bin")),
+            key=lambda entry: entry.stat().st_mtime, reverse=True)
+        dropped = {entry.name[:-4] for entry in images[self.max_images:]}
+        for image_md5 in dropped:
+            os.remove(self.image_path(image_md5))
+        patches_dir = os.path.join(self.root, "patches")
+        if dropped and os.path.isdir(patches_dir):
+            for entry in os.scandir(patches_dir):
+                if dropped & set(entry.name[:-4].split("-")):
+                    os.remove(entry.path)
+
+
+def device_firmware(address):
+    """
+    Asks a device which image it runs.
+
+    Args:
+        address (str): The device IP address.
+
+    Returns:
+        str or None: The hex MD5 of the running image, "" if unknown, or
+        None if the device can't flash patches (older firmware).
+    """
+    try:
+        response = device_request("GET", address, "/firmware_info",
+                                  command="firmware_info")
+        info = response.json() if response.status_code == 200 else {}
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+    if PATCH_FORMAT not in info.get("formats", []):
+        return None
+    return str(info.get("md5", "")).lower()
+
+
+def _upload(address, path, filename):
+    """Uploads a firmware file to a device, returns the response."""
+    with open(path, "rb") as f:
+        response = device_request(
+            "POST",
+            address,
+            "/django_update_firmware",
+            command="firmware",
+            files={"firmware": (filename, f)},
+            timeout=None,
+        )
+    FIRMWARE_BYTES_PUSHED.inc(os.path.getsize(path))
+    return response
+
+
+def push_firmware(address, path, store=None):
+    """
+    Flashes a firmware image on a device, sending as few bytes as possible.
+
+    - If the device runs an image of the store, it gets the patch from
+      that image, typically a few percent of the image.
+    - If it runs an unknown image, it gets the compressed image.
+    - If it runs older firmware, or rejects the patch (e.g. its image
+      changed since it was asked), it gets the full image, as before.
+
+    Args:
+        address (str): The device IP address.
+        path (str): The path of the image to flash.
+        store (FirmwareStore, optional): Defaults to `firmware_store`.
+
+    Returns:
+        tuple: The transfer mode ("delta", "compressed", "full", "fallback"
+        or "up_to_date") and the bytes sent.
+
+    Raises:
+        FirmwareRejected: If the device fails to flash the full image.
+        requests.exceptions.RequestException: If the device can't be reached.
+        DeviceBusy: If too many commands are already queued for the device.
+    """
+    store = store or firmware_store
+    target_md5 = store.add(path)
+    base_md5 = device_firmware(address)
+    if base_md5 == target_md5:
+        FIRMWARE_UPDATES.inc(mode="up_to_date")
+        return "up_to_date", 0
+
+    sent = 0
+    mode = "full"
+    if base_md5 is not None:
+        if not store.has(base_md5):
+            base_md5 = None
+        patch_path = store.patch(target_md5, base_md5)
+        if os.path.getsize(patch_path) < os.path.getsize(path):
+            response = _upload(address, patch_path, PATCH_FILENAME)
+            sent = os.path.getsize(patch_path)
+            if response.status_code == 200:
+                mode = "delta" if base_md5 else "compressed"
+                FIRMWARE_UPDATES.inc(mode=mode)
+                return mode, sent
+            logger.warning(f"Device {address} rejected the firmware patch "
+                           f"({response.status_code}), sending the full "
+                           f"image")
+            mode = "fallback"
+
+    response = _upload(address, path, IMAGE_FILENAME)
+    if response.status_code != 200:
+        raise FirmwareRejected(
+            f"Device {address} failed to flash the firmware.")
+    FIRMWARE_UPDATES.inc(mode=mode)
+    return mode, sent + os.path.getsize(path)
+
+
+# Store of the images pushed by this deployment
+firmware_store = FirmwareStore()
@@ -1,2 +1,69 @@
-from django.test import TestCase
+import random
 
+from django.test import SimpleTestCase
+
+from .delta import HEADER, PatchMismatch, apply_patch, make_patch
+
+
+class DeltaPatchTests(SimpleTestCase):
+    """Round trips of `make_patch` and `apply_patch`."""
+
+    def setUp(self):
+        rng = random.Random(46)
+        self.base = rng.randbytes(64 * 1024)
+        self.inserted = rng.randbytes(3000)
+
+    def assertRoundTrip(self, target, base=None):
+        patch = make_patch(target, base)
+        self.assertEqual(apply_patch(patch, base or b""), target)
+        return patch
+
+    def test_identical_image(self):
+        patch = self.assertRoundTrip(self.base, self.base)
+        self.assertLess(len(patch), 200)
+
+    def test_shifted_region(self):
+        # The second half moves 5 bytes further, as after a code change
+        target = (self.base[:30000] + b"\x00" * 5 + self.base[30000:])
+        patch = self.assertRoundTrip(target, self.base)
+        self.assertLess(len(patch), 500)
+
+    def test_inserted_region(self):
+        target = self.base[:20000] + self.inserted + self.base[20000:]
+        patch = self.assertRoundTrip(target, self.base)
+        self.assertLess(len(patch), len(self.inserted) + 500)
+
+    def test_shifted_addresses(self):
+        # Same layout with every 200th byte (an "address") bumped by one
+        target = bytearray(self.base)
+        for offset in range(0, len(target), 200):
+            target[offset] = (target[offset] + 1) & 0xFF
+        patch = self.assertRoundTrip(bytes(target), self.base)
+        self.assertLess(len(patch), len(target) // 4)
+
+    def test_empty_base(self):
+        self.assertRoundTrip(self.base)
+        self.assertRoundTrip(self.base, b"")
+        self.assertRoundTrip(b"", self.base)
+
+    def test_other_base_rejected(self):
+        patch = make_patch(self.inserted + self.base, self.base)
+        with self.assertRaises(PatchMismatch):
+            apply_patch(patch, self.base[1:])
+
+    def test_corrupted_patch_rejected(self):
+        patch = bytearray(make_patch(self.inserted + self.base, self.base))
+        patch[len(patch) // 2] ^= 0xFF
+        with self.assertRaises(PatchMismatch):
+            apply_patch(bytes(patch), self.base)
+
+    def test_truncated_patch_rejected(self):
+        patch = make_patch(self.inserted + self.base, self.base)
+        for length in (HEADER.size - 1, HEADER.size + 10, len(patch) - 1):
+            with self.subTest(length=length):
+                with self.assertRaises(PatchMismatch):
+                    apply_patch(patch[:length], self.base)
+
+    def test_not_a_patch_rejected(self):
+        with self.assertRaises(PatchMismatch):
+            apply_patch(b"\x00" * (HEADER.size + 10))
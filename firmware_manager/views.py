@@ -1,11 +1,12 @@
 from django.shortcuts import render
 from django.http import JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
-import requests
 import os
 from django.conf import settings
 import logging
-logger = logging.getLogger('my_custom_logger')
+from light_app.rate_limit import DeviceBusy
+from .ota import push_firmware, FirmwareRejected
+logger = logging.getLogger('home_control.firmware')
 
 from .signals import message_received
 from django.dispatch import receiver
@@ -23,7 +24,7 @@ def handle_message(sender, **kwargs):
     message = kwargs.get("message")
         
     # Aici poți face ceva în funcție de mesajul primit
-    print(f"Mesajul primit în alt fișier: {message}")
+    logger.debug(f"Mesajul primit în alt fișier: {message}")
 
 
 @csrf_exempt
@@ -35,8 +36,8 @@ def upload_firmware(request):
                 raise Exception("No firmware file found in request.")
 
             file_path = os.path.join(settings.MEDIA_ROOT, firmware_file.name)
-            print(f"Received firmware file: {firmware_file.name}")
-            print(f"Saving to: {file_path}")
+            logger.info(f"Received firmware file: {firmware_file.name}, "
+                        f"saving to: {file_path}")
 
             # Salvează fișierul pe serverul Django
             with open(file_path, "wb+") as destination:
@@ -66,25 +67,27 @@ def upload_to_esp32(request):
             settings.MEDIA_ROOT, "firmware.bin"
         )  # Fișierul deja uploadat
 
-        with open(file_path, "rb") as f:
-            url = (
-                f"http://{request.user_ip}/django_update_firmware" 
-            )
-            response = requests.post(url, files={"firmware": f})
-
-        if response.status_code == 200:
-            return JsonResponse(
-                {
-                    "status": "success",
-                    "message": "Firmware uploaded to ESP32 successfully",
-                }
-            )
-        else:
-            return JsonResponse(
-                {"status": "error", "message": "Failed to upload\
-                  firmware to ESP32"},
-                status=500,
-            )
+        # Sends a patch from the device's current image when possible,
+        # see `push_firmware`
+        mode, sent = push_firmware(request.user_ip, file_path)
+        return JsonResponse(
+            {
+                "status": "success",
+                "message": "Firmware uploaded to ESP32 successfully",
+                "mode": mode,
+                "bytes_sent": sent,
+            }
+        )
+    except FirmwareRejected:
+        return JsonResponse(
+            {"status": "error", "message": "Failed to upload\
+              firmware to ESP32"},
+            status=500,
+        )
+    except DeviceBusy as e:
+        # Too many commands are already queued for the device
+        return JsonResponse({"status": "error", "message": str(e)},
+                            status=429)
     except Exception as e:
         return JsonResponse(
             {"status": "error", "message": f"An error occurred: {str(e)}"},
@@ -15,22 +15,31 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-from firmware_manager.routing import websocket_urlpatterns  
 
 # Set the default settings module for the 'asgi' application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", 
                       "home_control_project.settings")
 
+# Set Django up before importing the consumers, which use the models
+django_asgi_app = get_asgi_application()
+
+from firmware_manager.routing import websocket_urlpatterns  # noqa: E402
+from light_app.routing import (  # noqa: E402
+    websocket_urlpatterns as device_websocket_urlpatterns,
+)
+
 # Define the ASGI application, handling both HTTP and WebSocket protocols
 application = ProtocolTypeRouter(
     {
         # HTTP requests are handled by Django's ASGI application
-        "http": get_asgi_application(),
+        "http": django_asgi_app,
         
         # WebSocket connections are handled via the Channels routing and
         #  authentication stack
         "websocket": AuthMiddlewareStack(
-            URLRouter(websocket_urlpatterns)  # Define URL routing for WebS.
+            # Define URL routing for WebS. (the devices' command channel and
+            #  the settings consumer)
+            URLRouter(device_websocket_urlpatterns + websocket_urlpatterns)
         ),
     }
 )
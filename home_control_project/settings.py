@@ -2,10 +2,6 @@ import os
 from pathlib import Path
 import dj_database_url
 from django.contrib.messages import constants as messages
-import cloudinary
-import cloudinary.uploader
-import cloudinary.api
-import django_heroku
 import json
 
 # Load environment variables from 'env.py' if the file exists
@@ -33,6 +29,136 @@ ALLOWED_HOSTS = os.getenv("ALLOWED_HOSTS", "127.0.0.1").split(',')
 API_USERNAME = os.getenv("DJANGO_API_USERNAME")
 API_PASSWORD = os.getenv("DJANGO_API_PASSWORD")
 
+# Home status hysteresis: consecutive failed probes before a home is marked
+# offline, and consecutive successful probes before it is marked online again
+HOME_STATUS_OFFLINE_THRESHOLD = int(
+    os.getenv("HOME_STATUS_OFFLINE_THRESHOLD", "3"))
+HOME_STATUS_ONLINE_THRESHOLD = int(
+    os.getenv("HOME_STATUS_ONLINE_THRESHOLD", "2"))
+
+# Seconds after their last request during which a user's device keeps being
+# polled (users with "always_poll" enabled are polled regardless)
+POLL_ACTIVITY_WINDOW = int(os.getenv("POLL_ACTIVITY_WINDOW", "900"))
+# Seconds between two reloads of the poller's target index, picking up the
+# settings changed through other processes
+POLL_TARGETS_RELOAD_INTERVAL = float(
+    os.getenv("POLL_TARGETS_RELOAD_INTERVAL", "60"))
+
+# Bearer token of the scrapers of the /metrics endpoint; without it, only
+# staff users can see the metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Request profiling (see /admin/profiling/). When enabled, every request is
+# timed per view and PROFILING_SAMPLE_RATE of them run under cProfile (async
+# views record their query and device call spans); those slower than
+# PROFILING_SLOW_MS are kept in a ring buffer
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "False") == "True"
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0.01"))
+PROFILING_SLOW_MS = int(os.getenv("PROFILING_SLOW_MS", "500"))
+PROFILING_BUFFER_SIZE = int(os.getenv("PROFILING_BUFFER_SIZE", "50"))
+
+# Start the background device poller in this process. It is only started by
+# the servers (daphne, gunicorn, uvicorn, hypercorn) and runserver, never by
+# other commands or scripts, see LightAppConfig.ready()
+POLLER_AUTOSTART = os.getenv("POLLER_AUTOSTART", "True") == "True"
+
+# Sharding of the poller over several workers (see light_app/sharding.py):
+# where the live workers are listed ("db" or "redis", empty for a single
+# poller owning every home), the name of this worker (host:pid by default),
+# seconds between two membership renewals, and seconds after which a
+# silent worker's homes are taken over
+POLLER_MEMBERSHIP = os.getenv("POLLER_MEMBERSHIP", "")
+POLLER_WORKER_NAME = os.getenv("POLLER_WORKER_NAME", "")
+POLLER_MEMBERSHIP_INTERVAL = float(
+    os.getenv("POLLER_MEMBERSHIP_INTERVAL", "5"))
+POLLER_MEMBERSHIP_TTL = float(os.getenv("POLLER_MEMBERSHIP_TTL", "15"))
+
+# Budget (in milliseconds) for importing the project and running
+# django.setup(), checked by "manage.py check_startup"
+STARTUP_IMPORT_BUDGET_MS = int(os.getenv("STARTUP_IMPORT_BUDGET_MS", "400"))
+
+# Seconds a rendered room list page stays cached. Pages are also dropped as
+# soon as one of the user's rooms, lights or settings changes
+FRAGMENT_CACHE_TIMEOUT = int(os.getenv("FRAGMENT_CACHE_TIMEOUT", "3600"))
+
+# Tracing of requests, ORM queries, device calls and Channels messages
+# (see light_app/tracing.py): "file" appends the spans to TRACING_FILE as
+# JSON lines, "otlp" sends them to an OpenTelemetry collector's OTLP/HTTP
+# endpoint; unset disables tracing. Only TRACING_SAMPLE_RATE of the
+# traces are recorded, plus those a caller's `traceparent` marks as sampled
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "")
+TRACING_FILE = os.getenv("TRACING_FILE", os.path.join(BASE_DIR,
+                                                      "traces.jsonl"))
+TRACING_OTLP_ENDPOINT = os.getenv(
+    "TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "home-control")
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1.0"))
+# Seconds between two exports of the recorded spans
+TRACING_EXPORT_INTERVAL = float(os.getenv("TRACING_EXPORT_INTERVAL", "2"))
+
+# Firmware images pushed to devices and the delta patches between them
+# (see firmware_manager/ota.py), and how many past images are kept to patch
+# devices from
+FIRMWARE_STORE_DIR = os.getenv(
+    "FIRMWARE_STORE_DIR", os.path.join(BASE_DIR, "firmware_store"))
+FIRMWARE_STORE_MAX_IMAGES = int(os.getenv("FIRMWARE_STORE_MAX_IMAGES", "10"))
+
+# Logging (see light_app/structured_logging.py): records are queued and
+# written by a background thread, as JSON lines (LOG_FORMAT=json) or text,
+# to stderr or LOG_FILE. LOG_LEVEL applies to every subsystem logger
+# ("home_control.<subsystem>": poller, heartbeats, devices, events,
+# firmware, tracing, views) unless LOG_LEVELS overrides it, e.g.
+# "poller=DEBUG,heartbeats=WARNING". Warnings and errors repeated from the
+# same place (and device) are logged at most once per
+# LOG_RATE_LIMIT_INTERVAL seconds
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if DEBUG else "INFO").upper()
+LOG_LEVELS = {
+    name.strip(): level.strip().upper()
+    for name, _, level in (
+        item.partition("=") for item in os.getenv("LOG_LEVELS", "").split(",")
+    )
+    if name.strip() and level.strip()
+}
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_RATE_LIMIT_INTERVAL = float(os.getenv("LOG_RATE_LIMIT_INTERVAL", "60"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "json": {"()": "light_app.structured_logging.JsonFormatter"},
+        "text": {"format": "%(asctime)s %(levelname)s %(name)s %(message)s"},
+    },
+    "filters": {
+        "rate_limit": {
+            "()": "light_app.structured_logging.RateLimitFilter",
+            "interval": LOG_RATE_LIMIT_INTERVAL,
+        },
+    },
+    "handlers": {
+        "async": {
+            "()": "light_app.structured_logging.AsyncQueueHandler",
+            "formatter": LOG_FORMAT,
+            "filters": ["rate_limit"],
+            "filename": LOG_FILE,
+            "queue_size": LOG_QUEUE_SIZE,
+        },
+    },
+    "loggers": {
+        "home_control": {
+            "handlers": ["async"],
+            "level": LOG_LEVEL,
+            "propagate": False,
+        },
+        **{
+            f"home_control.{name}": {"level": level}
+            for name, level in LOG_LEVELS.items()
+        },
+    },
+}
+
 # Installed applications (both third-party and custom)
 INSTALLED_APPS = [
     "django.contrib.admin",
@@ -41,7 +167,6 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
-    "cloudinary_storage",  # For Cloudinary storage
     "django.contrib.sites",
     "allauth",  # Django allauth for authentication
     "allauth.account",
@@ -49,7 +174,6 @@ INSTALLED_APPS = [
     "crispy_forms",  # For form styling
     "crispy_bootstrap5",  # Bootstrap 5 support for Crispy Forms
     "django_summernote",  # Text editor
-    "cloudinary",  # Cloudinary media storage
     "django_resized",  # Resizing images
     "light_app",  # Custom app for handling light functionalities
     "firmware_manager",  # Custom app for firmware management
@@ -82,17 +206,82 @@ ACCOUNT_EMAIL_VERIFICATION = "none"
 
 # Channels configuration
 ASGI_APPLICATION = "home_control_project.asgi.application"
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-    },
-}
+
+# Per-device rate limiting of the commands sent to the M5Core2: sustained
+# commands per second, commands accepted back to back, and commands allowed
+# to wait for a slot before new ones are rejected
+DEVICE_RATE_LIMIT = float(os.getenv("DEVICE_RATE_LIMIT", "5"))
+DEVICE_RATE_BURST = int(os.getenv("DEVICE_RATE_BURST", "3"))
+DEVICE_QUEUE_SIZE = int(os.getenv("DEVICE_QUEUE_SIZE", "8"))
+
+# Device heartbeats (see light_app/heartbeats.py): seconds between two
+# batched flushes, check intervals without a beat before a home is marked
+# offline, allowed clock skew of a beat in seconds, and the UDP port of
+# "manage.py listen_heartbeats"
+HEARTBEAT_FLUSH_INTERVAL = float(os.getenv("HEARTBEAT_FLUSH_INTERVAL", "1"))
+HEARTBEAT_MISSED_BEATS = float(os.getenv("HEARTBEAT_MISSED_BEATS", "2"))
+HEARTBEAT_MAX_SKEW = int(os.getenv("HEARTBEAT_MAX_SKEW", "60"))
+HEARTBEAT_UDP_PORT = int(os.getenv("HEARTBEAT_UDP_PORT", "9999"))
+
+# Light state change log (see light_app/light_events.py): seconds between
+# two batched writes, and pending changes written at once
+LIGHT_EVENTS_FLUSH_INTERVAL = float(
+    os.getenv("LIGHT_EVENTS_FLUSH_INTERVAL", "1"))
+LIGHT_EVENTS_BATCH_SIZE = int(os.getenv("LIGHT_EVENTS_BATCH_SIZE", "1000"))
+
+# Cache: Redis shared by all the workers when REDIS_URL is set, otherwise
+# a per-process local memory cache
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+
+# Channel layer: the same Redis when REDIS_URL is set, so a command sent by
+# any worker reaches the device's socket wherever it is open (the device
+# presence is shared through CACHES), otherwise in-process like the cache
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [REDIS_URL]},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+# In-process cache tier in front of CACHES["default"] (see
+# light_app/tiered_cache.py): entries kept, and seconds they stay valid,
+# which bounds how stale another worker's view can be after a change
+CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("CACHE_LOCAL_MAX_ENTRIES", "1024"))
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", "2"))
 
 # Middleware configuration for request handling and session management
 MIDDLEWARE = [
+    # Request, query and device call spans, see TRACING_* below
+    "light_app.middleware.TracingMiddleware",
+    # Response time and query count metrics, see /metrics
+    "light_app.middleware.MetricsMiddleware",
+    # Read-your-writes when reading from replicas, see DATABASE_REPLICAS
+    "light_app.middleware.ReplicaPinningMiddleware",
+    # Opt-in per-view profiling, see PROFILING_* below
+    "light_app.middleware.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    # Static file serving for production
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    # Static file serving for production (async-capable WhiteNoise)
+    "light_app.middleware.StaticFilesMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -134,10 +323,75 @@ WSGI_APPLICATION = "home_control_project.wsgi.application"
 
 # DATABASE CONFIGURATION
 
+# Seconds a thread keeps its connection open when the database isn't
+# pooled. Keep it at 0 under ASGI (daphne, see Procfile): Django runs the
+# sync code of each request in a new thread, so a persistent connection
+# would never be reused, only left open until garbage collected. Only
+# long-lived threads (WSGI workers, the poller) can reuse one
+DB_CONN_MAX_AGE = int(os.getenv("DB_CONN_MAX_AGE", "0"))
+# Use psycopg's connection pool on PostgreSQL (the default), sized by the
+# DB_POOL_* settings: request threads and background workers borrow a
+# connection for a request or a poller iteration and give it back, so
+# connections are reused across requests whatever thread serves them
+DB_POOL = os.getenv("DB_POOL", "True") == "True"
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Seconds to wait for a free connection before failing the request
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Seconds after which pooled connections are replaced, or closed if idle
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+# Connect through PgBouncer in transaction mode: no server-side cursors or
+# prepared statements, which don't survive switching server connections,
+# and no client-side pool on top of PgBouncer's
+PGBOUNCER = os.getenv("PGBOUNCER", "False") == "True"
+
+# Read replicas of the default database, as comma-separated database URLs.
+# Reads go to a random replica, except for REPLICA_STICKY_SECONDS after a
+# client or task wrote something (read-your-writes); writes go to default
+DATABASE_REPLICA_URLS = [
+    url.strip()
+    for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",")
+    if url.strip()
+]
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+
 # Database configuration using dj_database_url
 DATABASES = {
-    "default": dj_database_url.config(default=os.environ.get("DATABASE_URL"))
+    "default": dj_database_url.config(
+        default=os.environ.get("DATABASE_URL"),
+        conn_max_age=DB_CONN_MAX_AGE,
+        conn_health_checks=True,
+        # Heroku Postgres only accepts SSL connections
+        ssl_require="DYNO" in os.environ,
+    )
 }
+DATABASE_REPLICAS = []
+for index, url in enumerate(DATABASE_REPLICA_URLS, start=1):
+    DATABASE_REPLICAS.append(f"replica_{index}")
+    DATABASES[f"replica_{index}"] = dj_database_url.parse(
+        url, conn_max_age=DB_CONN_MAX_AGE, conn_health_checks=True)
+    # Tests read the replicas from the test database
+    DATABASES[f"replica_{index}"]["TEST"] = {"MIRROR": "default"}
+DATABASE_ROUTERS = ["light_app.db_router.ReplicaRouter"]
+
+for database in DATABASES.values():
+    if database.get("ENGINE") != "django.db.backends.postgresql":
+        continue
+    db_options = database.setdefault("OPTIONS", {})
+    if PGBOUNCER:
+        database["DISABLE_SERVER_SIDE_CURSORS"] = True
+        db_options["prepare_threshold"] = None
+    elif DB_POOL:
+        # Pooled connections are returned after each request instead
+        database["CONN_MAX_AGE"] = 0
+        db_options["pool"] = {
+            "min_size": DB_POOL_MIN_SIZE,
+            "max_size": DB_POOL_MAX_SIZE,
+            "timeout": DB_POOL_TIMEOUT,
+            "max_lifetime": DB_POOL_MAX_LIFETIME,
+            "max_idle": DB_POOL_MAX_IDLE,
+        }
 # Cloudinary configuration for storing media files
 CLOUDINARY_URL = os.getenv("CLOUDINARY_URL")
 
@@ -160,6 +414,12 @@ else:
     STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
     MEDIA_URL = "/media/"
     DEFAULT_FILE_STORAGE = "cloudinary_storage.storage.MediaCloudinaryStorage"
+    # Cloudinary is only used for production media; loading its apps only
+    # here keeps it out of development and test start-up
+    INSTALLED_APPS += [
+        "cloudinary_storage",  # For Cloudinary storage
+        "cloudinary",  # Cloudinary media storage
+    ]
 
 # CSRF trusted origins configuration for securing
 #  cross-site request forgery protection
@@ -199,6 +459,16 @@ SUMMERNOTE_CONFIG = {
 # Default primary key field type for Django models
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
-# Apply Heroku-specific settings like static file handling and database
+# Apply Heroku-specific settings (allowed hosts, secret key, test runner).
+# The database is configured above from DATABASE_URL: letting django_heroku
+# replace it would drop the pool and PgBouncer options. Static files are
+# configured above too: django_heroku would prepend the sync-only
+# WhiteNoiseMiddleware to MIDDLEWARE, and its console LOGGING would replace
+# the structured logging configured above
 if "DYNO" in os.environ:
-    django_heroku.settings(locals())
+    # Imported here as it pulls in django.test, which other processes
+    # don't need
+    import django_heroku
+
+    django_heroku.settings(locals(), databases=False, staticfiles=False,
+                           logging=False)
@@ -1,9 +1,12 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
+from light_app import views as light_views
 
 urlpatterns = [
     path("accounts/", include("allauth.urls")),
+    # Profiling page, routed before the admin's catch-all
+    path("admin/profiling/", light_views.profiling_view, name="profiling"),
     path("admin/", admin.site.urls),
     path(
         "update/", include("firmware_manager.urls")
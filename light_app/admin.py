@@ -1,7 +1,18 @@
 from django.contrib import admin
-from .models import Room, Light, Choice,UserSettings
+from .models import Room, Light, Choice, Scene, SceneLight, UserSettings
 
 admin.site.register(Room)
 admin.site.register(Light)
 admin.site.register(Choice)
 admin.site.register(UserSettings)
+
+
+class SceneLightInline(admin.TabularInline):
+    model = SceneLight
+    extra = 1
+
+
+@admin.register(Scene)
+class SceneAdmin(admin.ModelAdmin):
+    list_display = ("name", "user")
+    inlines = [SceneLightInline]
@@ -1,13 +1,59 @@
+import os
+import sys
+
 from django.apps import AppConfig
-from django.db import connections
+from django.conf import settings
+
+# Servers whose processes serve requests, by program name
+SERVER_PROGRAMS = ("daphne", "gunicorn", "uvicorn", "hypercorn")
+
+
+def program_name():
+    """
+    Returns the name of the program running this process, e.g. "daphne"
+    for both `daphne ...` and `python -m daphne ...`.
+    """
+    if not sys.argv or not sys.argv[0]:
+        return ""
+    path = sys.argv[0]
+    if os.path.basename(path) == "__main__.py":
+        path = os.path.dirname(path)
+    name = os.path.basename(path)
+    return name[:-3] if name.endswith(".py") else name
+
+
+def serves_requests():
+    """
+    Tells whether this process will serve requests, i.e. whether it needs
+    the background poller.
+
+    Only the known servers (`SERVER_PROGRAMS`) and `runserver` do; any
+    other process (management commands, pytest, celery, scripts...)
+    doesn't, and neither does the parent process of the runserver
+    autoreloader.
+
+    Returns:
+        bool: True if the poller should be started in this process.
+    """
+    program = program_name()
+    if program in SERVER_PROGRAMS:
+        return True
+    if program not in ("manage", "django-admin", "django") or (
+            len(sys.argv) < 2):
+        return False
+    if sys.argv[1] != "runserver":
+        return False
+    return os.environ.get("RUN_MAIN") == "true" or "--noreload" in sys.argv
 
 
 class LightAppConfig(AppConfig):
     """
     Configuration class for the 'light_app' Django application.
 
-    This class ensures that database migrations are checked at startup
-    and starts the ping task for all users if there are no pending migrations.
+    This class connects the app's signal receivers and starts the background
+    ping task in processes that serve requests. It does not touch the
+    database, so start-up stays cheap for management commands and test
+    workers.
     """
 
     default_auto_field = "django.db.models.BigAutoField"
@@ -17,16 +63,20 @@ class LightAppConfig(AppConfig):
         """
         This method is executed when the app is ready.
 
-        It ensures that there are no pending migrations before the application
-        starts interacting with the database, and it initiates the
-          task to start
-        pinging for all users.
+        It connects the signal receivers, before any database connection is
+        opened, and, unless disabled with the `POLLER_AUTOSTART` setting,
+        starts the background task pinging the users' devices. The task only
+        queries the database from its own thread, once running.
         """
-        # Open a connection to the default database
+        # Connect the signal receivers (user settings, poll target index,
+        # per-request query counting, connection metrics, replica routing
+        # and query tracing)
+        from . import (  # noqa: F401
+            signals, query_stats, db_pool, db_router, tracing,
+        )
 
-        connection = connections["default"]
-        connection.prepare_database()  # Ensure the database is prepared
-        # Pornește task-ul în background
-        from .background_task import start_background_task
+        if getattr(settings, "POLLER_AUTOSTART", True) and serves_requests():
+            # Pornește task-ul în background
+            from .background_task import start_background_task
 
-        start_background_task()
+            start_background_task()
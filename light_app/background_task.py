@@ -1,20 +1,135 @@
 import threading
-from time import sleep
-from django.contrib.sessions.models import Session
-from django.utils import timezone
+from time import monotonic, perf_counter
 import requests
 import logging
-from light_app.models import UserSettings, User
-from .context_processors import home_online_status, debug
-
-# Initialize logger for custom logging
-logger = logging.getLogger("my_custom_logger")
+from django.db import close_old_connections
+from .device_client import device_probe
+from .heartbeats import heartbeats
+from .home_status import tracker
+from .metrics import PROBE_SECONDS
+from .poll_targets import poll_targets
+from .rate_limit import DeviceBusy
+from .sharding import poller_shard
+from .tracing import tracer
+
+# Logger of the poller (see LOGGING in settings)
+logger = logging.getLogger("home_control.poller")
 
 # Global variables
 update = True
 response_text = ""
 count = 0
-lock = threading.Lock()
+# Monotonic time at which each user's device is next due for a probe
+next_probe_at = {}
+
+# Seconds to wait when no device is due for a probe
+IDLE_INTERVAL = 10
+# Set to ask the permanent task to exit, see `stop_background_task`
+stop_event = threading.Event()
+# The thread running the permanent task, if started
+poller_thread = None
+
+
+def probe_target(target):
+    """
+    Probes a single user's device and feeds the result to the tracker.
+
+    If the user is in "test mode", a flapping device is simulated by
+    alternating the probe result. Otherwise, an HTTP request is sent to the
+    user's M5Core2 IP to check if the device is online.
+
+    Args:
+        target (PollTarget): The snapshot of the user's device settings.
+
+    Returns:
+        None
+    """
+    global update, response_text, count
+
+    if target.test_mode:
+        # Alternate the probe result to simulate a flapping device; the
+        # tracker damps the transitions
+        reachable = not tracker.last_probe(target.user_id)
+    else:
+        start = perf_counter()
+        try:
+            # Send a GET request to check the M5Core2  status
+            response = device_probe(
+                target.m5core2_ip,
+                params={"check_interval": target.server_check_interval},
+                command="probe",
+            )
+
+            if response.status_code == 200:
+                count += 1
+                logger.debug(f"home_online {count}")
+                reachable = True
+                result = "online"
+            else:
+                logger.debug(f"home_Offline {count}")
+                reachable = False
+                result = "offline"
+        except DeviceBusy:
+            # The device's queue is full of user commands; not a failure,
+            # probe it again next time
+            logger.debug(f"Probe of {target.m5core2_ip} skipped, "
+                         f"device busy")
+            return
+        except requests.exceptions.RequestException as e:
+            # Handle connection error, count it as a failure
+            reachable = False
+            result = "error"
+            response_text = f"Server offline: {e}"
+            # Logged once a minute per device while it stays offline
+            logger.error(response_text,
+                         extra={"rate_key": target.m5core2_ip})
+        PROBE_SECONDS.observe(perf_counter() - start, result=result)
+
+    if tracker.record(target.user_id, reachable):
+        update = True
+
+
+def poll_once():
+    """
+    Runs one poller iteration over the devices that are due for a probe.
+
+    Only users returned by the `poll_targets` index are considered, i.e.
+    users with a configured device who are either recently active or opted
+    in with `always_poll`, and, when several pollers share the homes, only
+    those of this worker's shard. Each device is probed at most once per
+    its own `server_check_interval`, and not at all while it pushes
+    heartbeats.
+
+    Returns:
+        float: The number of seconds until the next device is due.
+    """
+    poller_shard.refresh()
+    now = monotonic()
+    targets = poll_targets.due_targets(poller_shard.owns)
+    # Homes whose device pushes heartbeats don't need probing
+    alive = heartbeats.fresh_users(
+        target.user_id for target in targets if not target.test_mode
+        and next_probe_at.get(target.user_id, 0) <= now
+    )
+
+    for target in targets:
+        if next_probe_at.get(target.user_id, 0) > now:
+            continue
+        if target.user_id not in alive:
+            with tracer.span("poller.probe", root=True,
+                             attributes={"user.id": target.user_id}):
+                probe_target(target)
+        next_probe_at[target.user_id] = (
+            monotonic() + target.server_check_interval
+        )
+
+    # Wake up in time to renew the shard membership
+    idle = (min(IDLE_INTERVAL, poller_shard.refresh_interval)
+            if poller_shard.enabled else IDLE_INTERVAL)
+    due_at = [next_probe_at.get(target.user_id, now) for target in targets]
+    if not due_at:
+        return idle
+    return min(max(min(due_at) - monotonic(), 0.1), idle)
 
 
 def start_permanent_task():
@@ -25,80 +140,40 @@ def start_permanent_task():
     status.
 
     The task:
-    - Checks if there are active user sessions.
-    - If a user is in "test mode", it toggles their `home_online_status`.
-    - Otherwise, it sends an HTTP request to the user's M5Core2 IP to check
-      if the device is online.
-    - Logs and handles any errors related to connectivity.
+    - Asks the `poll_targets` index which devices should be probed.
+    - Probes each due device, see `probe_target`.
+    - Feeds every probe result to the hysteresis `tracker`, which decides
+      when the published `home_online_status` actually changes.
+    - Sleeps until the next device is due.
 
     This function is designed to run indefinitely within a separate thread.
 
     Returns:
         None
     """
-    global home_online_status, update, response_text, count
-
-    while True:
-        # Retrieve active sessions
-        active_sessions = Session.objects.filter(
-            expire_date__gte=timezone.now()
-        )
-
-        if active_sessions.exists():
-            for user in User.objects.all():
-                user_id = user.id
-                try:
-                    # Retrieve user settings
-                    user_settings = UserSettings.objects.get(user=user)
-
-                    # Check if the user is in test mode
-                    if user_settings.test_mode:
-                        with lock:
-                            # Toggle the current home_onlineStatus for the user
-                            current_status = home_online_status.get(
-                                user_id, False
-                                )
-                            home_online_status[user_id] = not current_status
-                        update = True
-
-                    else:
-                        try:
-                            # Send a GET request to check the M5Core2  status
-                            response = requests.get(
-                                f"http://{user_settings.m5core2_ip}"
-                                f"?check_interval="
-                                f"{user_settings.server_check_interval}",
-                                timeout=30,
-                            )
-
-                            if response.status_code == 200:
-                                count += 1
-                                debug(f"home_online {count}")
-
-                                with lock:
-                                    # Mark home as online
-                                    home_online_status[user_id] = True
-                            else:
-                                debug(f"home_Offline {count}")
-                                with lock:
-                                    # Mark home as offline
-                                    home_online_status[user_id] = False
-                        except requests.exceptions.RequestException as e:
-                            # Handle connection error, mark home as offline
-                            with lock:
-                                home_online_status[user_id] = False
-                            response_text = f"Server offline: {e}"
-                            logger.error(response_text)
-
-                except UserSettings.DoesNotExist:
-                    # If UserSettings do not exist for a user, skip them
-                    continue
-
-        # Sleep for the defined interval
-        if "user_settings" in locals():
-            sleep(user_settings.server_check_interval)
-        else:
-            sleep(10)
+    while not stop_event.is_set():
+        # Like a request, each iteration drops a connection that outlived
+        # CONN_MAX_AGE or broke, and gives a pooled one back when done, so
+        # the thread doesn't hold a connection while it sleeps
+        close_old_connections()
+        try:
+            delay = poll_once()
+        except Exception as e:
+            # Keep the poller alive on unexpected (e.g. database) errors
+            logger.error(f"Poller iteration failed: {e}")
+            delay = IDLE_INTERVAL
+        finally:
+            close_old_connections()
+
+        # Sleep until the next device is due, or until asked to stop
+        stop_event.wait(delay)
+
+    try:
+        poller_shard.leave()
+    except Exception as e:
+        logger.error(f"Leaving the poller shards failed: {e}")
+    finally:
+        close_old_connections()
 
 
 def start_background_task():
@@ -108,9 +183,31 @@ def start_background_task():
     home statuses without blocking the main application.
 
     Returns:
-        None
+        threading.Thread: The started thread.
     """
+    global poller_thread
+
+    stop_event.clear()
     task_thread = threading.Thread(target=start_permanent_task)
     # Ensure the thread will not prevent the program from exiting
     task_thread.daemon = True
     task_thread.start()
+    poller_thread = task_thread
+    return task_thread
+
+
+def stop_background_task(timeout=None):
+    """
+    Asks the permanent background task to exit after its current iteration,
+    e.g. so a benchmark can drive `poll_once` on its own.
+
+    Args:
+        timeout (float, optional): Seconds to wait for the thread to exit.
+          Defaults to waiting until it does.
+
+    Returns:
+        None
+    """
+    stop_event.set()
+    if poller_thread is not None:
+        poller_thread.join(timeout)
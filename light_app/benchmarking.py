@@ -0,0 +1,289 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import urlsplit, parse_qs
+
+from django.db import connection, connections
+
+
+class FakeDevice:
+    """
+    Local asyncio stand-in for the M5Core2 web server, used by the
+    benchmark commands.
+
+    It answers the endpoints Django calls on a real device (`/`,
+    `/control_led`, `/control_batch`, `/firmware_info` and
+    `/django_update_firmware`) after a configurable latency, and fails a
+    configurable fraction of the requests with a 503. Given a firmware
+    image, it flashes the uploaded images and patches like the device does.
+    The server runs its own event loop in a daemon thread.
+
+    Attributes:
+        latency (float): Seconds to wait before answering.
+        jitter (float): Maximum random seconds added to the latency.
+        failure_rate (float): Fraction of requests answered with a 503.
+        firmware (bytes): The image the device runs, None to answer
+          firmware uploads without flashing them (older firmware).
+        upload_rate (float): Bytes per second the device receives uploads
+          at, 0 for no limit.
+        requests (dict): Number of requests received per path.
+        bytes_received (int): Request body bytes received.
+        address (str): "host:port" the device listens on, once started.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 host="127.0.0.1", port=0, firmware=None, upload_rate=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.firmware = firmware
+        self.upload_rate = upload_rate
+        self.host = host
+        self.port = port
+        self.requests = {}
+        self.bytes_received = 0
+        self.address = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._writers = set()
+
+    def start(self):
+        """
+        Start serving in a background thread.
+
+        Returns:
+            str: The "host:port" address to store as the user's M5Core2 IP.
+        """
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port,
+                                     backlog=1024)
+            )
+            port = self._server.sockets[0].getsockname()[1]
+            self.address = f"{self.host}:{port}"
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.address
+
+    def stop(self):
+        """Stop the server and its event loop."""
+        if self._loop is None:
+            return
+
+        async def shutdown():
+            self._server.close()
+            # Drop the keep-alive connections clients left open
+            for writer in list(self._writers):
+                writer.close()
+            await asyncio.gather(*(
+                task for task in asyncio.all_tasks()
+                if task is not asyncio.current_task()
+            ), return_exceptions=True)
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                content = b""
+                if length:
+                    content = await reader.readexactly(length)
+                    self.bytes_received += length
+                    if self.upload_rate:
+                        await asyncio.sleep(length / self.upload_rate)
+
+                url = urlsplit(target)
+                self.requests[url.path] = self.requests.get(url.path, 0) + 1
+                status, body = await self._respond(
+                    method, url.path, parse_qs(url.query), headers, content)
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}"
+                    f"\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, method, path, query, headers=None,
+                       content=b""):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            return "503 Service Unavailable", b'{"error": "busy"}'
+
+        if path == "/":
+            return "200 OK", b'{"status": "online"}'
+        if path == "/control_led":
+            return "200 OK", json.dumps({
+                "status": "ok",
+                "room": query.get("room", [""])[0],
+                "light": query.get("light", [""])[0],
+                "action": query.get("action", [""])[0],
+            }).encode()
+        if path == "/control_batch":
+            return "200 OK", json.dumps({
+                "status": "ok",
+                "count": len(query.get("action", [])),
+            }).encode()
+        if path == "/firmware_info" and self.firmware is not None:
+            return "200 OK", json.dumps({
+                "md5": hashlib.md5(self.firmware).hexdigest(),
+                "size": len(self.firmware),
+                "formats": ["hcd1"],
+            }).encode()
+        if path == "/django_update_firmware" and method == "POST":
+            if self.firmware is not None and not self._flash(headers,
+                                                             content):
+                return "500 Internal Server Error", b'{"error": "failed"}'
+            return "200 OK", b'{"status": "updated"}'
+        return "404 Not Found", b'{"error": "not found"}'
+
+    def _flash(self, headers, content):
+        """Flashes an uploaded image or patch, returns False on failure."""
+        from firmware_manager.delta import PatchMismatch, apply_patch
+
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {headers.get('content-type', '')}\r\n\r\n"
+            .encode() + content)
+        for part in message.iter_parts():
+            data = part.get_payload(decode=True)
+            if part.get_filename() == "firmware.bin":
+                self.firmware = data
+                return True
+            if part.get_filename() == "firmware.hcd":
+                try:
+                    self.firmware = apply_patch(data, self.firmware)
+                except PatchMismatch:
+                    return False
+                return True
+        return False
+
+
+def percentile(values, fraction):
+    """
+    Return the nearest-rank percentile of a list of values.
+
+    Args:
+        values (list): The observed values.
+        fraction (float): The percentile as a fraction, e.g. 0.99.
+
+    Returns:
+        float: The percentile, or 0 for an empty list.
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(name, latencies, queries, errors, elapsed):
+    """
+    Summarize one benchmark scenario.
+
+    Args:
+        name (str): The scenario name.
+        latencies (list[float]): Per-request latencies in seconds.
+        queries (list[int]): Per-request database query counts.
+        errors (int): Number of failed requests.
+        elapsed (float): Wall time of the whole scenario in seconds.
+
+    Returns:
+        dict: Request count, errors, throughput, p50/p99 latency in
+        milliseconds and the mean number of queries per request.
+    """
+    count = len(latencies)
+    return {
+        "scenario": name,
+        "requests": count,
+        "errors": errors,
+        "throughput": count / elapsed if elapsed else 0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "queries_per_request": sum(queries) / count if count else 0,
+    }
+
+
+def format_summary(result):
+    """Format a `summarize` result as one report line."""
+    return (
+        f"{result['scenario']:<20} {result['requests']:>7} req "
+        f"{result['errors']:>5} err {result['throughput']:>9.1f} req/s "
+        f"p50 {result['p50_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  "
+        f"{result['queries_per_request']:>6.1f} queries/req"
+    )
+
+
+def create_bench_db():
+    """
+    Create a throwaway test database for a benchmark run.
+
+    SQLite's shared in-memory test database locks whole tables under
+    concurrent clients, so a temporary file is used instead.
+
+    Returns:
+        str: The original database name, to pass to `destroy_test_db`.
+    """
+    test_settings = connection.settings_dict.setdefault("TEST", {})
+    if connection.vendor == "sqlite" and not test_settings.get("NAME"):
+        test_settings["NAME"] = os.path.join(tempfile.mkdtemp(),
+                                             "bench.sqlite3")
+    old_name = connection.creation.create_test_db(verbosity=0,
+                                                  autoclobber=True)
+    # Point the read replicas at the test database, as the test runner does
+    for alias in connections:
+        mirror = connections[alias].settings_dict.get("TEST", {}).get("MIRROR")
+        if mirror == connection.alias:
+            connections[alias].creation.set_as_test_mirror(
+                connection.settings_dict)
+    return old_name
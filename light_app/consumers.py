@@ -0,0 +1,111 @@
+import json
+import logging
+from urllib.parse import parse_qsl
+
+from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from .device_channel import (
+    device_group, socket_opened, socket_alive, socket_closed,
+)
+from .heartbeats import heartbeats, InvalidHeartbeat
+from .tracing import TracedConsumerMixin
+
+logger = logging.getLogger("home_control.devices")
+
+# Commands awaiting an acknowledgement kept per socket; the oldest are
+# forgotten beyond this (their senders have timed out by then)
+MAX_PENDING_COMMANDS = 256
+
+
+class DeviceConsumer(TracedConsumerMixin, AsyncWebsocketConsumer):
+    """
+    WebSocket a user's M5Core2 opens to /ws/device/ and keeps open, so
+    Django can send it commands without connecting to it (which also works
+    behind NAT).
+
+    The device authenticates with a signed heartbeat in the query string
+    (`?user=<id>&ts=<time>&sig=<signature>`, see `heartbeats.py`) and joins
+    its user's device group. Frames are JSON:
+
+    - Django to device: {"type": "command", "id": ..., "path":
+      "/control_led", "params": [[name, value], ...], "traceparent": ...},
+      the same endpoint, query parameters and trace header as over HTTP.
+    - Device to Django: {"type": "ack", "id": ..., "status": 200, "body":
+      {...}} once a command is applied, and {"type": "heartbeat"} every
+      check interval, which keeps the home online.
+    """
+
+    async def connect(self):
+        self.user_id = None
+        self.replies = {}
+        beat = dict(parse_qsl(self.scope["query_string"].decode()))
+        try:
+            self.user_id = await sync_to_async(heartbeats.authenticate)(
+                beat, "ws")
+        except InvalidHeartbeat:
+            await self.close()
+            return
+        await self.channel_layer.group_add(
+            device_group(self.user_id), self.channel_name)
+        await self.accept()
+        await socket_opened(self.user_id, heartbeats.deadline(self.user_id))
+
+    async def disconnect(self, close_code):
+        if self.user_id is None:
+            return
+        await self.channel_layer.group_discard(
+            device_group(self.user_id), self.channel_name)
+        await socket_closed(self.user_id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            frame = json.loads(text_data or bytes_data)
+        except (TypeError, ValueError):
+            frame = None
+        if not isinstance(frame, dict):
+            logger.warning("Ignoring a malformed frame from user %s's device",
+                           self.user_id, extra={"rate_key": self.user_id})
+            return
+
+        if frame.get("type") == "ack":
+            reply_to = self.replies.pop(frame.get("id"), None)
+            if reply_to is not None:
+                await self.channel_layer.send(reply_to, {
+                    "type": "device.ack",
+                    "id": frame["id"],
+                    "status": self.ack_status(frame),
+                    "body": frame.get("body"),
+                })
+        elif frame.get("type") == "heartbeat":
+            heartbeats.touch(self.user_id, "ws")
+            await socket_alive(self.user_id,
+                               heartbeats.deadline(self.user_id))
+
+    def ack_status(self, frame):
+        """
+        Returns the status of an acknowledgement, 200 (the command was
+        applied) if the device sent an invalid one, so its sender still
+        gets the reply.
+        """
+        status = frame.get("status", 200)
+        try:
+            return int(status)
+        except (TypeError, ValueError):
+            logger.warning("Invalid status %r in an ack from user %s's "
+                           "device", status, self.user_id,
+                           extra={"rate_key": self.user_id})
+            return 200
+
+    async def device_command(self, event):
+        """Forwards a command sent to the group to the device."""
+        self.replies[event["id"]] = event["reply_to"]
+        while len(self.replies) > MAX_PENDING_COMMANDS:
+            del self.replies[next(iter(self.replies))]
+        await self.send(text_data=json.dumps({
+            "type": "command",
+            "id": event["id"],
+            "path": event["path"],
+            "params": event["params"],
+            "traceparent": event.get("traceparent"),
+        }))
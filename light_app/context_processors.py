@@ -1,5 +1,8 @@
+import logging
+
 from light_app.models import UserSettings, User
-from home_control_project.settings import DEBUG, DATABASES
+
+logger = logging.getLogger("home_control.views")
 
 # Global dictionary to store the online status of each user
 # The keys are user IDs, and the values are booleans representing the
@@ -9,16 +12,13 @@ home_online_status = {1: False}  # Using boolean values True/False
 
 def debug(data):
     """
-    Prints the debug information if the DEBUG setting is True.
+    Logs debug information, shown when the "home_control.views" logger is
+    at DEBUG level (the default with the DEBUG setting, see LOG_LEVEL).
 
     Args:
-        data (str): The data to be printed for debugging purposes.
+        data (str): The data to be logged for debugging purposes.
     """
-    if DEBUG:
-        print(data)
-
-
-debug(DATABASES)
+    logger.debug(data)
 
 
 def global_variables(request):
@@ -38,18 +38,23 @@ def global_variables(request):
         for the authenticated user. If the user is not authenticated, default
         values are returned.
     """
-    global home_online_status  # Access the global online status dictionary
+    # Imported here: snapshots imports this module
+    from .snapshots import home_status
+
     user_settings = None
 
     if request.user.is_authenticated:
-        # Get or create user settings for the authenticated user
-        user_settings, created = UserSettings.objects.get_or_create(
-            user=request.user
-        )
+        # Reuse the settings loaded by UserSettingsMiddleware, or get or
+        # create them for the authenticated user
+        user_settings = getattr(request, "user_settings", None)
+        if user_settings is None:
+            user_settings, created = UserSettings.objects.get_or_create(
+                user=request.user
+            )
         user_id = request.user.id
 
-        # Get the current online status from the global dictionary for user
-        online_status = home_online_status.get(user_id, False)
+        # Get the online status published by the worker polling the home
+        online_status = bool(home_status(user_id))
 
         return {
             # Return the online status for the current user
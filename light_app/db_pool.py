@@ -0,0 +1,46 @@
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .metrics import registry, DB_CONNECTIONS
+
+
+def pool_stats():
+    """
+    Returns the utilization of the default database's connection pool, for
+    the `home_control_db_pool_connections` gauge.
+
+    Returns:
+        dict: Connections per state ("size", "idle", "in_use" and
+        "waiting" requests), empty when the database isn't pooled.
+    """
+    pool = getattr(connections["default"], "pool", None)
+    if pool is None:
+        return {}
+    stats = pool.get_stats()
+    size = stats.get("pool_size", 0)
+    idle = stats.get("pool_available", 0)
+    return {
+        ("size",): size,
+        ("idle",): idle,
+        ("in_use",): size - idle,
+        ("waiting",): stats.get("requests_waiting", 0),
+    }
+
+
+registry.gauge(
+    "home_control_db_pool_connections",
+    "Connections of the database pool, per state.",
+    ["state"],
+    function=pool_stats,
+)
+
+
+def count_connection(sender, connection, **kwargs):
+    """
+    Signal receiver counting the database connections opened, or borrowed
+    from the pool, to tell how well they are reused.
+    """
+    DB_CONNECTIONS.inc(alias=connection.alias)
+
+
+connection_created.connect(count_connection)
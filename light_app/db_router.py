@@ -0,0 +1,164 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+# Statements that change data; anything else (SELECT, SAVEPOINT, ...) is
+# left to the replicas
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+# Pin of the current request or task to the primary, see `Pin`
+_pin = ContextVar("db_pin", default=None)
+
+
+class Pin:
+    """
+    Read-your-writes state of a request or task: its reads go to the
+    primary until `until`, which every write it makes pushes forward.
+
+    Attributes:
+        until (float): Monotonic time until which reads use the primary.
+        wrote (bool): True once the request or task wrote something.
+    """
+
+    __slots__ = ("until", "wrote")
+
+    def __init__(self, until=0.0):
+        self.until = until
+        self.wrote = False
+
+
+def replicas():
+    """Returns the aliases of the read replicas, see `DATABASE_REPLICAS`."""
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+
+def sticky_seconds():
+    """Returns the seconds reads stay on the primary after a write."""
+    return getattr(settings, "REPLICA_STICKY_SECONDS", 10)
+
+
+def replica_alias():
+    """
+    Returns a database alias to read from when reading slightly stale data
+    is fine, regardless of the current pin.
+
+    Returns:
+        str: A random replica, or "default" without replicas.
+    """
+    aliases = replicas()
+    return random.choice(aliases) if aliases else "default"
+
+
+def pin_primary(seconds=None, wrote=False):
+    """
+    Sends the reads of the current request or task to the primary.
+
+    Args:
+        seconds (float, optional): For how long. Defaults to the
+          `REPLICA_STICKY_SECONDS` setting.
+        wrote (bool): Whether it is pinned because it wrote something.
+    """
+    until = monotonic() + (sticky_seconds() if seconds is None else seconds)
+    pin = _pin.get()
+    if pin is None:
+        pin = Pin()
+        _pin.set(pin)
+    pin.until = max(pin.until, until)
+    pin.wrote = pin.wrote or wrote
+
+
+def is_pinned():
+    """Tells whether the current request or task reads from the primary."""
+    pin = _pin.get()
+    return pin is not None and monotonic() < pin.until
+
+
+def start_pinning(seconds=0):
+    """
+    Gives the current request its own pin.
+
+    Args:
+        seconds (float): Seconds to read from the primary from the start,
+          e.g. when the client wrote something just before.
+
+    Returns:
+        tuple: The `Pin` and the token to pass to `stop_pinning`.
+    """
+    pin = Pin(monotonic() + seconds if seconds else 0.0)
+    return pin, _pin.set(pin)
+
+
+def stop_pinning(token):
+    """Drops the pin set by `start_pinning`."""
+    _pin.reset(token)
+
+
+@contextmanager
+def use_primary():
+    """Context manager sending the reads made within to the primary."""
+    token = _pin.set(Pin(float("inf")))
+    try:
+        yield
+    finally:
+        _pin.reset(token)
+
+
+def _track_writes(execute, sql, params, many, context):
+    """Database execute wrapper pinning the caller after each write."""
+    if sql.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+        pin_primary(wrote=True)
+    return execute(sql, params, many, context)
+
+
+def install_write_tracker(sender, connection, **kwargs):
+    """
+    Signal receiver installing the write tracker on new connections to the
+    primary, when there are replicas to route the reads to.
+    """
+    if (connection.alias == "default" and replicas()
+            and _track_writes not in connection.execute_wrappers):
+        connection.execute_wrappers.append(_track_writes)
+
+
+connection_created.connect(install_write_tracker)
+
+
+class ReplicaRouter:
+    """
+    Database router sending writes to the primary (`default`) and reads to
+    the read replicas listed in the `DATABASE_REPLICAS` setting.
+
+    Reads stay on the primary when they could observe replication lag:
+
+    - for `REPLICA_STICKY_SECONDS` after the current request or task wrote
+      something, and for a client's requests in that period (see
+      `ReplicaPinningMiddleware`), so users see their own changes, e.g. a
+      toggled light or saved settings;
+    - inside a transaction on the primary;
+    - within `use_primary()`.
+
+    Without replicas every query goes to `default`.
+    """
+
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if (not aliases or is_pinned()
+                or connections["default"].in_atomic_block):
+            return "default"
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema through replication
+        return db == "default"
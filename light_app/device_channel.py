@@ -0,0 +1,165 @@
+import asyncio
+import uuid
+from time import perf_counter
+
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+
+from .metrics import DEVICE_COMMAND_SECONDS
+from .profiling import record_external_time
+from .rate_limit import limiter
+from .tracing import device_span
+
+# Sockets opened by devices in this process, user_id -> count
+_sockets = {}
+# Identifies this process as the holder of a device's socket in the shared
+# presence key
+PROCESS_ID = uuid.uuid4().hex
+
+
+class DeviceNotResponding(Exception):
+    """Raised when a device doesn't acknowledge a command in time."""
+
+
+class DeviceReply:
+    """
+    Acknowledgement of a command sent over a device's WebSocket, with the
+    part of the `httpx.Response` interface the views use.
+
+    Attributes:
+        status_code (int): The HTTP-like status reported by the device.
+        body (object): The JSON body reported by the device.
+    """
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    @property
+    def is_success(self):
+        return 200 <= self.status_code < 300
+
+    def json(self):
+        return self.body
+
+
+def device_group(user_id):
+    """Returns the channel layer group of a user's connected devices."""
+    return f"device_{user_id}"
+
+
+def presence_key(user_id):
+    """Returns the shared cache key telling a user's device is connected."""
+    return f"device_socket:{user_id}"
+
+
+async def socket_opened(user_id, timeout):
+    """
+    Records that a device opened its WebSocket in this process.
+
+    Args:
+        user_id (int): The ID of the user owning the device.
+        timeout (float): Seconds the device counts as connected for the
+          other processes unless it pings again, see `socket_alive`.
+    """
+    _sockets[user_id] = _sockets.get(user_id, 0) + 1
+    await socket_alive(user_id, timeout)
+
+
+async def socket_alive(user_id, timeout):
+    """Extends the time a device counts as connected for other processes."""
+    await cache.aset(presence_key(user_id), PROCESS_ID, timeout)
+
+
+async def socket_closed(user_id):
+    """
+    Records that a device's WebSocket in this process was closed.
+
+    The shared presence is only dropped if this process holds it: a device
+    that already reconnected to another worker stays connected.
+    """
+    count = _sockets.get(user_id, 0) - 1
+    if count > 0:
+        _sockets[user_id] = count
+        return
+    _sockets.pop(user_id, None)
+    if await cache.aget(presence_key(user_id)) == PROCESS_ID:
+        await cache.adelete(presence_key(user_id))
+
+
+async def is_connected(user_id):
+    """
+    Tells whether a user's device has its WebSocket open, in any process.
+
+    Args:
+        user_id (int): The ID of the user owning the device.
+
+    Returns:
+        bool: True if commands can be sent with `send_command`.
+    """
+    if _sockets.get(user_id):
+        return True
+    return bool(await cache.aget(presence_key(user_id)))
+
+
+async def send_command(user_id, path, params, command=None, timeout=30):
+    """
+    Sends a command to a user's device over its open WebSocket and waits
+    for the acknowledgement: one frame each way, no connection setup.
+
+    The command is sent to the user's device group with a request ID and
+    a reply channel; the device's consumer relays the acknowledgement
+    carrying the same ID to that channel. The frame carries the trace of
+    the command, if traced.
+
+    Args:
+        user_id (int): The ID of the user owning the device.
+        path (str): The device endpoint, e.g. "/control_led".
+        params (dict or list): The query string parameters of the endpoint.
+        command (str, optional): Metric label. Defaults to the path.
+        timeout (float): Seconds to wait for the acknowledgement.
+
+    Returns:
+        DeviceReply: The device's acknowledgement.
+
+    Raises:
+        DeviceNotResponding: If the acknowledgement doesn't come in time.
+        DeviceBusy: If too many commands are already queued for the device.
+    """
+    address = f"ws:{user_id}"
+    with device_span("WS", address, path, command) as span:
+        delay = limiter.reserve(address, command or path)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                limiter.release(address)
+
+        layer = get_channel_layer()
+        reply_channel = await layer.new_channel()
+        request_id = uuid.uuid4().hex
+        if isinstance(params, dict):
+            params = list(params.items())
+        start = perf_counter()
+        try:
+            await layer.group_send(device_group(user_id), {
+                "type": "device.command",
+                "id": request_id,
+                "path": path,
+                "params": params,
+                "reply_to": reply_channel,
+                "traceparent": span.traceparent if span else None,
+            })
+            try:
+                reply = await asyncio.wait_for(
+                    layer.receive(reply_channel), timeout)
+            except asyncio.TimeoutError:
+                raise DeviceNotResponding(
+                    f"Device of user {user_id} didn't acknowledge {path}.")
+        finally:
+            elapsed = perf_counter() - start
+            DEVICE_COMMAND_SECONDS.observe(elapsed, command=command or path)
+            record_external_time(elapsed, f"WebSocket {path}")
+        if span is not None:
+            span.set("http.status_code", reply["status"])
+        return DeviceReply(reply["status"], reply.get("body"))
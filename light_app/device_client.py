@@ -0,0 +1,265 @@
+import asyncio
+import weakref
+from time import perf_counter
+
+import httpx
+import requests
+
+from . import device_channel
+from .metrics import DEVICE_COMMAND_SECONDS, DEVICE_PROBES_COALESCED
+from .profiling import record_external_time
+from .rate_limit import limiter
+from .single_flight import SingleFlight
+from .tracing import device_span, trace_headers
+
+# Default timeout (in seconds) for requests sent to an M5Core2 device
+DEVICE_TIMEOUT = 30
+
+# Async HTTP clients, one per event loop, so connections to the devices are
+# reused across requests served by the same loop
+_async_clients = weakref.WeakKeyDictionary()
+
+# Identical probes of a device in flight at the same time share one
+# request, whether sent by a thread (the poller) or a coroutine (a view)
+_probes = SingleFlight()
+
+# Probe parameters telling the device something without changing its
+# answer; probes differing only by them are identical
+ADVISORY_PARAMS = frozenset({"check_interval"})
+
+
+def device_url(address, path="/"):
+    """
+    Builds the URL of an endpoint on a user's M5Core2 device.
+
+    Args:
+        address (str): The device IP address, optionally with a port.
+        path (str): The endpoint path, e.g. "/control_led".
+
+    Returns:
+        str: The full HTTP URL.
+    """
+    return f"http://{address}{path}"
+
+
+def device_request(method, address, path="/", command=None, **kwargs):
+    """
+    Sends an HTTP request to a user's M5Core2 device.
+
+    All Django to device traffic goes through this function so its latency
+    is recorded in the `home_control_device_command_seconds` histogram,
+    it is paced by the per-device rate limiter, see `rate_limit.py`, and
+    it is traced, the device getting the trace in a `traceparent` header.
+
+    Waiting for a slot of the rate limiter would hold the calling thread
+    (a poller worker), so a request finding the device's bucket empty is
+    rejected with `DeviceBusy` rather than queued, unlike with
+    `adevice_request`.
+
+    Args:
+        method (str): The HTTP method, e.g. "GET".
+        address (str): The device IP address, optionally with a port.
+        path (str): The endpoint path. Defaults to "/".
+        command (str, optional): Metric label for the request. Defaults to
+          the path.
+        **kwargs: Extra arguments passed to `requests.request`.
+
+    Returns:
+        requests.Response: The device's response.
+
+    Raises:
+        requests.exceptions.RequestException: If the device can't be reached.
+        DeviceBusy: If the device can't take a command right now.
+    """
+    kwargs.setdefault("timeout", DEVICE_TIMEOUT)
+    with device_span(method, address, path, command) as span:
+        kwargs["headers"] = trace_headers(span, kwargs.get("headers"))
+        limiter.reserve(address, command or path, queue=False)
+        start = perf_counter()
+        try:
+            response = requests.request(method, device_url(address, path),
+                                        **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            DEVICE_COMMAND_SECONDS.observe(elapsed, command=command or path)
+            record_external_time(elapsed, f"{method} {address}{path}")
+        if span is not None:
+            span.set("http.status_code", response.status_code)
+        return response
+
+
+def async_client():
+    """
+    Returns the HTTP client shared by the coroutines of the running event
+    loop, creating it on first use.
+
+    Returns:
+        httpx.AsyncClient: The client bound to the running loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient()
+    return client
+
+
+async def adevice_request(method, address, path="/", command=None, **kwargs):
+    """
+    Async version of `device_request`, for async views and consumers.
+
+    Waiting for the device doesn't hold a worker thread, so slow devices
+    don't starve the other requests served by the event loop.
+
+    Args:
+        method (str): The HTTP method, e.g. "GET".
+        address (str): The device IP address, optionally with a port.
+        path (str): The endpoint path. Defaults to "/".
+        command (str, optional): Metric label for the request. Defaults to
+          the path.
+        **kwargs: Extra arguments passed to `httpx.AsyncClient.request`.
+
+    Returns:
+        httpx.Response: The device's response.
+
+    Raises:
+        httpx.HTTPError: If the device can't be reached.
+        DeviceBusy: If too many commands are already queued for the device.
+    """
+    kwargs.setdefault("timeout", DEVICE_TIMEOUT)
+    with device_span(method, address, path, command) as span:
+        kwargs["headers"] = trace_headers(span, kwargs.get("headers"))
+        delay = limiter.reserve(address, command or path)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                limiter.release(address)
+        start = perf_counter()
+        try:
+            response = await async_client().request(
+                method, device_url(address, path), **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            DEVICE_COMMAND_SECONDS.observe(elapsed, command=command or path)
+            record_external_time(elapsed, f"{method} {address}{path}")
+        if span is not None:
+            span.set("http.status_code", response.status_code)
+        return response
+
+
+async def adevice_command(user_id, address, path, params, command=None):
+    """
+    Sends a command to a user's device: as a frame over the WebSocket the
+    device keeps open if it has one (see `consumers.DeviceConsumer`), which
+    costs a single round trip and works behind NAT, otherwise as an HTTP
+    GET to its address.
+
+    Args:
+        user_id (int): The ID of the user owning the device.
+        address (str): The device IP address, used without a WebSocket.
+        path (str): The endpoint path, e.g. "/control_led".
+        params (dict or list): The query string parameters.
+        command (str, optional): Metric label for the request. Defaults to
+          the path.
+
+    Returns:
+        httpx.Response or DeviceReply: The device's response.
+
+    Raises:
+        httpx.HTTPError: If the device can't be reached over HTTP.
+        DeviceNotResponding: If the device doesn't acknowledge the command
+          sent over its WebSocket.
+        DeviceBusy: If too many commands are already queued for the device.
+    """
+    if await device_channel.is_connected(user_id):
+        return await device_channel.send_command(
+            user_id, path, params, command, DEVICE_TIMEOUT)
+    return await adevice_request("GET", address, path, command=command,
+                                 params=params)
+
+
+def probe_key(address, path, params):
+    """
+    Returns the key identifying identical probes of a device, i.e. those
+    getting the same answer: the advisory parameters are left out, so the
+    poller's probe (which tells the device its check interval) and a
+    view's liveness probe share one request.
+    """
+    return address, path, tuple(sorted(
+        (name, value) for name, value in (params or {}).items()
+        if name not in ADVISORY_PARAMS))
+
+
+def device_probe(address, path="/", params=None, command=None):
+    """
+    Sends a GET probe (liveness, status) to a device, sharing the response
+    of an identical probe already in flight instead of sending another.
+
+    However many threads and coroutines ask at once, a device receives at
+    most one probe per (path, params), see `probe_key`. Only idempotent
+    reads may go through this; commands changing the device state must use
+    `device_request`.
+
+    A probe shared from a coroutine returns an `httpx.Response`, which has
+    the same `status_code`, `text` and `json()` as a `requests.Response`;
+    its connection errors are raised as `requests` ones.
+
+    Args:
+        address (str): The device IP address, optionally with a port.
+        path (str): The endpoint path. Defaults to "/".
+        params (dict, optional): The query string parameters.
+        command (str, optional): Metric label for the request.
+
+    Returns:
+        requests.Response: The device's response, possibly shared.
+
+    Raises:
+        requests.exceptions.RequestException: If the device can't be reached.
+        DeviceBusy: If the device can't take a command right now.
+    """
+    try:
+        response, shared = _probes.do(
+            probe_key(address, path, params),
+            lambda: device_request("GET", address, path, command=command,
+                                   params=params),
+        )
+    except httpx.HTTPError as e:
+        raise requests.exceptions.ConnectionError(str(e)) from e
+    if shared:
+        DEVICE_PROBES_COALESCED.inc(command=command or path)
+    return response
+
+
+async def adevice_probe(address, path="/", params=None, command=None):
+    """
+    Async version of `device_probe`, sharing the probes in flight in any
+    thread or event loop without blocking this one.
+
+    A probe shared from a thread returns a `requests.Response`, which has
+    the same `status_code`, `text` and `json()` as an `httpx.Response`;
+    its connection errors are raised as `httpx` ones.
+
+    Args:
+        address (str): The device IP address, optionally with a port.
+        path (str): The endpoint path. Defaults to "/".
+        params (dict, optional): The query string parameters.
+        command (str, optional): Metric label for the request.
+
+    Returns:
+        httpx.Response: The device's response, possibly shared.
+
+    Raises:
+        httpx.HTTPError: If the device can't be reached.
+        DeviceBusy: If too many commands are already queued for the device.
+    """
+    try:
+        response, shared = await _probes.ado(
+            probe_key(address, path, params),
+            lambda: adevice_request("GET", address, path, command=command,
+                                    params=params),
+        )
+    except requests.exceptions.RequestException as e:
+        raise httpx.TransportError(str(e)) from e
+    if shared:
+        DEVICE_PROBES_COALESCED.inc(command=command or path)
+    return response
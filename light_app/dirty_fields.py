@@ -0,0 +1,128 @@
+from django.db import models
+
+from .metrics import MODEL_SAVES
+
+
+class DirtyFieldsMixin(models.Model):
+    """
+    Model mixin tracking which fields changed since the instance was loaded
+    or last saved, so saves only write those columns.
+
+    - Saving a loaded instance without `update_fields` turns into an
+      UPDATE of the changed fields, as if they had been passed as
+      `update_fields` (receivers of `post_save` see them).
+    - Saving a loaded instance with no changes does nothing: no query, no
+      row lock and no signals, so no cache is invalidated either.
+    - New instances, saves with `update_fields` or `force_insert`, and
+      instances whose primary key changed are saved as before.
+    - If the row was deleted since the instance was loaded, the UPDATE
+      affects no rows and the whole instance is inserted again, as it
+      would have been without the mixin (`post_save` still reports the
+      dirty fields, with `created=False`).
+
+    Values are compared with `==` to the ones loaded, which suits the
+    scalar fields of the models using it (not mutable JSON values).
+    """
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_values()
+        return instance
+
+    def _remember_values(self, fields=None):
+        """Records the loaded values of some fields, or of all of them."""
+        if not hasattr(self, "_loaded_values"):
+            self._loaded_values = {}
+        for field in self._meta.concrete_fields:
+            if fields is not None and field.attname not in fields:
+                continue
+            if field.attname in self.__dict__:
+                self._loaded_values[field.attname] = (
+                    self.__dict__[field.attname])
+
+    def get_dirty_fields(self):
+        """
+        Returns the fields changed since the instance was loaded or saved.
+
+        Returns:
+            list or None: The names of the changed fields, None if the
+            whole instance must be saved (it is new or its key changed).
+        """
+        loaded = getattr(self, "_loaded_values", None)
+        if self._state.adding or loaded is None:
+            return None
+        pk = self._meta.pk
+        if loaded.get(pk.attname) != self.pk:
+            return None
+        return [
+            field.name
+            for field in self._meta.concrete_fields
+            if not field.primary_key
+            and field.attname in self.__dict__
+            and (field.attname not in loaded
+                 or loaded[field.attname] != self.__dict__[field.attname])
+        ]
+
+    def is_dirty(self):
+        """Tells whether saving the instance would write anything."""
+        return self.get_dirty_fields() != []
+
+    def save(self, *args, **kwargs):
+        narrowed = False
+        if (kwargs.get("update_fields") is None and not args
+                and not kwargs.get("force_insert")):
+            dirty = self.get_dirty_fields()
+            if dirty == []:
+                MODEL_SAVES.inc(model=self._meta.model_name,
+                                result="skipped")
+                return
+            if dirty is not None:
+                kwargs["update_fields"] = dirty
+                narrowed = True
+                MODEL_SAVES.inc(model=self._meta.model_name,
+                                result="partial")
+            else:
+                MODEL_SAVES.inc(model=self._meta.model_name, result="full")
+        self._narrowed_save = narrowed
+        try:
+            super().save(*args, **kwargs)
+        finally:
+            self._narrowed_save = False
+        update_fields = kwargs.get("update_fields")
+        self._remember_values(
+            None if update_fields is None else {
+                self._meta.get_field(name).attname for name in update_fields
+            })
+
+    save.alters_data = True
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields,
+                   forced_update):
+        """
+        Runs the UPDATE of a save; when one narrowed to the dirty fields
+        matches no row, inserts the whole row instead, as a full save
+        would have.
+
+        Django would otherwise raise "Save with update_fields did not affect
+        any rows.", which also marks the enclosing transaction for
+        rollback.
+        """
+        updated = super()._do_update(base_qs, using, pk_val, values,
+                                     update_fields, forced_update)
+        if updated or not getattr(self, "_narrowed_save", False):
+            return updated
+        fields = [field for field in self._meta.local_concrete_fields
+                  if not field.generated]
+        self._do_insert(type(self)._base_manager, using, fields, (), False)
+        return True
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using, fields, from_queryset)
+        self._remember_values(
+            None if fields is None else {
+                self._meta.get_field(name).attname for name in fields
+            })
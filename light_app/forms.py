@@ -101,7 +101,7 @@ class UserSettingsForm(forms.ModelForm):
             "theme", "font_size", "primary_color",
             "email_notifications", "push_notifications",
             "two_factor_authentication", "scheduled_lights", "silence_mode",
-            "test_mode", "m5core2_ip", "server_check_interval"
+            "test_mode", "m5core2_ip", "server_check_interval", "always_poll"
         ]
         widgets = {
             # Text input for display name.
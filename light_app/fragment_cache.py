@@ -0,0 +1,158 @@
+import hashlib
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.paginator import Paginator
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+
+from .models import Room
+from .snapshots import home_status
+from .tiered_cache import tiered_cache
+
+# Rooms shown on each page of the room list
+ROOMS_PER_PAGE = 3
+
+# Stands in for the CSRF token in cached fragments; the token is per
+# session, so it is substituted on every response
+CSRF_PLACEHOLDER = "__csrf_token__"
+
+
+def room_list_namespace(user_id):
+    """Returns the cache namespace of a user's room list pages."""
+    return f"room_list:{user_id}"
+
+
+def room_list_version(user_id):
+    """
+    Returns the version of a user's room list, i.e. the time of its last
+    change, starting a new one if the cache has none.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        float: The version, a UNIX timestamp.
+    """
+    return tiered_cache.version(room_list_namespace(user_id))
+
+
+def bump_room_list_version(user_id):
+    """
+    Invalidates the cached room list pages of a user.
+
+    Called by the signal receivers whenever a room, a light or the user's
+    settings change; code bypassing the signals (bulk operations) must
+    call it itself.
+
+    Args:
+        user_id (int): The ID of the user.
+    """
+    tiered_cache.bump(room_list_namespace(user_id))
+
+
+def fragment_timeout():
+    """Returns the lifetime of the cached room list fragments."""
+    return getattr(settings, "FRAGMENT_CACHE_TIMEOUT", 3600)
+
+
+def page_key(request):
+    """
+    Returns the number of the room list page shown for a request, as used
+    in cache keys.
+
+    The "page" parameter is resolved as `Paginator.get_page` does (the
+    first page if it isn't a number, the last one if out of range), so
+    arbitrary values map to the existing pages instead of each adding a
+    cache entry. The number of rooms is cached with the pages.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        str: The page number.
+    """
+    user_id = request.user.id
+    count = tiered_cache.get_or_set(
+        room_list_namespace(user_id), "count",
+        lambda: Room.objects.filter(user_id=user_id).count(),
+        fragment_timeout())
+    page = Paginator(range(count), ROOMS_PER_PAGE).get_page(
+        request.GET.get("page"))
+    return str(page.number)
+
+
+def room_list_etag(request, *args, **kwargs):
+    """
+    Computes the ETag of a room list page.
+
+    It covers everything the page depends on: the room list version, the
+    page number, the CSRF cookie embedded in the forms and the home status
+    badge. No ETag is returned while flash messages are pending, so they
+    are always rendered.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        str or None: The ETag, or None to skip conditional handling.
+    """
+    if len(get_messages(request)):
+        return None
+    user_id = request.user.id
+    parts = [
+        user_id,
+        room_list_version(user_id),
+        page_key(request),
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ""),
+        bool(home_status(user_id)),
+    ]
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def room_list_last_modified(request, *args, **kwargs):
+    """
+    Returns the time of the last change of the user's room list.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        datetime or None: The last modification time, or None to skip
+        conditional handling.
+    """
+    if len(get_messages(request)):
+        return None
+    return datetime.fromtimestamp(room_list_version(request.user.id),
+                                  tz=timezone.utc)
+
+
+def render_room_cards(request):
+    """
+    Renders the room cards and pagination of a room list page, reusing the
+    cached fragment of the current room list version when there is one.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        str: The HTML fragment.
+    """
+    user = request.user
+    number = page_key(request)
+
+    def render_cards():
+        rooms = Room.objects.filter(user=user).prefetch_related("lights")
+        page_obj = Paginator(rooms, ROOMS_PER_PAGE).get_page(number)
+        return render_to_string("light_app/room_cards.html", {
+            "user": user,
+            "csrf_token": CSRF_PLACEHOLDER,
+            "page_obj": page_obj,
+            "is_paginated": page_obj.has_other_pages(),
+        })
+
+    html = tiered_cache.get_or_set(
+        room_list_namespace(user.id), number, render_cards,
+        fragment_timeout())
+    return html.replace(CSRF_PLACEHOLDER, get_token(request))
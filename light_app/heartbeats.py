@@ -0,0 +1,480 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from .metrics import HEARTBEATS_RECEIVED
+from .models import UserSettings
+
+logger = logging.getLogger("home_control.heartbeats")
+
+# Most heartbeats accepted in one HTTP request or UDP datagram
+MAX_BATCH = 1000
+
+
+class InvalidHeartbeat(ValueError):
+    """Raised for a malformed, forged, stale or replayed heartbeat."""
+
+
+def sign_heartbeat(key, user_id, timestamp):
+    """
+    Computes the signature of a heartbeat.
+
+    Args:
+        key (str): The user's API password, shared with the device.
+        user_id (int): The ID of the user owning the device.
+        timestamp (int): The UNIX time of the beat.
+
+    Returns:
+        str: The hex HMAC-SHA256 of "<user_id>:<timestamp>".
+    """
+    message = f"{user_id}:{timestamp}".encode()
+    return hmac.new(key.encode(), message, hashlib.sha256).hexdigest()
+
+
+def heartbeat_payload(key, user_id, timestamp=None):
+    """
+    Builds a signed heartbeat, as sent by a device.
+
+    Args:
+        key (str): The user's API password.
+        user_id (int): The ID of the user owning the device.
+        timestamp (int, optional): Defaults to now.
+
+    Returns:
+        dict: The "user", "ts" and "sig" of the beat.
+    """
+    if timestamp is None:
+        timestamp = int(time.time())
+    return {"user": user_id, "ts": timestamp,
+            "sig": sign_heartbeat(key, user_id, timestamp)}
+
+
+def last_seen_key(user_id):
+    """Returns the shared cache key of a home's last heartbeat time."""
+    return f"heartbeat:{user_id}"
+
+
+def signed_key(user_id, timestamp=None):
+    """
+    Returns the shared cache key of the time of a user's last accepted
+    beat, or the key claiming one beat of the user.
+    """
+    if timestamp is None:
+        return f"heartbeat:sig:{user_id}"
+    return f"heartbeat:sig:{user_id}:{timestamp}"
+
+
+class HeartbeatStore:
+    """
+    Ingests the heartbeats pushed by devices and derives the online status
+    of their homes: a home is online while its last beat is at most
+    `missed_beats` check intervals old.
+
+    A beat is signed with the user's API password and carries its time,
+    which must be recent and newer than the previous beat, so beats can't
+    be forged or replayed, to this process or another one: each accepted
+    beat is claimed with an atomic `add` in the shared cache, and the time
+    of the last one is kept there too. Accepting a batch of beats is a
+    signature check per beat and a few cache round trips, without any
+    query; a flusher thread applies the pending beats
+    every `flush_interval` seconds in a batch: one `set_many` of the last
+    seen times in the shared cache (so every worker sees them) and the
+    resulting status changes, published through the home status tracker.
+    The same thread marks offline the homes whose beats stopped.
+
+    The signing keys and check intervals are loaded with one query and
+    kept in sync by the `UserSettings` signal receivers, and reloaded every
+    `reload_interval` seconds for the changes made by other processes.
+
+    Attributes:
+        flush_interval (float): Seconds between two flushes.
+        missed_beats (float): Check intervals without a beat before a home
+          is marked offline.
+        max_skew (int): Seconds a beat's time may differ from ours.
+        reload_interval (float): Seconds between two reloads of the keys.
+    """
+
+    def __init__(self, flush_interval=None, missed_beats=None, max_skew=None,
+                 reload_interval=60):
+        self.flush_interval = flush_interval or getattr(
+            settings, "HEARTBEAT_FLUSH_INTERVAL", 1.0)
+        self.missed_beats = missed_beats or getattr(
+            settings, "HEARTBEAT_MISSED_BEATS", 2)
+        self.max_skew = max_skew or getattr(
+            settings, "HEARTBEAT_MAX_SKEW", 60)
+        self.reload_interval = reload_interval
+        # user_id -> (signing key, check interval)
+        self._keys = {}
+        self._loaded_at = None
+        # Beats accepted since the last flush, user_id -> time
+        self._pending = {}
+        # Last beat of the homes this process saw, user_id -> time
+        self._last_seen = {}
+        # Time of the last signed beat of each user seen by this process,
+        # rejecting its replays without a cache round trip
+        self._signed = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def tracker(self):
+        """The home status tracker the statuses are published through."""
+        from .home_status import tracker
+        return tracker
+
+    def load(self):
+        """(Re)load the signing keys with one query."""
+        keys = {
+            user_id: (key, interval)
+            for user_id, key, interval in UserSettings.objects.exclude(
+                api_password="").values_list(
+                    "user_id", "api_password", "server_check_interval")
+        }
+        with self._lock:
+            self._keys = keys
+            self._loaded_at = time.monotonic()
+
+    def update(self, user_settings):
+        """
+        Refresh the key of one user after a settings change.
+
+        Args:
+            user_settings (UserSettings): The saved settings instance.
+        """
+        with self._lock:
+            if self._loaded_at is None:
+                # The initial load will pick the change up
+                return
+            if user_settings.api_password:
+                self._keys[user_settings.user_id] = (
+                    user_settings.api_password,
+                    user_settings.server_check_interval,
+                )
+            else:
+                self._keys.pop(user_settings.user_id, None)
+
+    def remove(self, user_id):
+        """
+        Forget a user.
+
+        Args:
+            user_id (int): The ID of the user to remove.
+        """
+        with self._lock:
+            self._keys.pop(user_id, None)
+            self._last_seen.pop(user_id, None)
+            self._signed.pop(user_id, None)
+
+    def has_key(self, user_id):
+        """Tells whether a user's device can send heartbeats."""
+        if self._loaded_at is None:
+            self.load()
+        return user_id in self._keys
+
+    def verify(self, beat, now):
+        """
+        Checks a heartbeat and records its time against replays to this
+        process; `claim` then rules out those to other processes. Must be
+        called with the lock held.
+
+        Args:
+            beat (dict): The "user", "ts" and "sig" of the beat.
+            now (float): The current UNIX time.
+
+        Returns:
+            tuple: The user ID and the time of the beat.
+
+        Raises:
+            InvalidHeartbeat: If the beat is malformed, wrongly signed, too
+              old or not newer than the previous one.
+        """
+        try:
+            user_id = int(beat["user"])
+            timestamp = int(beat["ts"])
+            signature = str(beat["sig"])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidHeartbeat("Malformed heartbeat.")
+        key = self._keys.get(user_id)
+        if key is None or not hmac.compare_digest(
+                sign_heartbeat(key[0], user_id, timestamp), signature):
+            raise InvalidHeartbeat("Invalid signature.")
+        if abs(now - timestamp) > self.max_skew:
+            raise InvalidHeartbeat("Stale heartbeat.")
+        if timestamp <= self._signed.get(user_id, 0):
+            raise InvalidHeartbeat("Replayed heartbeat.")
+        self._signed[user_id] = timestamp
+        return user_id, timestamp
+
+    def claim(self, beats):
+        """
+        Claims verified beats in the shared cache, so a beat replayed to
+        several processes is only accepted once, and one older than the
+        last beat accepted anywhere is rejected.
+
+        The claim of each beat is an atomic `add`; the time of the last
+        accepted beat is a lower bound read and written with one
+        round trip each for the whole batch.
+
+        Args:
+            beats (list[tuple]): The user IDs and times of the beats, as
+              returned by `verify`.
+
+        Returns:
+            list[tuple]: The beats claimed by this process.
+        """
+        if not beats:
+            return []
+        timeout = 2 * self.max_skew
+        floors = cache.get_many(
+            {signed_key(user_id) for user_id, _ in beats})
+        claimed, last = [], {}
+        for user_id, timestamp in beats:
+            if timestamp <= floors.get(signed_key(user_id), 0):
+                continue
+            if not cache.add(signed_key(user_id, timestamp), 1, timeout):
+                continue
+            claimed.append((user_id, timestamp))
+            last[signed_key(user_id)] = max(
+                timestamp, last.get(signed_key(user_id), 0))
+        if last:
+            cache.set_many(last, timeout)
+        return claimed
+
+    def receive(self, beats, transport):
+        """
+        Accepts a batch of heartbeats; they are applied by the next flush.
+
+        Args:
+            beats (list[dict]): The beats.
+            transport (str): Metric label, "http" or "udp".
+
+        Returns:
+            tuple: The numbers of accepted and rejected beats.
+        """
+        if self._loaded_at is None:
+            self.load()
+        now = time.time()
+        verified = []
+        with self._lock:
+            for beat in beats[:MAX_BATCH]:
+                try:
+                    verified.append(self.verify(beat, now))
+                except InvalidHeartbeat:
+                    continue
+        claimed = self.claim(verified)
+        with self._lock:
+            for user_id, timestamp in claimed:
+                self._pending[user_id] = max(
+                    timestamp, self._pending.get(user_id, 0))
+        accepted = len(claimed)
+        rejected = len(beats) - accepted
+        if accepted:
+            HEARTBEATS_RECEIVED.inc(accepted, transport=transport,
+                                    result="accepted")
+            self.start()
+        if rejected:
+            HEARTBEATS_RECEIVED.inc(rejected, transport=transport,
+                                    result="rejected")
+        return accepted, rejected
+
+    def authenticate(self, beat, transport):
+        """
+        Checks and accepts a single heartbeat, e.g. the one a device sends
+        to open its WebSocket, see `consumers.DeviceConsumer`.
+
+        Args:
+            beat (dict): The "user", "ts" and "sig" of the beat.
+            transport (str): Metric label.
+
+        Returns:
+            int: The ID of the user owning the device.
+
+        Raises:
+            InvalidHeartbeat: If the beat is invalid.
+        """
+        if self._loaded_at is None:
+            self.load()
+        try:
+            with self._lock:
+                user_id, timestamp = self.verify(beat, time.time())
+            if not self.claim([(user_id, timestamp)]):
+                raise InvalidHeartbeat("Replayed heartbeat.")
+            with self._lock:
+                self._pending[user_id] = max(
+                    timestamp, self._pending.get(user_id, 0))
+        except InvalidHeartbeat:
+            HEARTBEATS_RECEIVED.inc(transport=transport, result="rejected")
+            raise
+        HEARTBEATS_RECEIVED.inc(transport=transport, result="accepted")
+        self.start()
+        return user_id
+
+    def touch(self, user_id, transport):
+        """
+        Records a beat of an already authenticated device, e.g. a ping on
+        its open WebSocket.
+
+        Args:
+            user_id (int): The ID of the user owning the device.
+            transport (str): Metric label.
+        """
+        with self._lock:
+            self._pending[user_id] = time.time()
+        HEARTBEATS_RECEIVED.inc(transport=transport, result="accepted")
+        self.start()
+
+    def deadline(self, user_id):
+        """Seconds without a beat after which a home is offline."""
+        interval = self._keys.get(user_id, (None, 7200))[1]
+        return interval * self.missed_beats + self.flush_interval
+
+    def flush(self):
+        """Applies the pending beats, then expires the silent homes."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_seen.update(pending)
+        if pending:
+            cache.set_many(
+                {last_seen_key(user_id): timestamp
+                 for user_id, timestamp in pending.items()},
+                max(self.deadline(user_id) for user_id in pending),
+            )
+            for user_id in pending:
+                self.tracker.publish(user_id, True)
+        self.expire()
+
+    def expire(self):
+        """
+        Marks offline the homes whose last beat is too old, unless another
+        process received a newer one.
+        """
+        now = time.time()
+        with self._lock:
+            silent = [user_id for user_id, timestamp in self._last_seen.items()
+                      if now - timestamp > self.deadline(user_id)]
+        if not silent:
+            return
+        shared = cache.get_many([last_seen_key(user_id) for user_id in silent])
+        for user_id in silent:
+            timestamp = shared.get(last_seen_key(user_id), 0)
+            with self._lock:
+                if now - timestamp <= self.deadline(user_id):
+                    self._last_seen[user_id] = timestamp
+                    continue
+                self._last_seen.pop(user_id, None)
+            self.tracker.publish(user_id, False)
+
+    def fresh_users(self, user_ids):
+        """
+        Returns the users whose home sent a heartbeat recently enough, to
+        any process, in one cache round trip.
+
+        Args:
+            user_ids (iterable): The IDs of the users to check.
+
+        Returns:
+            set: The IDs of the users whose home is alive.
+        """
+        candidates = [user_id for user_id in user_ids
+                      if self.has_key(user_id)]
+        if not candidates:
+            return set()
+        now = time.time()
+        shared = cache.get_many(
+            [last_seen_key(user_id) for user_id in candidates])
+        return {
+            user_id for user_id in candidates
+            if now - shared.get(last_seen_key(user_id), 0)
+            <= self.deadline(user_id)
+        }
+
+    def start(self):
+        """Starts the flusher thread, if not running."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the flusher thread after a last flush."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            stopping = self._stop.wait(self.flush_interval)
+            try:
+                if (time.monotonic() - self._loaded_at
+                        > self.reload_interval):
+                    close_old_connections()
+                    try:
+                        self.load()
+                    finally:
+                        close_old_connections()
+                self.flush()
+            except Exception as e:
+                # Keep the flusher alive on cache or database errors
+                logger.error(f"Heartbeat flush failed: {e}")
+            if stopping:
+                return
+
+
+class HeartbeatProtocol(asyncio.DatagramProtocol):
+    """
+    Asyncio UDP listener feeding the heartbeats it receives to a store.
+
+    Each datagram holds one heartbeat, or a list of them, as JSON. They
+    are accepted in a worker thread, since claiming them is a round trip
+    to the shared cache.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def datagram_received(self, data, addr):
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            HEARTBEATS_RECEIVED.inc(transport="udp", result="rejected")
+            return
+        asyncio.get_running_loop().run_in_executor(
+            None, self.store.receive,
+            payload if isinstance(payload, list) else [payload], "udp")
+
+
+async def serve_udp(host, port, store=None):
+    """
+    Starts listening for heartbeat datagrams in the running event loop.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The UDP port.
+        store (HeartbeatStore, optional): Defaults to the shared store.
+
+    Returns:
+        asyncio.DatagramTransport: The listening transport, to close.
+    """
+    store = store or heartbeats
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: HeartbeatProtocol(store), local_addr=(host, port))
+    return transport
+
+
+# Shared store of the process
+heartbeats = HeartbeatStore()
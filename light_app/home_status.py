@@ -0,0 +1,135 @@
+import threading
+
+from django.conf import settings
+
+from .context_processors import home_online_status
+from .signals import home_status_changed
+
+
+class HomeStatusTracker:
+    """
+    Applies hysteresis to the raw results of home device probes.
+
+    A single dropped probe no longer flips a home offline: the tracker only
+    changes the published status in `home_online_status` after
+    `offline_after` consecutive failed probes, and brings it back online
+    after `online_after` consecutive successful probes. Every published
+    change is emitted through the `home_status_changed` signal.
+
+    Attributes:
+        offline_after (int): Consecutive failures needed to go offline.
+        online_after (int): Consecutive successes needed to go online.
+        statuses (dict): The published status of each user's home.
+    """
+
+    def __init__(self, offline_after=None, online_after=None, statuses=None):
+        """
+        Initialize the tracker.
+
+        Args:
+            offline_after (int, optional): Defaults to the
+              `HOME_STATUS_OFFLINE_THRESHOLD` setting.
+            online_after (int, optional): Defaults to the
+              `HOME_STATUS_ONLINE_THRESHOLD` setting.
+            statuses (dict, optional): Dictionary the published statuses are
+              written to. Defaults to the global `home_online_status`.
+        """
+        if offline_after is None:
+            offline_after = getattr(settings, "HOME_STATUS_OFFLINE_THRESHOLD",
+                                    3)
+        if online_after is None:
+            online_after = getattr(settings, "HOME_STATUS_ONLINE_THRESHOLD", 2)
+
+        self.offline_after = max(1, int(offline_after))
+        self.online_after = max(1, int(online_after))
+        self.statuses = home_online_status if statuses is None else statuses
+        # user_id -> (result of the last probe, length of the current streak)
+        self._streaks = {}
+        self._lock = threading.Lock()
+
+    def record(self, user_id, reachable):
+        """
+        Record the result of one probe of a user's home device.
+
+        The first probe of a home whose status is unknown is published
+        immediately. After that the status only changes once the streak of
+        identical results reaches the matching threshold.
+
+        Args:
+            user_id (int): The ID of the user owning the device.
+            reachable (bool): Whether the probe succeeded.
+
+        Returns:
+            bool: True if the published status changed, False otherwise.
+        """
+        reachable = bool(reachable)
+
+        with self._lock:
+            last_result, streak = self._streaks.get(user_id, (None, 0))
+            streak = streak + 1 if last_result == reachable else 1
+            self._streaks[user_id] = (reachable, streak)
+
+            previous = self.statuses.get(user_id)
+            if previous == reachable:
+                return False
+
+            threshold = self.online_after if reachable else self.offline_after
+            if previous is not None and streak < threshold:
+                return False
+
+            self.statuses[user_id] = reachable
+
+        # Emit outside the lock so receivers may query the tracker
+        home_status_changed.send(
+            sender=self.__class__,
+            user_id=user_id,
+            online=reachable,
+            previous=previous,
+        )
+        return True
+
+    def publish(self, user_id, online):
+        """
+        Publish a status directly, without hysteresis, e.g. one derived
+        from the device's heartbeats rather than from probes.
+
+        Args:
+            user_id (int): The ID of the user owning the device.
+            online (bool): The new status.
+
+        Returns:
+            bool: True if the published status changed, False otherwise.
+        """
+        online = bool(online)
+
+        with self._lock:
+            previous = self.statuses.get(user_id)
+            if previous == online:
+                return False
+            self.statuses[user_id] = online
+
+        home_status_changed.send(
+            sender=self.__class__,
+            user_id=user_id,
+            online=online,
+            previous=previous,
+        )
+        return True
+
+    def last_probe(self, user_id):
+        """
+        Return the result of the most recent probe for a user.
+
+        Args:
+            user_id (int): The ID of the user owning the device.
+
+        Returns:
+            bool or None: The last raw probe result, or None if the device
+            has not been probed yet.
+        """
+        with self._lock:
+            return self._streaks.get(user_id, (None, 0))[0]
+
+
+# Shared tracker used by the background poller
+tracker = HomeStatusTracker()
@@ -0,0 +1,407 @@
+import csv
+import io
+import json
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+
+from .fragment_cache import bump_room_list_version
+from .light_events import light_events
+from .models import Room, Light, STATE_CHOICES
+from .room_api import room_page, STREAM_BATCH_SIZE
+from .snapshots import invalidate_lights_snapshot
+
+# Columns of the CSV house description, one light per row; a room without
+# lights is a row with an empty "light"
+CSV_COLUMNS = ["room", "light", "description", "state"]
+
+STATE_VALUES = {name: value for value, name in STATE_CHOICES}
+STATE_NAMES = dict(STATE_CHOICES)
+
+# Longest room or light name, see the models
+MAX_NAME_LENGTH = 100
+
+# Fields of the exported rooms and lights
+EXPORT_ROOM_FIELDS = ("name", "lights")
+EXPORT_LIGHT_FIELDS = ("name", "description", "state")
+
+
+class InvalidHouse(ValueError):
+    """Raised for a malformed house description."""
+
+
+def parse_state(value, where):
+    """
+    Parses a light state given by name ("on") or value ("1").
+
+    Args:
+        value (str or int or None): The state, empty for "off".
+        where (str): Position of the value, for error messages.
+
+    Returns:
+        int: The state value.
+
+    Raises:
+        InvalidHouse: If the state is unknown.
+    """
+    if value in (None, ""):
+        return STATE_VALUES["off"]
+    if str(value).lower() in STATE_VALUES:
+        return STATE_VALUES[str(value).lower()]
+    if str(value).isdigit() and int(value) in STATE_NAMES:
+        return int(value)
+    raise InvalidHouse(
+        f"{where}: unknown state {value!r}, use one of "
+        f"{', '.join(STATE_VALUES)}.")
+
+
+def check_name(name, kind, where):
+    """
+    Validates and strips a room or light name.
+
+    Args:
+        name (str): The name.
+        kind (str): "room" or "light", for error messages.
+        where (str): Position of the name, for error messages.
+
+    Returns:
+        str: The stripped name.
+
+    Raises:
+        InvalidHouse: If the name is missing or too long.
+    """
+    if name is None:
+        name = ""
+    if not isinstance(name, str):
+        raise InvalidHouse(f"{where}: the {kind} name must be a string.")
+    name = name.strip()
+    if not name:
+        raise InvalidHouse(f"{where}: missing {kind} name.")
+    if len(name) > MAX_NAME_LENGTH:
+        raise InvalidHouse(
+            f"{where}: {kind} name longer than {MAX_NAME_LENGTH} characters.")
+    return name
+
+
+def add_light(house, room, light):
+    """Adds a room, and a parsed light unless None, to a house."""
+    lights = house.setdefault(room, {})
+    if light is not None:
+        lights[light["name"]] = light
+
+
+def parse_csv(text):
+    """
+    Parses a CSV house description.
+
+    Args:
+        text (str): The CSV document, with a header row.
+
+    Returns:
+        dict: The lights of each room, by room and light name.
+
+    Raises:
+        InvalidHouse: If a row is malformed.
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    missing = {"room", "light"} - set(reader.fieldnames or ())
+    if missing:
+        raise InvalidHouse(
+            f"Missing CSV columns: {', '.join(sorted(missing))}.")
+    house = {}
+    for line, row in enumerate(reader, start=2):
+        where = f"Line {line}"
+        room = check_name(row["room"], "room", where)
+        light = None
+        if (row.get("light") or "").strip():
+            light = {
+                "name": check_name(row["light"], "light", where),
+                "description": row.get("description") or "",
+                "state": parse_state(row.get("state"), where),
+            }
+        add_light(house, room, light)
+    return house
+
+
+def parse_json(text):
+    """
+    Parses a JSON house description: a list of rooms, each with a "room"
+    name and a "lights" list of {"name", "description", "state"} objects.
+
+    Args:
+        text (str): The JSON document.
+
+    Returns:
+        dict: The lights of each room, by room and light name.
+
+    Raises:
+        InvalidHouse: If the document is malformed.
+    """
+    try:
+        rooms = json.loads(text)
+    except ValueError as e:
+        raise InvalidHouse(f"Invalid JSON: {e}") from e
+    if not isinstance(rooms, list):
+        raise InvalidHouse("The JSON document must be a list of rooms.")
+    house = {}
+    for index, entry in enumerate(rooms):
+        where = f"Room #{index + 1}"
+        if not isinstance(entry, dict):
+            raise InvalidHouse(f"{where}: must be an object.")
+        room = check_name(entry.get("room"), "room", where)
+        lights = entry.get("lights") or []
+        if not isinstance(lights, list):
+            raise InvalidHouse(f"{where}: \"lights\" must be a list.")
+        add_light(house, room, None)
+        for light_index, light in enumerate(lights):
+            light_where = f"{where}, light #{light_index + 1}"
+            if not isinstance(light, dict):
+                raise InvalidHouse(f"{light_where}: must be an object.")
+            add_light(house, room, {
+                "name": check_name(light.get("name"), "light", light_where),
+                "description": str(light.get("description") or ""),
+                "state": parse_state(light.get("state"), light_where),
+            })
+    return house
+
+
+def parse_house(text, house_format):
+    """
+    Parses a house description.
+
+    Args:
+        text (str): The document.
+        house_format (str): "csv" or "json".
+
+    Returns:
+        dict: The lights of each room, by room and light name.
+
+    Raises:
+        InvalidHouse: If the format is unknown or the document malformed.
+    """
+    if house_format == "csv":
+        return parse_csv(text)
+    if house_format == "json":
+        return parse_json(text)
+    raise InvalidHouse(f"Unknown format {house_format!r}, use csv or json.")
+
+
+def import_house(user, house):
+    """
+    Creates the rooms and lights of a house description for a user, in one
+    transaction and a handful of queries whatever its size.
+
+    Existing rooms (same name, thanks to the (name, user) unique
+    constraint) are reused; existing lights (same room and name) get the
+    description and state of the import. Running the same import twice
+    changes nothing.
+
+    The bulk operations don't send model signals, so the caches are
+    invalidated and the states set logged (see `light_events`) here.
+
+    Args:
+        user (User): The owner of the house.
+        house (dict): The parsed description, see `parse_house`.
+
+    Returns:
+        dict: The numbers of rooms and lights created and updated.
+    """
+    with transaction.atomic():
+        existing_rooms = set(Room.objects.filter(
+            user=user, name__in=list(house)).values_list("name", flat=True))
+        Room.objects.bulk_create(
+            [Room(name=name, user=user) for name in house
+             if name not in existing_rooms],
+            ignore_conflicts=True,
+        )
+        room_ids = dict(Room.objects.filter(
+            user=user, name__in=list(house)).values_list("name", "id"))
+
+        existing_lights = {
+            (light.room_id, light.name): light
+            for light in Light.objects.filter(room_id__in=room_ids.values())
+        }
+        new_lights, changed_lights, switched = [], [], []
+        for room_name, lights in house.items():
+            room_id = room_ids[room_name]
+            for light in lights.values():
+                current = existing_lights.get((room_id, light["name"]))
+                if current is None:
+                    new_lights.append(Light(room_id=room_id, **light))
+                elif (current.description, current.state) != (
+                        light["description"], light["state"]):
+                    if current.state != light["state"]:
+                        switched.append(current)
+                    current.description = light["description"]
+                    current.state = light["state"]
+                    changed_lights.append(current)
+        Light.objects.bulk_create(new_lights, batch_size=500)
+        Light.objects.bulk_update(changed_lights, ["description", "state"],
+                                  batch_size=500)
+
+        transaction.on_commit(lambda: invalidate_house_caches(user.id))
+        transaction.on_commit(lambda: light_events.record_many(
+            (light.id, light.state) for light in new_lights + switched
+            if light.id is not None))
+
+    return {
+        "rooms_created": len(room_ids) - len(existing_rooms),
+        "lights_created": len(new_lights),
+        "lights_updated": len(changed_lights),
+    }
+
+
+def invalidate_house_caches(user_id):
+    """Drops the cached views of a user's rooms and lights."""
+    bump_room_list_version(user_id)
+    invalidate_lights_snapshot()
+
+
+def room_batches(user):
+    """
+    Yields a user's rooms with their lights, in keyset batches.
+
+    Args:
+        user (User): The owner of the house.
+
+    Yields:
+        list: Rooms, each with its "name" and "lights".
+    """
+    cursor = None
+    while True:
+        rooms, cursor = room_page(user, cursor, STREAM_BATCH_SIZE,
+                                  EXPORT_ROOM_FIELDS, EXPORT_LIGHT_FIELDS)
+        yield rooms
+        if cursor is None:
+            return
+
+
+async def aroom_batches(user):
+    """Asynchronous `room_batches`, reading each batch in a worker thread."""
+    cursor = None
+    while True:
+        rooms, cursor = await sync_to_async(room_page)(
+            user, cursor, STREAM_BATCH_SIZE,
+            EXPORT_ROOM_FIELDS, EXPORT_LIGHT_FIELDS)
+        yield rooms
+        if cursor is None:
+            return
+
+
+def encode_csv(rooms, first):
+    """
+    Encodes a batch of rooms as CSV, in the format read by `parse_csv`.
+
+    Args:
+        rooms (list): The rooms, see `room_batches`.
+        first (bool): Whether this is the first batch, which starts with
+          the header row.
+
+    Returns:
+        str: The chunk of the document.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if first:
+        writer.writerow(CSV_COLUMNS)
+    for room in rooms:
+        if not room["lights"]:
+            writer.writerow([room["name"], "", "", ""])
+        for light in room["lights"]:
+            writer.writerow([room["name"], light["name"],
+                             light["description"] or "", light["state"]])
+    return buffer.getvalue()
+
+
+def encode_json(rooms, first):
+    """
+    Encodes a batch of rooms as JSON list items, in the format read by
+    `parse_json`.
+
+    Args:
+        rooms (list): The rooms, see `room_batches`.
+        first (bool): Whether this is the first batch, which opens the list.
+
+    Returns:
+        str: The chunk of the document.
+    """
+    items = [
+        json.dumps({"room": room["name"], "lights": room["lights"]})
+        for room in rooms
+    ]
+    chunk = ",\n".join(items)
+    if first:
+        return "[\n" + chunk if items else "["
+    return ",\n" + chunk if items else ""
+
+
+# Encoder of each export format, and the end of its document
+EXPORT_FORMATS = {
+    "csv": (encode_csv, ""),
+    "json": (encode_json, "\n]\n"),
+}
+
+
+def export_encoder(house_format):
+    """
+    Returns the encoder and the end of the document of an export format.
+
+    Raises:
+        InvalidHouse: If the format is unknown.
+    """
+    try:
+        return EXPORT_FORMATS[house_format]
+    except KeyError:
+        raise InvalidHouse(
+            f"Unknown format {house_format!r}, use csv or json.") from None
+
+
+def export_house(user, house_format):
+    """
+    Streams a user's house in the given format, reading its rooms in
+    keyset batches so memory stays flat.
+
+    Args:
+        user (User): The owner of the house.
+        house_format (str): "csv" or "json".
+
+    Returns:
+        generator: The chunks of the document.
+
+    Raises:
+        InvalidHouse: If the format is unknown.
+    """
+    encode, end = export_encoder(house_format)
+
+    def chunks():
+        for index, rooms in enumerate(room_batches(user)):
+            yield encode(rooms, index == 0)
+        if end:
+            yield end
+
+    return chunks()
+
+
+def aexport_house(user, house_format):
+    """
+    Asynchronous `export_house`, for streaming responses: under ASGI,
+    Django sends the chunks of an async generator as they are produced,
+    while it would read a sync one whole before sending anything.
+
+    Returns:
+        async generator: The chunks of the document.
+
+    Raises:
+        InvalidHouse: If the format is unknown.
+    """
+    encode, end = export_encoder(house_format)
+
+    async def chunks():
+        first = True
+        async for rooms in aroom_batches(user):
+            yield encode(rooms, first)
+            first = False
+        if end:
+            yield end
+
+    return chunks()
@@ -0,0 +1,137 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .metrics import LIGHT_EVENTS_WRITTEN
+from .models import Light, LightStateEvent
+
+logger = logging.getLogger("home_control.events")
+
+
+class LightEventLog:
+    """
+    Append-only log of light state changes (see `LightStateEvent`), the
+    history `usage.py` aggregates.
+
+    Recording a change only appends it to an in-memory batch, so toggles
+    and scene activations don't wait for an INSERT; a writer thread
+    inserts the pending changes every `flush_interval` seconds, or as
+    soon as `batch_size` of them are pending, with one bulk insert. The
+    pending changes are written when the process exits.
+
+    Attributes:
+        flush_interval (float): Seconds between two writes.
+        batch_size (int): Pending changes that trigger a write at once.
+    """
+
+    def __init__(self, flush_interval=None, batch_size=None):
+        self.flush_interval = flush_interval or getattr(
+            settings, "LIGHT_EVENTS_FLUSH_INTERVAL", 1.0)
+        self.batch_size = batch_size or getattr(
+            settings, "LIGHT_EVENTS_BATCH_SIZE", 1000)
+        # Changes recorded since the last write, (light_id, state, time)
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, light_id, state, when=None):
+        """
+        Records that a light was switched.
+
+        Args:
+            light_id (int): The ID of the light.
+            state (int): The state it was set to.
+            when (float, optional): UNIX time of the change, defaults to
+              now.
+        """
+        self.record_many([(light_id, state)], when)
+
+    def record_many(self, changes, when=None):
+        """
+        Records that several lights were switched at once, e.g. by a scene.
+
+        Args:
+            changes (iterable): (light ID, state) pairs.
+            when (float, optional): UNIX time of the changes, defaults to
+              now.
+        """
+        if when is None:
+            when = time.time()
+        with self._lock:
+            self._pending.extend(
+                (light_id, state, when) for light_id, state in changes)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+        self.start()
+
+    def flush(self):
+        """
+        Inserts the pending changes in one bulk insert.
+
+        Changes of lights deleted in the meantime are dropped, since their
+        history was deleted with them.
+
+        Returns:
+            int: The number of events written.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+        existing = set(Light.objects.filter(
+            id__in={light_id for light_id, _, _ in pending}).values_list(
+                "id", flat=True))
+        events = [LightStateEvent(light_id=light_id, state=state, time=when)
+                  for light_id, state, when in pending
+                  if light_id in existing]
+        LightStateEvent.objects.bulk_create(events, batch_size=500)
+        LIGHT_EVENTS_WRITTEN.inc(len(events))
+        return len(events)
+
+    def start(self):
+        """Starts the writer thread, if not running."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the writer thread after a last write."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            stopping = self._stop.is_set()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception as e:
+                # Keep the writer alive on database errors; the batch is
+                # lost, the lights' states are still stored
+                logger.error(f"Writing light events failed: {e}")
+            finally:
+                close_old_connections()
+            if stopping:
+                return
+
+
+# Shared log of the process
+light_events = LightEventLog()
+atexit.register(light_events.stop, 5)
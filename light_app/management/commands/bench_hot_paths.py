@@ -0,0 +1,242 @@
+import asyncio
+import itertools
+import json
+from time import perf_counter
+
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient
+
+from firmware_manager.consumers import MyWebSocketConsumer
+from light_app.background_task import stop_background_task
+from light_app.benchmarking import (
+    FakeDevice, create_bench_db, summarize, format_summary,
+)
+from light_app.light_events import light_events
+from light_app.models import Room, Light
+from light_app.query_stats import start_query_stats, stop_query_stats
+from light_app.rate_limit import limiter
+from light_app.scenes import capture_scene
+
+SCENARIOS = ["check_home_status", "toggle_light", "activate_scene",
+             "lights_status", "room_list", "ws_get"]
+
+# Lights of the benchmark scene
+SCENE_LIGHTS = 30
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the request hot paths against a local fake M5Core2 "
+        "device, reporting throughput, p50/p99 latency and queries per "
+        "request. Runs on a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200,
+                            help="Requests per scenario.")
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="Concurrent clients.")
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--lights", type=int, default=10,
+                            help="Lights per room.")
+        parser.add_argument("--latency", type=float, default=0.01,
+                            help="Fake device latency in seconds.")
+        parser.add_argument("--jitter", type=float, default=0.0,
+                            help="Random extra device latency in seconds.")
+        parser.add_argument("--failure-rate", type=float, default=0.0,
+                            help="Fraction of device requests that fail.")
+        parser.add_argument("--device-rate", type=float, default=0,
+                            help="Per-device rate limit (commands/s) while "
+                                 "benchmarking, 0 to disable it.")
+        parser.add_argument("--scenario", action="append",
+                            choices=SCENARIOS,
+                            help="Scenario to run (repeatable, default all).")
+        parser.add_argument("--json", dest="json_path",
+                            help="Write the results to this JSON file.")
+        parser.add_argument("--baseline",
+                            help="JSON results of a previous run to compare "
+                                 "against; fails on a p99 regression.")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="Allowed relative p99 regression.")
+
+    def handle(self, *args, **options):
+        # Keep the daemon poller's probes out of the device request counts
+        stop_background_task()
+        limiter.rate = options["device_rate"]
+        old_name = create_bench_db()
+        try:
+            with FakeDevice(options["latency"], options["jitter"],
+                            options["failure_rate"]) as device:
+                user = self.seed(device.address, options["rooms"],
+                                 options["lights"])
+                results = [
+                    self.run_scenario(name, user, options)
+                    for name in options["scenario"] or SCENARIOS
+                ]
+                self.stdout.write(
+                    f"Fake device requests: {device.requests}")
+        finally:
+            # Write the logged light changes before the database goes
+            light_events.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as f:
+                json.dump(results, f, indent=2)
+        if options["baseline"]:
+            self.compare(results, options["baseline"], options["tolerance"])
+
+    def seed(self, device_address, rooms, lights):
+        """Create the benchmark user with its rooms and lights."""
+        user = User.objects.create_user("bench", password="bench")
+        # Update the cached instance, it is saved again on every login
+        user_settings = user.usersettings
+        user_settings.m5core2_ip = device_address
+        user_settings.test_mode = False
+        user_settings.save()
+        room_objects = Room.objects.bulk_create(
+            Room(name=f"Room {r:03}", user=user) for r in range(rooms))
+        Light.objects.bulk_create(
+            Light(name=f"Light {n:03}", room=room)
+            for room in room_objects for n in range(lights)
+        )
+        capture_scene(user, "Movie night", Light.objects.filter(
+            room__user=user).values_list("id", flat=True)[:SCENE_LIGHTS])
+        return user
+
+    def run_scenario(self, name, user, options):
+        if name == "ws_get":
+            result = asyncio.run(self.run_websocket(user, options))
+        else:
+            result = asyncio.run(self.run_http(name, user, options))
+        self.stdout.write(format_summary(result))
+        return result
+
+    async def http_request(self, name, client, index):
+        if name == "check_home_status":
+            return await client.get("/check_home_status/")
+        if name == "lights_status":
+            return await client.get("/lights_status/")
+        if name == "room_list":
+            return await client.get("/rooms/", {"page": index % 4 + 1})
+        if name == "toggle_light":
+            return await client.post(
+                f"/toggle-light/Room {index % 3:03}/Light {index % 5:03}/",
+                headers={"x-requested-with": "XMLHttpRequest"},
+            )
+        if name == "activate_scene":
+            return await client.post(
+                "/scenes/Movie night/activate/",
+                headers={"x-requested-with": "XMLHttpRequest"},
+            )
+        raise CommandError(f"Unknown scenario {name}")
+
+    async def run_http(self, name, user, options):
+        """
+        Drive one view with concurrent test clients, through Django's ASGI
+        handler as in production (daphne): async views run in the event
+        loop, sync ones in its worker thread.
+        """
+        total = options["requests"]
+        counter = itertools.count()
+        latencies, queries = [], []
+        errors = 0
+
+        async def client():
+            nonlocal errors
+            client = AsyncClient()
+            await client.aforce_login(user)
+            while (index := next(counter)) < total:
+                # Counts the request's queries, in whichever thread they
+                # run, see `query_stats.py`
+                query_stats, token = start_query_stats()
+                start = perf_counter()
+                try:
+                    response = await self.http_request(name, client, index)
+                finally:
+                    stop_query_stats(token)
+                latencies.append(perf_counter() - start)
+                queries.append(query_stats[0])
+                if response.status_code >= 400:
+                    errors += 1
+
+        start = perf_counter()
+        await asyncio.gather(*(client()
+                               for _ in range(options["concurrency"])))
+        return summarize(name, latencies, queries, errors,
+                         perf_counter() - start)
+
+    async def run_websocket(self, user, options):
+        """Drive the /ws/goo/ consumer with concurrent connections."""
+        total = options["requests"]
+        concurrency = options["concurrency"]
+        latencies = []
+        errors = 0
+        query_count = [0]
+
+        def count_query(execute, sql, params, many, context):
+            query_count[0] += 1
+            return execute(sql, params, many, context)
+
+        # The consumer's ORM calls all run in the shared sync thread
+        add_wrapper = sync_to_async(
+            lambda: connection.execute_wrappers.append(count_query))
+        remove_wrapper = sync_to_async(
+            lambda: connection.execute_wrappers.remove(count_query))
+
+        async def client(requests):
+            nonlocal errors
+            communicator = WebsocketCommunicator(
+                MyWebSocketConsumer.as_asgi(), "/ws/goo/")
+            await communicator.connect()
+            for _ in range(requests):
+                start = perf_counter()
+                await communicator.send_json_to({
+                    "action": "get",
+                    "attribute_name": "server_check_interval",
+                    "user_id": user.id,
+                })
+                response = await communicator.receive_json_from(timeout=30)
+                latencies.append(perf_counter() - start)
+                if "error" in response:
+                    errors += 1
+            await communicator.disconnect()
+
+        await add_wrapper()
+        start = perf_counter()
+        try:
+            await asyncio.gather(*(
+                client(total // concurrency + (i < total % concurrency))
+                for i in range(concurrency)
+            ))
+        finally:
+            elapsed = perf_counter() - start
+            await remove_wrapper()
+
+        per_request = query_count[0] / len(latencies) if latencies else 0
+        return summarize("ws_get", latencies, [per_request] * len(latencies),
+                         errors, elapsed)
+
+    def compare(self, results, baseline_path, tolerance):
+        """Fail if a scenario's p99 regressed beyond the tolerance."""
+        with open(baseline_path) as f:
+            baseline = {r["scenario"]: r for r in json.load(f)}
+
+        regressions = []
+        for result in results:
+            previous = baseline.get(result["scenario"])
+            if not previous or not previous["p99_ms"]:
+                continue
+            ratio = result["p99_ms"] / previous["p99_ms"]
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f"{result['scenario']}: p99 {previous['p99_ms']:.2f} -> "
+                    f"{result['p99_ms']:.2f} ms (+{(ratio - 1) * 100:.0f}%)"
+                )
+        if regressions:
+            raise CommandError("Regressions:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No p99 regressions."))
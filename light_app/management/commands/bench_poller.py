@@ -0,0 +1,245 @@
+import random
+import resource
+import socket
+import tracemalloc
+from contextlib import ExitStack
+from time import perf_counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from light_app import background_task, device_client
+from light_app.benchmarking import FakeDevice, create_bench_db, percentile
+from light_app.home_status import HomeStatusTracker
+from light_app.models import UserSettings
+from light_app.poll_targets import poll_targets
+from light_app.rate_limit import limiter
+from light_app.sharding import DatabaseMembership, HashRing, PollerShard
+from light_app.signals import home_status_changed
+
+# Non-routable address: connections to it hang until the timeout
+BLACKHOLE_ADDRESS = "10.255.255.1"
+
+
+def closed_port_address():
+    """Return a local "host:port" address on which nothing listens."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"127.0.0.1:{port}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark one full cycle of the background poller over N simulated "
+        "homes with mixed device latencies and dead hosts. Runs on a "
+        "throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--homes", type=int, default=1000,
+                            help="Number of simulated homes (users).")
+        parser.add_argument("--latencies", default="0.005,0.02,0.1",
+                            help="Comma separated latencies (seconds) of "
+                                 "the simulated devices.")
+        parser.add_argument("--jitter", type=float, default=0.0,
+                            help="Random extra device latency in seconds.")
+        parser.add_argument("--failure-rate", type=float, default=0.0,
+                            help="Fraction of probes a live device fails.")
+        parser.add_argument("--dead-fraction", type=float, default=0.05,
+                            help="Fraction of homes whose device refuses "
+                                 "connections.")
+        parser.add_argument("--blackhole-fraction", type=float, default=0.0,
+                            help="Fraction of homes whose device never "
+                                 "answers (each probe waits --timeout).")
+        parser.add_argument("--timeout", type=float, default=2.0,
+                            help="Device request timeout in seconds.")
+        parser.add_argument("--cycles", type=int, default=1,
+                            help="Number of poll cycles to run.")
+        parser.add_argument("--shards", type=int, default=1,
+                            help="Number of simulated poller workers "
+                                 "sharing the homes; their cycles run one "
+                                 "after the other.")
+        parser.add_argument("--no-memory", action="store_true",
+                            help="Don't trace memory (tracing slows the "
+                                 "cycle down).")
+
+    def handle(self, *args, **options):
+        # Keep the daemon poller from probing the simulated homes too
+        background_task.stop_background_task()
+        device_client.DEVICE_TIMEOUT = options["timeout"]
+        # The simulated homes share a few fake devices, which the per-device
+        # rate limiter would otherwise throttle as one
+        limiter.rate = 0
+
+        latencies = [float(value) for value in
+                     options["latencies"].split(",") if value]
+        old_name = create_bench_db()
+        try:
+            with ExitStack() as stack:
+                devices = [
+                    stack.enter_context(FakeDevice(
+                        latency, options["jitter"], options["failure_rate"]))
+                    for latency in latencies
+                ]
+                self.seed(options["homes"], devices, options)
+                shards = self.join_shards(options["shards"])
+                for cycle in range(1, options["cycles"] + 1):
+                    self.run_cycle(cycle, options["homes"],
+                                   not options["no_memory"], shards,
+                                   devices)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def seed(self, homes, devices, options):
+        """Create the users and their settings with bulk inserts."""
+        dead = closed_port_address()
+        addresses = []
+        for _ in range(homes):
+            roll = random.random()
+            if roll < options["dead_fraction"]:
+                addresses.append(dead)
+            elif roll < options["dead_fraction"] + options[
+                    "blackhole_fraction"]:
+                addresses.append(BLACKHOLE_ADDRESS)
+            else:
+                addresses.append(random.choice(devices).address)
+
+        users = User.objects.bulk_create(
+            User(username=f"home{index:06}") for index in range(homes))
+        if users and users[0].pk is None:
+            # Backends that don't return primary keys from bulk inserts
+            users = list(User.objects.filter(username__startswith="home"))
+        UserSettings.objects.bulk_create(
+            UserSettings(user=user, m5core2_ip=address, test_mode=False,
+                         always_poll=True)
+            for user, address in zip(users, addresses)
+        )
+        self.stdout.write(
+            f"Seeded {homes} homes: {addresses.count(dead)} dead, "
+            f"{addresses.count(BLACKHOLE_ADDRESS)} blackholed, "
+            f"{len(devices)} device profiles {[d.address for d in devices]}"
+        )
+
+    def join_shards(self, count):
+        """
+        Register simulated poller workers in the database membership list
+        and report how evenly the consistent hash ring spreads the homes
+        and how many move when a worker leaves.
+        """
+        if count <= 1:
+            return [PollerShard()]
+        shards = [
+            PollerShard(DatabaseMembership(ttl=3600), name=f"bench-{index}",
+                        refresh_interval=0.001)
+            for index in range(count)
+        ]
+        for shard in shards:
+            shard.refresh(force=True)
+        # Let every worker see all the others, and end its warm-up
+        for shard in shards:
+            shard.refresh(force=True)
+
+        user_ids = list(UserSettings.objects.values_list("user_id", flat=True))
+        ring = shards[0].ring
+        sizes = sorted(sum(1 for user_id in user_ids
+                           if ring.owner(user_id) == shard.name)
+                       for shard in shards)
+        smaller = HashRing(ring.members[1:])
+        moved = sum(1 for user_id in user_ids
+                    if ring.owner(user_id) != smaller.owner(user_id))
+        self.stdout.write(
+            f"{count} shards: {sizes[0]}-{sizes[-1]} homes each; a worker "
+            f"leaving moves {moved} homes "
+            f"({moved / max(len(user_ids), 1):.0%})"
+        )
+        return shards
+
+    @staticmethod
+    def received_probes(devices):
+        """Return the number of probes the fake devices received so far."""
+        return sum(device.requests.get("/", 0) for device in devices)
+
+    def run_cycle(self, cycle, homes, trace_memory, shards, devices):
+        """Run and report one full poll cycle."""
+        # Fresh tracker so every home publishes its first status once
+        background_task.tracker = HomeStatusTracker(statuses={})
+        background_task.next_probe_at.clear()
+
+        probes = {}
+        probe_target = background_task.probe_target
+
+        def count_probe(target):
+            probes[target.user_id] = probes.get(target.user_id, 0) + 1
+            probe_target(target)
+
+        completed = {}
+        start = 0
+
+        def record_completion(sender, user_id, **kwargs):
+            completed.setdefault(user_id, perf_counter() - start)
+
+        home_status_changed.connect(record_completion, weak=False)
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        if trace_memory:
+            tracemalloc.start()
+        shard_durations = []
+        poller_shard = background_task.poller_shard
+        background_task.probe_target = count_probe
+        received = self.received_probes(devices)
+        start = perf_counter()
+        try:
+            with connection.execute_wrapper(count_query):
+                if cycle == 1:
+                    # Cold cycle: include loading the target index
+                    poll_targets.load()
+                for shard in shards:
+                    background_task.poller_shard = shard
+                    shard_start = perf_counter()
+                    background_task.poll_once()
+                    shard_durations.append(perf_counter() - shard_start)
+            duration = perf_counter() - start
+            received = self.received_probes(devices) - received
+        finally:
+            background_task.probe_target = probe_target
+            background_task.poller_shard = poller_shard
+            home_status_changed.disconnect(record_completion)
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+        staleness = list(completed.values())
+        # Probes answered by the live devices; those of dead and
+        # blackholed homes only count as probed homes
+        self.stdout.write(
+            f"Cycle {cycle}: {homes} homes in {duration:.2f} s, "
+            f"{received / duration:.1f} device probes/s "
+            f"({sum(probes.values())} homes probed), "
+            f"{queries[0]} DB queries"
+        )
+        if len(shards) > 1:
+            self.stdout.write(
+                f"  slowest shard {max(shard_durations):.2f} s (the cycle "
+                f"time with one worker per node); homes probed twice: "
+                f"{sum(1 for count in probes.values() if count > 1)}, "
+                f"never: {homes - len(probes)}"
+            )
+        if trace_memory:
+            self.stdout.write(f"  peak traced memory {peak / 2**20:.1f} MiB")
+        self.stdout.write(
+            "  max RSS "
+            f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}"
+            " MiB"
+        )
+        self.stdout.write(
+            f"  status staleness: p50 {percentile(staleness, 0.5):.2f} s, "
+            f"p99 {percentile(staleness, 0.99):.2f} s, "
+            f"max {max(staleness, default=0):.2f} s "
+            f"({homes - len(staleness)} homes without a status)"
+        )
@@ -0,0 +1,122 @@
+import random
+from time import perf_counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from light_app import usage
+from light_app.benchmarking import create_bench_db, percentile
+from light_app.models import Light, LightStateEvent, Room, UserSettings
+
+
+def naive_on_hours(events, start, end):
+    """
+    Reference on-hours per light, one Python step per event.
+
+    Args:
+        events (list): (light ID, state, time) tuples in time order.
+        start (float): UNIX time of the start of the period.
+        end (float): UNIX time of its end.
+
+    Returns:
+        dict: The on-hours by light ID.
+    """
+    on_since, hours = {}, {}
+    for light_id, state, when in events:
+        if light_id in on_since:
+            began = max(on_since.pop(light_id), start)
+            if when > start:
+                hours[light_id] = hours.get(light_id, 0) + (
+                    min(when, end) - began) / 3600
+        if state in usage.ON_STATES:
+            on_since[light_id] = when
+    for light_id, began in on_since.items():
+        hours[light_id] = hours.get(light_id, 0) + (
+            end - max(began, start)) / 3600
+    return hours
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the usage report of a home over its light state change "
+        "log: seeds months of events on a throwaway test database, then "
+        "times the extract and the vectorized aggregation."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10,
+                            help="Rooms of the simulated home.")
+        parser.add_argument("--lights", type=int, default=5,
+                            help="Lights per room.")
+        parser.add_argument("--days", type=int, default=365,
+                            help="Days of history, and of the report.")
+        parser.add_argument("--switches", type=int, default=8,
+                            help="State changes per light and day.")
+        parser.add_argument("--runs", type=int, default=20,
+                            help="Reports timed.")
+        parser.add_argument("--timezone", default="Europe/Bucharest")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        old_name = create_bench_db()
+        try:
+            self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run(self, options):
+        rng = random.Random(options["seed"])
+        user = User.objects.create(username="usage-bench")
+        UserSettings.objects.update_or_create(
+            user=user, defaults={"timezone": options["timezone"]})
+        rooms = Room.objects.bulk_create(
+            [Room(name=f"room {index}", user=user)
+             for index in range(options["rooms"])])
+        lights = Light.objects.bulk_create(
+            [Light(name=f"light {index}", room=room)
+             for room in rooms for index in range(options["lights"])])
+
+        now = 1.8e9
+        history = options["days"] * 86400
+        # Starts a day before the report, so lights have a state at start
+        events = [
+            (light.id, rng.choice((1, 2, 2, 3)),
+             now - history - 86400 + rng.random() * (history + 86400))
+            for light in lights
+            for _ in range((options["days"] + 1) * options["switches"])]
+        events.sort(key=lambda event: event[2])
+        LightStateEvent.objects.bulk_create(
+            [LightStateEvent(light_id=light_id, state=state, time=when)
+             for light_id, state, when in events],
+            batch_size=2000,
+        )
+        self.stdout.write(f"{len(lights)} lights, {len(events)} events")
+
+        start = now - history
+        extract_times, report_times = [], []
+        for _ in range(options["runs"]):
+            began = perf_counter()
+            usage.extract(user, start, now)
+            extract_times.append(perf_counter() - began)
+            began = perf_counter()
+            report = usage.usage_report(user, options["days"], now)
+            report_times.append(perf_counter() - began)
+        extract_ms = 1000 * percentile(extract_times, 0.5)
+        report_ms = 1000 * percentile(report_times, 0.5)
+        self.stdout.write(
+            f"extract p50 {extract_ms:.1f} ms, report p50 {report_ms:.1f} ms "
+            f"(aggregation {report_ms - extract_ms:.1f} ms), "
+            f"{report['events']} events in the period")
+
+        began = perf_counter()
+        expected = naive_on_hours(events, start, now)
+        naive_seconds = perf_counter() - began
+        error = max(abs(light["on_hours"] - expected.get(light["id"], 0))
+                    for light in report["lights"])
+        daily = sum(day["on_hours"] for day in report["daily"])
+        rooms_total = sum(room["on_hours"] for room in report["rooms"])
+        self.stdout.write(
+            f"Per-event loop on-hours in {1000 * naive_seconds:.1f} ms, "
+            f"largest difference {error:.4f} h; daily total {daily:.1f} h "
+            f"vs rooms total {rooms_total:.1f} h")
@@ -0,0 +1,65 @@
+import os
+import re
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Python snippet timed in a fresh interpreter: import and set up Django
+SETUP_SNIPPET = (
+    "import os, django; "
+    "os.environ.setdefault('DJANGO_SETTINGS_MODULE', {module!r}); "
+    "django.setup()"
+)
+IMPORT_TIME_LINE = re.compile(
+    r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the import time of a cold django.setup() in a fresh "
+        "interpreter and fail if it exceeds STARTUP_IMPORT_BUDGET_MS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--budget", type=int,
+                            help="Budget in milliseconds (defaults to the "
+                                 "STARTUP_IMPORT_BUDGET_MS setting).")
+        parser.add_argument("--top", type=int, default=15,
+                            help="Number of slowest top-level imports shown.")
+
+    def handle(self, *args, **options):
+        budget = options["budget"] or getattr(
+            settings, "STARTUP_IMPORT_BUDGET_MS", 400)
+        snippet = SETUP_SNIPPET.format(
+            module=os.environ.get("DJANGO_SETTINGS_MODULE",
+                                  "home_control_project.settings"))
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", snippet],
+            capture_output=True, text=True,
+            env={**os.environ, "POLLER_AUTOSTART": "False"},
+        )
+        if result.returncode:
+            raise CommandError(f"django.setup() failed:\n{result.stderr}")
+
+        # Top-level imports are the ones without indentation; their
+        # cumulative times add up to the total
+        top_level = []
+        for line in result.stderr.splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if match and len(match.group(3)) == 1:
+                top_level.append((int(match.group(2)), match.group(4)))
+
+        total_ms = sum(cumulative for cumulative, _ in top_level) / 1000
+        for cumulative, module in sorted(top_level, reverse=True)[
+                :options["top"]]:
+            self.stdout.write(f"{cumulative / 1000:>9.1f} ms  {module}")
+        self.stdout.write(
+            f"Total import time {total_ms:.1f} ms (budget {budget} ms)")
+
+        if total_ms > budget:
+            raise CommandError(
+                f"Start-up import time {total_ms:.1f} ms exceeds the "
+                f"{budget} ms budget.")
+        self.stdout.write(self.style.SUCCESS("Within budget."))
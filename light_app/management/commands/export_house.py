@@ -0,0 +1,32 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from light_app.house_io import export_house
+
+
+class Command(BaseCommand):
+    help = (
+        "Export a user's rooms and lights as a CSV or JSON house "
+        "description, readable by import_house."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", help="Owner of the exported house.")
+        parser.add_argument("path", nargs="?",
+                            help="Destination file (defaults to stdout).")
+        parser.add_argument("--format", choices=("csv", "json"),
+                            default="json", help="Format of the export.")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError(f"Unknown user {options['username']!r}.")
+        chunks = export_house(user, options["format"])
+        if not options["path"]:
+            sys.stdout.writelines(chunks)
+            return
+        with open(options["path"], "w", encoding="utf-8", newline="") as file:
+            file.writelines(chunks)
@@ -0,0 +1,40 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from light_app.house_io import InvalidHouse, parse_house, import_house
+
+
+class Command(BaseCommand):
+    help = (
+        "Import rooms and lights for a user from a CSV or JSON house "
+        "description, in a single transaction. Existing rooms and lights "
+        "with the same names are updated, not duplicated."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", help="Owner of the imported house.")
+        parser.add_argument("path", help="CSV or JSON file to import.")
+        parser.add_argument("--format", choices=("csv", "json"),
+                            help="Format of the file (defaults to its "
+                                 "extension).")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError(f"Unknown user {options['username']!r}.")
+        path = options["path"]
+        house_format = options["format"] or (
+            "csv" if os.path.splitext(path)[1].lower() == ".csv" else "json")
+        try:
+            with open(path, encoding="utf-8-sig") as file:
+                house = parse_house(file.read(), house_format)
+        except (OSError, UnicodeDecodeError, InvalidHouse) as e:
+            raise CommandError(str(e))
+
+        counts = import_house(user, house)
+        self.stdout.write(self.style.SUCCESS(
+            "Created {rooms_created} rooms and {lights_created} lights, "
+            "updated {lights_updated} lights.".format(**counts)))
@@ -0,0 +1,42 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from light_app.heartbeats import heartbeats, serve_udp
+
+
+class Command(BaseCommand):
+    help = (
+        "Listen for device heartbeats over UDP. The homes' statuses are "
+        "shared with the web workers through the cache, so set REDIS_URL "
+        "when running this next to them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0",
+                            help="Address to listen on.")
+        parser.add_argument("--port", type=int,
+                            help="UDP port (defaults to the "
+                                 "HEARTBEAT_UDP_PORT setting).")
+
+    def handle(self, *args, **options):
+        port = options["port"] or settings.HEARTBEAT_UDP_PORT
+        # Load the keys before serving, not from the event loop
+        heartbeats.load()
+        heartbeats.start()
+        self.stdout.write(
+            f"Listening for heartbeats on udp://{options['host']}:{port}")
+        try:
+            asyncio.run(self.serve(options["host"], port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            heartbeats.stop()
+
+    async def serve(self, host, port):
+        transport = await serve_udp(host, port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            transport.close()
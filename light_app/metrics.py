@@ -0,0 +1,394 @@
+import math
+import threading
+import weakref
+
+# Default histogram buckets (in seconds) for request and device latencies
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+# Histogram buckets for per-request database query counts
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    """Escape a label value for the text exposition format."""
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+class _ShardOwner:
+    """Thread-local marker whose collection tells that a thread ended."""
+
+    __slots__ = ("__weakref__",)
+
+
+class _ThreadShards:
+    """
+    Per-thread storage for metric values.
+
+    Each thread only ever writes to its own shard, so updates on the hot
+    path need no lock and cannot be lost. Shards are merged when the
+    registry is scraped. The lock is only taken the first time a thread
+    touches a metric, and when it ends: the shard of a finished thread is
+    merged into a retired total, so short-lived threads don't leave their
+    shards behind.
+
+    Shard values are numbers, or lists of numbers added element-wise.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        # Merged values of the shards of finished threads
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the calling thread's shard, creating it on first use."""
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            # The thread-local owner is collected when the thread ends
+            self._local.owner = _ShardOwner()
+            weakref.finalize(self._local.owner, self._retire, shard)
+        return shard
+
+    def _retire(self, shard):
+        """Merge the shard of a finished thread into the retired total."""
+        with self._lock:
+            self._shards.remove(shard)
+            for key, value in shard.items():
+                total = self._retired.get(key)
+                if total is None:
+                    self._retired[key] = (
+                        list(value) if isinstance(value, list) else value)
+                elif isinstance(value, list):
+                    for index, item in enumerate(value):
+                        total[index] += item
+                else:
+                    self._retired[key] = total + value
+
+    def snapshot(self):
+        """Return a copy of the items of every shard."""
+        with self._lock:
+            shards = list(self._shards)
+            retired = [
+                (key, list(value) if isinstance(value, list) else value)
+                for key, value in self._retired.items()
+            ]
+        return [retired] + [list(shard.items()) for shard in shards]
+
+
+class Metric:
+    """
+    Base class for the metrics kept in a `MetricsRegistry`.
+
+    Attributes:
+        name (str): The metric name, e.g. `home_control_probe_seconds`.
+        help (str): One line description shown on the `/metrics` page.
+        labelnames (tuple): Names of the labels the metric is split by.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(
+            f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        """Return the metric in the Prometheus text exposition format."""
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+    def _samples(self):
+        return []
+
+
+class Counter(Metric):
+    """A monotonically increasing counter."""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._shards = _ThreadShards()
+
+    def inc(self, amount=1, **labels):
+        """
+        Increase the counter.
+
+        Args:
+            amount (int or float): The amount to add. Defaults to 1.
+            **labels: Values for the metric's label names.
+        """
+        shard = self._shards.get()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def values(self):
+        """Return the merged value of every label combination."""
+        totals = {}
+        for items in self._shards.snapshot():
+            for key, value in items:
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def _samples(self):
+        return [f"{self.name}{self._format_labels(key)} {value}"
+                for key, value in sorted(self.values().items())]
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down.
+
+    The value is either set explicitly or, when `function` is given,
+    computed when the registry is scraped.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+        self._function = function
+
+    def set(self, value, **labels):
+        """
+        Set the gauge.
+
+        Args:
+            value (int or float): The new value.
+            **labels: Values for the metric's label names.
+        """
+        self._values[self._key(labels)] = value
+
+    def values(self):
+        """Return the current value of every label combination."""
+        if self._function is not None:
+            # The function returns a single value, or a dict mapping label
+            # value tuples to values
+            value = self._function()
+            return dict(value) if isinstance(value, dict) else {(): value}
+        return dict(self._values)
+
+    def _samples(self):
+        return [f"{self.name}{self._format_labels(key)} {value}"
+                for key, value in sorted(self.values().items())]
+
+
+class Histogram(Metric):
+    """A histogram of observed values with cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._shards = _ThreadShards()
+
+    def observe(self, value, **labels):
+        """
+        Record one observation.
+
+        Args:
+            value (int or float): The observed value.
+            **labels: Values for the metric's label names.
+        """
+        shard = self._shards.get()
+        key = self._key(labels)
+        state = shard.get(key)
+        if state is None:
+            # [per-bucket counts..., sum, count]
+            state = shard[key] = [0] * len(self.buckets) + [0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[index] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    def values(self):
+        """Return the merged bucket counts, sum and count per label key."""
+        totals = {}
+        for items in self._shards.snapshot():
+            for key, state in items:
+                merged = totals.setdefault(key, [0] * len(state))
+                for index, value in enumerate(list(state)):
+                    merged[index] += value
+        return totals
+
+    def _samples(self):
+        lines = []
+        for key, state in sorted(self.values().items()):
+            cumulative = 0
+            for index, bound in enumerate(self.buckets):
+                cumulative += state[index]
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{self._format_labels(key, ('le', le))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{self._format_labels(key)} "
+                         f"{state[-2]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} "
+                         f"{state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Collection of the application's metrics, rendered by the `/metrics`
+    view in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric to the registry, or return the one already registered
+        under the same name.
+
+        Args:
+            metric (Metric): The metric to register.
+
+        Returns:
+            Metric: The registered metric.
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        return self.register(Gauge(name, help, labelnames, function))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        """Return every registered metric in the text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+# Registry shared by the whole process
+registry = MetricsRegistry()
+
+# =============================================================================
+# Application metrics
+
+PROBE_SECONDS = registry.histogram(
+    "home_control_probe_seconds",
+    "Latency of the background poller's device status probes.",
+    ["result"],
+)
+DEVICE_COMMAND_SECONDS = registry.histogram(
+    "home_control_device_command_seconds",
+    "Latency of HTTP requests sent to M5Core2 devices.",
+    ["command"],
+)
+VIEW_RESPONSE_SECONDS = registry.histogram(
+    "home_control_view_response_seconds",
+    "Response time per view.",
+    ["view"],
+)
+VIEW_DB_QUERIES = registry.histogram(
+    "home_control_view_db_queries",
+    "Number of database queries per request, per view.",
+    ["view"],
+    buckets=QUERY_COUNT_BUCKETS,
+)
+HOME_STATUS_TRANSITIONS = registry.counter(
+    "home_control_home_status_transitions_total",
+    "Published home online/offline transitions.",
+    ["status"],
+)
+FIRMWARE_BYTES_PUSHED = registry.counter(
+    "home_control_firmware_bytes_pushed_total",
+    "Firmware bytes uploaded to devices.",
+)
+CACHE_REQUESTS = registry.counter(
+    "home_control_cache_requests_total",
+    "Lookups in the two-tier cache, per tier (local, shared) and result.",
+    ["tier", "result"],
+)
+DEVICE_PROBES_COALESCED = registry.counter(
+    "home_control_device_probes_coalesced_total",
+    "Device probes answered with the result of an identical in-flight probe.",
+    ["command"],
+)
+DEVICE_QUEUE_DEPTH = registry.gauge(
+    "home_control_device_queue_depth",
+    "Device commands waiting for a rate limiter slot, over all devices.",
+)
+DEVICE_COMMANDS_REJECTED = registry.counter(
+    "home_control_device_commands_rejected_total",
+    "Device commands rejected because the device's queue was full.",
+    ["command"],
+)
+HEARTBEATS_RECEIVED = registry.counter(
+    "home_control_heartbeats_received_total",
+    "Device heartbeats received, per transport (http, udp) and result.",
+    ["transport", "result"],
+)
+POLLER_MEMBERS = registry.gauge(
+    "home_control_poller_members",
+    "Live poller workers sharing the homes, as seen by this process.",
+)
+DB_CONNECTIONS = registry.counter(
+    "home_control_db_connections_total",
+    "Database connections opened, or borrowed from the pool, per alias.",
+    ["alias"],
+)
+FIRMWARE_UPDATES = registry.counter(
+    "home_control_firmware_updates_total",
+    "Firmware updates pushed to devices, per transfer mode (delta, "
+    "compressed, full, fallback, up_to_date).",
+    ["mode"],
+)
+TRACE_SPANS_DROPPED = registry.counter(
+    "home_control_trace_spans_dropped_total",
+    "Trace spans dropped because the export queue was full or the export "
+    "failed.",
+)
+LOG_RECORDS_DROPPED = registry.counter(
+    "home_control_log_records_dropped_total",
+    "Log records dropped because the logging queue was full.",
+)
+LOG_RECORDS_SUPPRESSED = registry.counter(
+    "home_control_log_records_suppressed_total",
+    "Repeated log records suppressed by the rate limit, per logger.",
+    ["logger"],
+)
+MODEL_SAVES = registry.counter(
+    "home_control_model_saves_total",
+    "Saves of dirty-tracked models, per model and result (partial: only "
+    "the changed fields written, skipped: nothing changed, full).",
+    ["model", "result"],
+)
+LIGHT_EVENTS_WRITTEN = registry.counter(
+    "home_control_light_events_written_total",
+    "Light state changes written to the event log.",
+)
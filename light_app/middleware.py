@@ -1,6 +1,90 @@
+import random
+import time
+from time import perf_counter
+
+from asgiref.sync import (
+    iscoroutinefunction, markcoroutinefunction, sync_to_async,
+)
+from django.core.exceptions import MiddlewareNotUsed
 from django.utils import translation
 from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
 from light_app.models import UserSettings
+from light_app.metrics import VIEW_RESPONSE_SECONDS, VIEW_DB_QUERIES
+from light_app.poll_targets import poll_targets
+from light_app.snapshots import get_user_settings, aget_user_settings
+from light_app.query_stats import start_query_stats, stop_query_stats
+from light_app.tracing import tracer
+from light_app.db_router import (
+    replicas, sticky_seconds, start_pinning, stop_pinning,
+)
+from light_app.profiling import (
+    profile_store, start_external_timer, stop_external_timer, try_profile,
+    stop_profile, format_profile, start_timeline, stop_timeline,
+    format_timeline,
+)
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise static file serving, made async-capable.
+
+    WhiteNoiseMiddleware is sync only: under ASGI, Django would run it, and
+    through it the whole rest of the chain, in the single thread shared by
+    all sync code, serializing every request. This subclass serves static
+    files from a worker thread and passes other requests straight through
+    on the event loop.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response, *args, **kwargs):
+        """
+        Initialize the middleware with the next middleware or view.
+
+        Args:
+            get_response (callable): A callable to get the response for the
+              next middleware or view.
+        """
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """
+        Serve the request's static file, or pass the request on.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The static file or the next middleware's response.
+        """
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        """
+        Async version of `__call__`.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The static file or the next middleware's response.
+        """
+        if self.autorefresh:
+            # Looks the file up on disk
+            static_file = await sync_to_async(
+                self.find_file, thread_sensitive=False)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(
+                self.serve, thread_sensitive=False)(static_file, request)
+        return await self.get_response(request)
 
 
 class UserSettingsMiddleware:
@@ -11,12 +95,16 @@ class UserSettingsMiddleware:
     This middleware activates the user's preferred language, sets session
       variables for theme and font size, and
     provides access to user-specific settings such as the primary color and
-    IP address for M5Core2 devices.
+    IP address for M5Core2 devices. It runs natively in both sync (WSGI) and
+    async (ASGI) request chains.
 
     Attributes:
         get_response (callable): The next middleware or view in the stack.
     """
 
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         """
         Initialize the middleware with the next middleware or view.
@@ -26,6 +114,8 @@ class UserSettingsMiddleware:
             next middleware or view.
         """
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
         """
@@ -43,38 +133,104 @@ class UserSettingsMiddleware:
         Returns:
             HttpResponse: The response object from the next middleware or view.
         """
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
         if request.user.is_authenticated:
-            # Retrieve or create the user's settings.
-            user_settings, created = UserSettings.objects.get_or_create(
-                user=request.user
-                )
+            # Keep the user's device in the poller's active set.
+            poll_targets.mark_active(request.user.id)
 
-            # Activate the user's preferred language.
-            translation.activate(user_settings.preferred_language)
-            request.LANGUAGE_CODE = user_settings.preferred_language
+            # Retrieve or create the user's settings, through the cache.
+            user_settings = get_user_settings(request.user)
+            self.apply_settings(request, user_settings)
+
+            # Store theme, font size, and primary color in session. Only
+            # changed values are written, so the session isn't saved again
+            # on every request.
+            for key, value in self.session_values(user_settings).items():
+                if request.session.get(key) != value:
+                    request.session[key] = value
+
+        # Process the response from the next middleware or view.
+        response = self.get_response(request)
 
-            # Store theme, font size, and primary color in session.
-            request.session["theme"] = user_settings.theme
-            request.session["font_size"] = user_settings.font_size
-            request.session["primary_color"] = user_settings.primary_color
+        # Deactivate the translation after the request is processed.
+        translation.deactivate()
+
+        return response
+
+    async def __acall__(self, request):
+        """
+        Async version of `__call__`, using the async ORM and session APIs.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        user = await request.auser()
+        if user.is_authenticated:
+            # Keep the user's device in the poller's active set.
+            await poll_targets.amark_active(user.id)
 
-            # Attach user settings and M5Core2 IP address to the request obj.
-            request.user_settings = user_settings
-            request.user_ip = (
-                user_settings.m5core2_ip
-                if user_settings.m5core2_ip
-                else "none"
-            )
+            # Retrieve or create the user's settings, through the cache.
+            user_settings = await aget_user_settings(user)
+            self.apply_settings(request, user_settings)
 
+            # Store the changed theme, font size, and primary color in
+            # session.
+            for key, value in self.session_values(user_settings).items():
+                if await request.session.aget(key) != value:
+                    await request.session.aset(key, value)
 
         # Process the response from the next middleware or view.
-        response = self.get_response(request)
+        response = await self.get_response(request)
 
         # Deactivate the translation after the request is processed.
         translation.deactivate()
 
         return response
 
+    @staticmethod
+    def session_values(user_settings):
+        """
+        Returns the user settings mirrored in the session.
+
+        Args:
+            user_settings (UserSettings): The settings of the request's user.
+
+        Returns:
+            dict: The session keys and their values.
+        """
+        return {
+            "theme": user_settings.theme,
+            "font_size": user_settings.font_size,
+            "primary_color": user_settings.primary_color,
+        }
+
+    @staticmethod
+    def apply_settings(request, user_settings):
+        """
+        Activate the user's language and attach their settings and M5Core2
+        IP address to the request.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            user_settings (UserSettings): The settings of the request's user.
+        """
+        # Activate the user's preferred language.
+        translation.activate(user_settings.preferred_language)
+        request.LANGUAGE_CODE = user_settings.preferred_language
+
+        # Attach user settings and M5Core2 IP address to the request obj.
+        request.user_settings = user_settings
+        request.user_ip = (
+            user_settings.m5core2_ip
+            if user_settings.m5core2_ip
+            else "none"
+        )
+
 
 class UserLanguageMiddleware:
     """
@@ -83,12 +239,16 @@ class UserLanguageMiddleware:
 
     This middleware activates the language selected in the user's settings.
       If the user is not authenticated,
-    the default language is set to English.
+    the default language is set to English. It runs natively in both sync
+    and async request chains.
 
     Attributes:
         get_response (callable): The next middleware or view in the stack.
     """
 
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         """
         Initialize the middleware with the next middleware or view.
@@ -98,6 +258,8 @@ class UserLanguageMiddleware:
               next middleware or view.
         """
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
         """
@@ -114,11 +276,71 @@ class UserLanguageMiddleware:
         Returns:
             HttpResponse: The response object from the next middleware or view.
         """
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
         if request.user.is_authenticated:
-            # Retrieve or create the user's settings.
-            user_settings, created = UserSettings.objects.get_or_create(
-                user=request.user)
+            # Reuse the settings loaded by UserSettingsMiddleware, or
+            # retrieve or create them.
+            user_settings = getattr(request, "user_settings", None)
+            if user_settings is None:
+                user_settings, created = UserSettings.objects.get_or_create(
+                    user=request.user)
+            self.activate_language(request, user_settings)
+        else:
+            self.activate_language(request, None)
 
+        # Process the response from the next middleware or view.
+        response = self.get_response(request)
+
+        # Deactivate the translation after the request is processed.
+        translation.deactivate()
+
+        return response
+
+    async def __acall__(self, request):
+        """
+        Async version of `__call__`, using the async ORM.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        user = await request.auser()
+        if user.is_authenticated:
+            # Reuse the settings loaded by UserSettingsMiddleware, or
+            # retrieve or create them.
+            user_settings = getattr(request, "user_settings", None)
+            if user_settings is None:
+                user_settings, created = (
+                    await UserSettings.objects.aget_or_create(user=user)
+                )
+            self.activate_language(request, user_settings)
+        else:
+            self.activate_language(request, None)
+
+        # Process the response from the next middleware or view.
+        response = await self.get_response(request)
+
+        # Deactivate the translation after the request is processed.
+        translation.deactivate()
+
+        return response
+
+    @staticmethod
+    def activate_language(request, user_settings):
+        """
+        Activate the user's preferred language, or English for anonymous
+        users.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            user_settings (UserSettings or None): The settings of the
+              request's user, None if not authenticated.
+        """
+        if user_settings is not None:
             # Activate the user's preferred language.
             translation.activate(user_settings.preferred_language)
             request.LANGUAGE_CODE = user_settings.preferred_language
@@ -126,10 +348,419 @@ class UserLanguageMiddleware:
             # Activate default language (English) for non-authenticated users.
             translation.activate("en")
 
-        # Process the response from the next middleware or view.
-        response = self.get_response(request)
 
-        # Deactivate the translation after the request is processed.
-        translation.deactivate()
+class TracingMiddleware:
+    """
+    Middleware timing each request in the root span of its trace; the
+    spans of its ORM queries, device calls and inner work nest under it,
+    see `tracing.py`. A `traceparent` request header continues the
+    caller's trace.
+
+    It should be placed first in `MIDDLEWARE` so the other middlewares are
+    included in the span.
+
+    Attributes:
+        get_response (callable): The next middleware or view in the stack.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        """
+        Initialize the middleware with the next middleware or view.
+
+        Args:
+            get_response (callable): A callable to get the response for the
+              next middleware or view.
+
+        Raises:
+            MiddlewareNotUsed: If tracing is disabled in the settings.
+        """
+        if not tracer.enabled:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """
+        Process the request within its span.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        with self.span(request) as span:
+            response = self.get_response(request)
+            self.finish(span, request, response)
+        return response
+
+    async def __acall__(self, request):
+        """
+        Async version of `__call__`.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        with self.span(request) as span:
+            response = await self.get_response(request)
+            self.finish(span, request, response)
+        return response
+
+    def span(self, request):
+        """Opens the span of a request."""
+        return tracer.span(
+            f"{request.method} {request.path}",
+            "server",
+            {"http.method": request.method, "http.target": request.path},
+            traceparent=request.headers.get("traceparent"),
+            root=True,
+        )
+
+    def finish(self, span, request, response):
+        """Names the span after the view and records the response."""
+        if span is None:
+            return
+        match = request.resolver_match
+        if match:
+            view = match.url_name or match.view_name
+            span.name = f"{request.method} {view}"
+            span.set("http.route", match.route)
+        span.set("http.status_code", response.status_code)
+        if getattr(request, "user", None) is not None and (
+                request.user.is_authenticated):
+            span.set("user.id", request.user.id)
+
+
+class MetricsMiddleware:
+    """
+    Middleware recording the response time and the number of database
+    queries of each request, labelled with the URL name of the view.
+
+    It should be placed first in `MIDDLEWARE` so the cost of the other
+    middlewares is included. It runs natively in both sync and async
+    request chains.
+
+    Attributes:
+        get_response (callable): The next middleware or view in the stack.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        """
+        Initialize the middleware with the next middleware or view.
+
+        Args:
+            get_response (callable): A callable to get the response for the
+              next middleware or view.
+        """
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """
+        Process the request and record its metrics.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        queries, token = start_query_stats()
+        start = perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            stop_query_stats(token)
+        self.record(request, perf_counter() - start, queries[0])
+        return response
+
+    async def __acall__(self, request):
+        """
+        Async version of `__call__`.
 
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        queries, token = start_query_stats()
+        start = perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            stop_query_stats(token)
+        self.record(request, perf_counter() - start, queries[0])
         return response
+
+    @staticmethod
+    def record(request, elapsed, queries):
+        """
+        Record the response time and query count of a processed request.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            elapsed (float): The response time in seconds.
+            queries (int): The number of database queries run.
+        """
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else "unresolved"
+        VIEW_RESPONSE_SECONDS.observe(elapsed, view=view)
+        VIEW_DB_QUERIES.observe(queries, view=view)
+
+
+class ReplicaPinningMiddleware:
+    """
+    Middleware giving clients read-your-writes consistency when reads go
+    to replicas, see `db_router.ReplicaRouter`.
+
+    Once a request wrote something, the rest of it reads from the primary
+    and the response sets a short-lived cookie; the client's requests
+    carrying the cookie read from the primary too, until the replicas have
+    caught up with the write. It should be placed before the session and
+    authentication middlewares so their reads are routed as well.
+
+    Attributes:
+        get_response (callable): The next middleware or view in the stack.
+        sticky (float): Seconds reads stay on the primary after a write.
+    """
+
+    sync_capable = True
+    async_capable = True
+    cookie_name = "db_primary"
+
+    def __init__(self, get_response):
+        """
+        Initialize the middleware with the next middleware or view.
+
+        Args:
+            get_response (callable): A callable to get the response for the
+              next middleware or view.
+
+        Raises:
+            MiddlewareNotUsed: If there are no replicas.
+        """
+        if not replicas():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sticky = sticky_seconds()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """
+        Process the request with its own pin to the primary.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        pin, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            stop_pinning(token)
+        return self.finish(pin, response)
+
+    async def __acall__(self, request):
+        """
+        Async version of `__call__`.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        pin, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            stop_pinning(token)
+        return self.finish(pin, response)
+
+    def start(self, request):
+        """Pins the request to the primary if its client wrote recently."""
+        wrote_recently = self.cookie_name in request.COOKIES
+        return start_pinning(self.sticky if wrote_recently else 0)
+
+    def finish(self, pin, response):
+        """Keeps the client on the primary for a while after a write."""
+        if pin.wrote:
+            response.set_cookie(self.cookie_name, "1", max_age=self.sticky,
+                                httponly=True, samesite="Lax")
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Opt-in middleware recording, per URL name, the wall time, the number and
+    duration of ORM queries and the time spent in device HTTP calls.
+
+    A fraction (`PROFILING_SAMPLE_RATE`) of the requests additionally runs
+    under cProfile; those slower than `PROFILING_SLOW_MS` are kept with
+    their profile in a ring buffer shown on the admin profiling page.
+    The middleware is only active when `PROFILING_ENABLED` is True.
+
+    It is async-capable, so enabling it doesn't push the chain into a
+    thread under ASGI. cProfile can't attribute time to a single
+    coroutine, so the sampled requests of async views record their
+    wall-clock spans (ORM queries and device calls) instead, see
+    `start_timeline`.
+
+    Attributes:
+        get_response (callable): The next middleware or view in the stack.
+        sample_rate (float): Fraction of requests profiled with cProfile.
+        slow_threshold (float): Seconds above which a sample is kept.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        """
+        Initialize the middleware with the next middleware or view.
+
+        Args:
+            get_response (callable): A callable to get the response for the
+              next middleware or view.
+
+        Raises:
+            MiddlewareNotUsed: If profiling is disabled in the settings.
+        """
+        if not getattr(settings, "PROFILING_ENABLED", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, "PROFILING_SAMPLE_RATE", 0.01)
+        self.slow_threshold = getattr(
+            settings, "PROFILING_SLOW_MS", 500) / 1000
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """
+        Process the request and record its timings.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        profiler = None
+        if self.sampled():
+            profiler = try_profile()
+
+        query_stats, query_token = start_query_stats()
+        external, token = start_external_timer()
+        start = perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            wall = perf_counter() - start
+            stop_external_timer(token)
+            stop_query_stats(query_token)
+            if profiler:
+                stop_profile(profiler)
+
+        self.record(request, response, wall, query_stats, external[0],
+                    lambda: format_profile(profiler) if profiler else None)
+        return response
+
+    async def __acall__(self, request):
+        """
+        Async version of `__call__`, sampling wall-clock spans instead of
+        running cProfile.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            HttpResponse: The response object from the next middleware or view.
+        """
+        spans = timeline_token = None
+        if self.sampled():
+            spans, timeline_token = start_timeline()
+
+        query_stats, query_token = start_query_stats()
+        external, token = start_external_timer()
+        start = perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            wall = perf_counter() - start
+            stop_external_timer(token)
+            stop_query_stats(query_token)
+            if timeline_token is not None:
+                stop_timeline(timeline_token)
+
+        self.record(request, response, wall, query_stats, external[0],
+                    lambda: format_timeline(spans, start, wall)
+                    if spans is not None else None)
+        return response
+
+    def sampled(self):
+        """Tells whether to profile the current request."""
+        return bool(self.sample_rate) and random.random() < self.sample_rate
+
+    def record(self, request, response, wall, query_stats, external,
+               profile):
+        """
+        Adds a request to the per-view statistics, and keeps it as a sample
+        if it was profiled and is slow.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            response (HttpResponse): Its response.
+            wall (float): Wall time of the request in seconds.
+            query_stats (list): Its query count and seconds.
+            external (float): Seconds spent in device calls.
+            profile (callable): Returns the formatted profile of a
+              sampled request, None if it wasn't sampled.
+        """
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else "unresolved"
+        profile_store.record(view, wall, query_stats[0], query_stats[1],
+                             external)
+
+        if wall < self.slow_threshold:
+            return
+        stack = profile()
+        if stack is not None:
+            profile_store.add_sample({
+                "timestamp": time.time(),
+                "method": request.method,
+                "path": request.path,
+                "view": view,
+                "status": response.status_code,
+                "wall_ms": wall * 1000,
+                "queries": query_stats[0],
+                "query_ms": query_stats[1] * 1000,
+                "external_ms": external * 1000,
+                "profile": stack,
+            })
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.1 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("light_app", "0003_alter_room_user_alter_room_unique_together"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="usersettings",
+            name="always_poll",
+            field=models.BooleanField(
+                default=False,
+                help_text="Check the device status even when the user is inactive.",
+            ),
+        ),
+    ]
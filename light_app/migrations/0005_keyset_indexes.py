@@ -0,0 +1,27 @@
+# Generated by Django 5.1.1 on 2026-10-19 08:03
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("light_app", "0004_usersettings_always_poll"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="light",
+            index=models.Index(
+                fields=["room", "name", "id"], name="light_room_name_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="room",
+            index=models.Index(
+                fields=["user", "name", "id"], name="room_user_name_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 5.1.1 on 2026-10-19 08:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("light_app", "0005_keyset_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Scene",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                ("members", models.JSONField(default=list, editable=False)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="scenes",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["name"],
+            },
+        ),
+        migrations.CreateModel(
+            name="SceneLight",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "state",
+                    models.IntegerField(
+                        choices=[(1, "on"), (2, "off"), (3, "timer")],
+                        default=1,
+                    ),
+                ),
+                (
+                    "light",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="scene_entries",
+                        to="light_app.light",
+                    ),
+                ),
+                (
+                    "scene",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="entries",
+                        to="light_app.scene",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["id"],
+                "unique_together": {("scene", "light")},
+            },
+        ),
+        migrations.AddField(
+            model_name="scene",
+            name="lights",
+            field=models.ManyToManyField(
+                blank=True,
+                related_name="scenes",
+                through="light_app.SceneLight",
+                to="light_app.light",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="scene",
+            unique_together={("name", "user")},
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.1 on 2026-10-19 08:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("light_app", "0006_scenes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PollerWorker",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=200, unique=True)),
+                ("last_seen", models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1.1 on 2026-10-19 08:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("light_app", "0007_poller_workers"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LightStateEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "state",
+                    models.IntegerField(
+                        choices=[(1, "on"), (2, "off"), (3, "timer")]
+                    ),
+                ),
+                ("time", models.FloatField()),
+                (
+                    "light",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="state_events",
+                        to="light_app.light",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["light", "time"],
+                        name="light_event_light_time_idx",
+                    )
+                ],
+            },
+        ),
+    ]
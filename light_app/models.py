@@ -2,6 +2,8 @@ from django.db import models
 from django.contrib.auth.models import User
 import datetime
 
+from .dirty_fields import DirtyFieldsMixin
+
 # =============================================================================
 # Choices for light state (on, off, timer)
 STATE_CHOICES = [
@@ -32,7 +34,7 @@ class Choice(models.Model):
 # =============================================================================
 
 
-class Room(models.Model):
+class Room(DirtyFieldsMixin, models.Model):
     """
     A model representing a room owned by a specific user.
 
@@ -50,11 +52,16 @@ class Room(models.Model):
     class Meta:
         ordering = ["name"]
         unique_together = ("name", "user")
+        indexes = [
+            # Keyset pagination of a user's rooms on (name, id)
+            models.Index(fields=["user", "name", "id"],
+                         name="room_user_name_id_idx"),
+        ]
 
 # =============================================================================
 
 
-class Light(models.Model):
+class Light(DirtyFieldsMixin, models.Model):
     """
     A model to represent a light in a room. Each light is associated with a 
     room and can have a state.
@@ -79,11 +86,74 @@ class Light(models.Model):
 
     class Meta:
         ordering = ["id"]
+        indexes = [
+            # Keyset pagination of a room's lights on (name, id)
+            models.Index(fields=["room", "name", "id"],
+                         name="light_room_name_id_idx"),
+        ]
+
+# =============================================================================
+
+
+class Scene(models.Model):
+    """
+    A named set of lights, each with the state it takes when the scene is
+    activated (e.g. "Movie night").
+
+    Fields:
+    - name: Name of the scene.
+    - user: A foreign key referencing the user who owns the scene.
+    - lights: Many-to-many relationship with the Light model, through
+    SceneLight which holds the state of each light.
+    - members: Denormalized membership, precomputed from SceneLight (see
+    `scenes.refresh_scene_members`): a [light id, room name, light name,
+    state] list per light, so activating the scene needs no join.
+    """
+
+    name = models.CharField(max_length=100)
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="scenes")
+    lights = models.ManyToManyField(
+        Light, through="SceneLight", related_name="scenes", blank=True)
+    members = models.JSONField(default=list, editable=False)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        ordering = ["name"]
+        unique_together = ("name", "user")
+
+# =============================================================================
+
+
+class SceneLight(models.Model):
+    """
+    The state a light takes in a scene.
+
+    Fields:
+    - scene: Foreign key to the Scene model.
+    - light: Foreign key to the Light model.
+    - state: State of the light in the scene, chosen from STATE_CHOICES.
+    """
+
+    scene = models.ForeignKey(
+        Scene, on_delete=models.CASCADE, related_name="entries")
+    light = models.ForeignKey(
+        Light, on_delete=models.CASCADE, related_name="scene_entries")
+    state = models.IntegerField(choices=STATE_CHOICES, default=1)
+
+    def __str__(self):
+        return f"{self.light} {self.get_state_display()} in {self.scene}"
+
+    class Meta:
+        ordering = ["id"]
+        unique_together = ("scene", "light")
 
 # =============================================================================
 
 
-class UserSettings(models.Model):
+class UserSettings(DirtyFieldsMixin, models.Model):
     """
     A model to store user-specific settings, including notification
       preferences, theme, and more.
@@ -108,6 +178,8 @@ class UserSettings(models.Model):
     - silence_mode: Boolean to enable or disable silence mode.
     - test_mode: Boolean to indicate if the user is in test mode.
     - m5core2_ip: IP address for the M5Core2 device.
+    - always_poll: Boolean to keep checking the device even when the user
+    has no recent activity.
     """
 
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -139,6 +211,11 @@ class UserSettings(models.Model):
     test_mode = models.BooleanField(default=True)
     # User's M5Core2 IP address
     m5core2_ip = models.CharField(max_length=100, blank=True, default="")
+    # Keep checking the device while the user is away from the site
+    always_poll = models.BooleanField(
+        default=False,
+        help_text="Check the device status even when the user is inactive.",
+    )
 
     def save(self, *args, **kwargs):
         """
@@ -153,3 +230,54 @@ class UserSettings(models.Model):
 
     def __str__(self):
         return f"{self.user.username} Settings"
+
+# =============================================================================
+
+
+class PollerWorker(models.Model):
+    """
+    A background poller worker taking part in the sharded polling of the
+    devices, when the membership is kept in the database (see
+    `sharding.py`).
+
+    Fields:
+    - name: Unique name of the worker (host and process ID by default).
+    - last_seen: Last time the worker renewed its membership.
+    """
+
+    name = models.CharField(max_length=200, unique=True)
+    last_seen = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.name
+
+# =============================================================================
+
+
+class LightStateEvent(models.Model):
+    """
+    An append-only log entry recording that a light was switched, written
+    in batches by `light_events.LightEventLog` and aggregated by `usage.py`.
+
+    Fields:
+    - light: The light that was switched.
+    - state: The state it was set to (see STATE_CHOICES).
+    - time: UNIX time of the change, kept as a number so months of events
+    are extracted without converting each one to a datetime.
+    """
+
+    light = models.ForeignKey(Light, on_delete=models.CASCADE,
+                              related_name="state_events", db_index=False)
+    state = models.IntegerField(choices=STATE_CHOICES)
+    time = models.FloatField()
+
+    def __str__(self):
+        return f"{self.light_id} {self.get_state_display()} at {self.time}"
+
+    class Meta:
+        indexes = [
+            # Per-light history in time order, and the state of each light
+            # at the start of a report
+            models.Index(fields=["light", "time"],
+                         name="light_event_light_time_idx"),
+        ]
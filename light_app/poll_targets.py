@@ -0,0 +1,242 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from .db_router import replica_alias
+from .models import UserSettings
+
+# Snapshot of the user settings the poller needs to probe one device
+PollTarget = namedtuple(
+    "PollTarget",
+    ["user_id", "m5core2_ip", "server_check_interval", "test_mode",
+     "always_poll"],
+)
+
+# Seconds between two publications of a user's activity in the shared
+# cache by the same process; much shorter than the activity window
+ACTIVITY_SHARE_INTERVAL = 60
+# Seconds between two reads of the activity other processes published
+ACTIVITY_SYNC_INTERVAL = 5
+
+
+def activity_key(user_id):
+    """Returns the shared cache key of a user's last request time."""
+    return f"poll_activity:{user_id}"
+
+
+def has_device(user_settings):
+    """
+    Tells whether the poller has anything to probe for a user.
+
+    Args:
+        user_settings (UserSettings): The settings of the user.
+
+    Returns:
+        bool: True if the user is in test mode or has an M5Core2 IP set.
+    """
+    return user_settings.test_mode or bool(user_settings.m5core2_ip)
+
+
+class PollTargetIndex:
+    """
+    In-memory index of the users whose devices the poller may probe.
+
+    The index is loaded with a single query the first time it is used and is
+    then kept in sync incrementally by the `UserSettings` save/delete signal
+    receivers, so the poller never rescans the user table; it is reloaded
+    every `reload_interval` seconds for the changes made by other
+    processes (sharded pollers run on other nodes than the web workers).
+    Of the indexed users, only those who opted in with `always_poll` or
+    who were active within the last `activity_window` seconds are returned
+    as due.
+
+    Activity is recorded in process memory and published in the shared
+    cache (at most once a minute per user and process), where the poller
+    looks up the users it didn't see itself, so a home is probed by the
+    worker owning it whichever worker served its user.
+
+    Attributes:
+        activity_window (int): Seconds a user counts as active after their
+          last request.
+        reload_interval (float): Seconds between two reloads of the index.
+    """
+
+    def __init__(self, activity_window=None, reload_interval=None):
+        """
+        Initialize an empty index.
+
+        Args:
+            activity_window (int, optional): Defaults to the
+              `POLL_ACTIVITY_WINDOW` setting.
+            reload_interval (float, optional): Defaults to the
+              `POLL_TARGETS_RELOAD_INTERVAL` setting.
+        """
+        if activity_window is None:
+            activity_window = getattr(settings, "POLL_ACTIVITY_WINDOW", 900)
+        if reload_interval is None:
+            reload_interval = getattr(
+                settings, "POLL_TARGETS_RELOAD_INTERVAL", 60)
+        self.activity_window = activity_window
+        self.reload_interval = reload_interval
+        self._targets = {}
+        self._last_seen = {}
+        # Last time this process published each user's activity
+        self._shared_at = {}
+        self._loaded_at = None
+        self._synced_at = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        (Re)load the index with one query over the users with a device.
+
+        The user's `last_login` seeds their activity so homes of users who
+        signed in recently are probed right after a restart. The scan reads
+        from a replica, if any: the signals keep the index current after.
+        """
+        queryset = (
+            UserSettings.objects.using(replica_alias())
+            .select_related("user")
+            .filter(user__is_active=True)
+            .filter(Q(test_mode=True) | ~Q(m5core2_ip=""))
+        )
+        targets = {}
+        last_seen = {}
+        for user_settings in queryset:
+            targets[user_settings.user_id] = self._snapshot(user_settings)
+            if user_settings.user.last_login:
+                last_seen[user_settings.user_id] = (
+                    user_settings.user.last_login.timestamp()
+                )
+
+        with self._lock:
+            self._targets = targets
+            for user_id, seen in last_seen.items():
+                if seen > self._last_seen.get(user_id, 0):
+                    self._last_seen[user_id] = seen
+            self._loaded_at = time.monotonic()
+
+    def update(self, user_settings):
+        """
+        Add, refresh or drop the entry for one user after a settings change.
+
+        Args:
+            user_settings (UserSettings): The saved settings instance.
+        """
+        with self._lock:
+            if self._loaded_at is None:
+                # The initial load will pick the change up
+                return
+            if has_device(user_settings):
+                self._targets[user_settings.user_id] = self._snapshot(
+                    user_settings)
+            else:
+                self._targets.pop(user_settings.user_id, None)
+
+    def remove(self, user_id):
+        """
+        Drop a user from the index.
+
+        Args:
+            user_id (int): The ID of the user to remove.
+        """
+        with self._lock:
+            self._targets.pop(user_id, None)
+            self._last_seen.pop(user_id, None)
+            self._shared_at.pop(user_id, None)
+
+    def mark_active(self, user_id):
+        """
+        Record that a user just made a request.
+
+        Args:
+            user_id (int): The ID of the active user.
+        """
+        now = self._seen(user_id)
+        if now is not None:
+            cache.set(activity_key(user_id), now, self.activity_window)
+
+    async def amark_active(self, user_id):
+        """Async version of `mark_active`."""
+        now = self._seen(user_id)
+        if now is not None:
+            await cache.aset(activity_key(user_id), now,
+                             self.activity_window)
+
+    def _seen(self, user_id):
+        """
+        Records a request locally.
+
+        Returns:
+            float or None: Its time, if it should be published.
+        """
+        now = time.time()
+        self._last_seen[user_id] = now
+        if now - self._shared_at.get(user_id, 0) < ACTIVITY_SHARE_INTERVAL:
+            return None
+        self._shared_at[user_id] = now
+        return now
+
+    def due_targets(self, owns=None):
+        """
+        Return the targets the poller should probe right now.
+
+        Args:
+            owns (callable, optional): Tells whether a user ID belongs to
+              this poller's shard; other users are left out.
+
+        Returns:
+            list[PollTarget]: Targets of users who opted in with
+            `always_poll` or were active within `activity_window` seconds.
+        """
+        if (self._loaded_at is None or time.monotonic() - self._loaded_at
+                > self.reload_interval):
+            self.load()
+
+        cutoff = time.time() - self.activity_window
+        with self._lock:
+            targets = [target for target in self._targets.values()
+                       if owns is None or owns(target.user_id)]
+        if time.monotonic() - self._synced_at > ACTIVITY_SYNC_INTERVAL:
+            self._sync_activity(
+                [target.user_id for target in targets
+                 if not target.always_poll
+                 and self._last_seen.get(target.user_id, 0) < cutoff])
+        return [
+            target for target in targets
+            if target.always_poll
+            or self._last_seen.get(target.user_id, 0) >= cutoff
+        ]
+
+    def _sync_activity(self, user_ids):
+        """Reads the activity other processes published for some users."""
+        self._synced_at = time.monotonic()
+        if not user_ids:
+            return
+        shared = cache.get_many([activity_key(user_id)
+                                 for user_id in user_ids])
+        for user_id in user_ids:
+            seen = shared.get(activity_key(user_id))
+            if seen is not None and seen > self._last_seen.get(user_id, 0):
+                self._last_seen[user_id] = seen
+
+    def __len__(self):
+        return len(self._targets)
+
+    @staticmethod
+    def _snapshot(user_settings):
+        return PollTarget(
+            user_id=user_settings.user_id,
+            m5core2_ip=user_settings.m5core2_ip,
+            server_check_interval=user_settings.server_check_interval,
+            test_mode=user_settings.test_mode,
+            always_poll=user_settings.always_poll,
+        )
+
+
+# Shared index used by the background poller
+poll_targets = PollTargetIndex()
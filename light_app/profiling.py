@@ -0,0 +1,251 @@
+import cProfile
+import io
+import pstats
+import threading
+from collections import deque
+from contextvars import ContextVar
+from time import perf_counter
+
+from django.conf import settings
+
+# Seconds spent in device HTTP calls by the current request, when profiled
+_external_time = ContextVar("external_time", default=None)
+
+# Wall-clock spans (kind, label, start, seconds) of the current request,
+# when sampled in an async view, see `start_timeline`
+_timeline = ContextVar("profile_timeline", default=None)
+
+# cProfile can only run one profiler at a time, see `try_profile`
+_profile_lock = threading.Lock()
+
+# Longest label shown in a timeline, e.g. an SQL statement
+MAX_LABEL_LENGTH = 100
+
+
+def start_external_timer():
+    """
+    Start accounting the time the current request spends in device calls.
+
+    Returns:
+        tuple: The accumulator and the token to pass to
+        `stop_external_timer`.
+    """
+    accumulator = [0.0]
+    return accumulator, _external_time.set(accumulator)
+
+
+def stop_external_timer(token):
+    """Stop the accounting started by `start_external_timer`."""
+    _external_time.reset(token)
+
+
+def record_external_time(seconds, label="device call"):
+    """
+    Add the duration of one outbound device request to the current
+    request's external HTTP time. Does nothing outside a profiled request.
+
+    Args:
+        seconds (float): The duration of the device request.
+        label (str): The request, for the timeline of a sampled request.
+    """
+    accumulator = _external_time.get()
+    if accumulator is not None:
+        accumulator[0] += seconds
+    record_span("device", label, seconds)
+
+
+def start_timeline():
+    """
+    Start recording the wall-clock spans (queries and device calls) of the
+    current request.
+
+    cProfile can't attribute time to one coroutine, so this is how the
+    sampled requests of async views are broken down instead.
+
+    Returns:
+        tuple: The span list and the token to pass to `stop_timeline`.
+    """
+    spans = []
+    return spans, _timeline.set(spans)
+
+
+def stop_timeline(token):
+    """Stop the recording started by `start_timeline`."""
+    _timeline.reset(token)
+
+
+def record_span(kind, label, seconds):
+    """
+    Add a span that just ended to the current request's timeline. Does
+    nothing outside a sampled async request.
+
+    Args:
+        kind (str): "query" or "device".
+        label (str): What ran, e.g. the SQL statement.
+        seconds (float): Its duration.
+    """
+    spans = _timeline.get()
+    if spans is not None:
+        spans.append((kind, label, perf_counter() - seconds, seconds))
+
+
+def format_timeline(spans, start, wall):
+    """
+    Format the spans of a request in start order, with their offsets from
+    the start of the request.
+
+    Spans may overlap (concurrent device calls), and the time outside of
+    them is spent in the view's own code or waiting on the event loop.
+
+    Args:
+        spans (list): The spans recorded by `start_timeline`.
+        start (float): `perf_counter()` at the start of the request.
+        wall (float): Wall time of the request in seconds.
+
+    Returns:
+        str: One line per span, after a summary line.
+    """
+    covered, end = 0.0, start
+    for _, _, span_start, seconds in sorted(spans, key=lambda s: s[2]):
+        # Length of the union of the spans
+        covered += max(0.0, span_start + seconds - max(span_start, end))
+        end = max(end, span_start + seconds)
+    lines = [
+        f"Async view, wall-clock spans: {len(spans)} spans covering "
+        f"{covered * 1000:.1f} of {wall * 1000:.1f} ms",
+        f"{'offset ms':>10} {'ms':>9}  kind    label",
+    ]
+    for kind, label, span_start, seconds in sorted(
+            spans, key=lambda s: s[2]):
+        lines.append(
+            f"{(span_start - start) * 1000:>10.1f} {seconds * 1000:>9.1f}  "
+            f"{kind:<7} {label[:MAX_LABEL_LENGTH]}")
+    return "\n".join(lines)
+
+
+class ProfileStore:
+    """
+    Per-view request statistics and a ring buffer of slow request samples.
+
+    Attributes:
+        samples (deque): The most recent slow request samples, newest last.
+        stats (dict): Aggregated timings per URL name.
+    """
+
+    def __init__(self, size=None):
+        """
+        Initialize an empty store.
+
+        Args:
+            size (int, optional): Number of samples kept. Defaults to the
+              `PROFILING_BUFFER_SIZE` setting.
+        """
+        if size is None:
+            size = getattr(settings, "PROFILING_BUFFER_SIZE", 50)
+        self.samples = deque(maxlen=size)
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, view, wall, queries, query_time, external_time):
+        """
+        Add one request to the per-view statistics.
+
+        Args:
+            view (str): The URL name of the view.
+            wall (float): Wall time of the request in seconds.
+            queries (int): Number of ORM queries.
+            query_time (float): Time spent in ORM queries in seconds.
+            external_time (float): Time spent in device calls in seconds.
+        """
+        with self._lock:
+            entry = self.stats.setdefault(view, {
+                "view": view, "requests": 0, "wall": 0.0, "max_wall": 0.0,
+                "queries": 0, "query_time": 0.0, "external_time": 0.0,
+            })
+            entry["requests"] += 1
+            entry["wall"] += wall
+            entry["max_wall"] = max(entry["max_wall"], wall)
+            entry["queries"] += queries
+            entry["query_time"] += query_time
+            entry["external_time"] += external_time
+
+    def add_sample(self, sample):
+        """
+        Append a slow request sample, evicting the oldest when full.
+
+        Args:
+            sample (dict): The request details and its profile stack.
+        """
+        self.samples.append(sample)
+
+    def view_stats(self):
+        """
+        Return the per-view statistics with averages, slowest first.
+
+        Returns:
+            list[dict]: One entry per URL name.
+        """
+        with self._lock:
+            entries = [dict(entry) for entry in self.stats.values()]
+        for entry in entries:
+            count = entry["requests"]
+            entry["avg_wall_ms"] = entry["wall"] * 1000 / count
+            entry["avg_queries"] = entry["queries"] / count
+            entry["avg_query_ms"] = entry["query_time"] * 1000 / count
+            entry["avg_external_ms"] = entry["external_time"] * 1000 / count
+            entry["max_wall_ms"] = entry["max_wall"] * 1000
+        return sorted(entries, key=lambda e: e["avg_wall_ms"], reverse=True)
+
+
+def try_profile():
+    """
+    Start a cProfile profiler if none is running in this process.
+
+    Returns:
+        cProfile.Profile or None: The running profiler, or None if another
+        request is already being profiled.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiling tool is active (e.g. a debugger)
+        _profile_lock.release()
+        return None
+    return profiler
+
+
+def stop_profile(profiler):
+    """
+    Stop a profiler started by `try_profile`, letting another one start.
+
+    Args:
+        profiler (cProfile.Profile): The running profiler.
+    """
+    try:
+        profiler.disable()
+    finally:
+        _profile_lock.release()
+
+
+def format_profile(profiler, limit=30):
+    """
+    Format the hottest stacks of a profiler stopped by `stop_profile`.
+
+    Args:
+        profiler (cProfile.Profile): The stopped profiler.
+        limit (int): Number of functions to include.
+
+    Returns:
+        str: The profile sorted by cumulative time.
+    """
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats(
+        "cumulative").print_stats(limit)
+    return output.getvalue()
+
+
+# Store shared by the profiling middleware and the admin page
+profile_store = ProfileStore()
@@ -0,0 +1,60 @@
+from contextvars import ContextVar
+from time import perf_counter
+
+from django.db.backends.signals import connection_created
+
+from .profiling import record_span
+
+# Accumulators ([query count, seconds]) of the scopes the current request
+# or task is running in, innermost last
+_scopes = ContextVar("query_stats_scopes", default=())
+
+
+def _record_query(execute, sql, params, many, context):
+    """Database execute wrapper adding each query to the active scopes."""
+    scopes = _scopes.get()
+    if not scopes:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = perf_counter() - start
+        for stats in scopes:
+            stats[0] += 1
+            stats[1] += elapsed
+        record_span("query", sql, elapsed)
+
+
+def install_wrapper(sender, connection, **kwargs):
+    """
+    Signal receiver installing the query recorder on every new database
+    connection.
+
+    Unlike `connection.execute_wrapper()`, which only covers the calling
+    thread, this also counts the queries async views run through
+    `sync_to_async`, since the scopes live in a context variable that is
+    carried over to the worker thread.
+    """
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(install_wrapper)
+
+
+def start_query_stats():
+    """
+    Start counting the queries of the current request or task.
+
+    Returns:
+        tuple: The `[count, seconds]` accumulator and the token to pass to
+        `stop_query_stats`.
+    """
+    stats = [0, 0.0]
+    return stats, _scopes.set(_scopes.get() + (stats,))
+
+
+def stop_query_stats(token):
+    """Stop the counting started by `start_query_stats`."""
+    _scopes.reset(token)
@@ -0,0 +1,118 @@
+import threading
+from time import monotonic
+
+from django.conf import settings
+
+from .metrics import DEVICE_QUEUE_DEPTH, DEVICE_COMMANDS_REJECTED
+
+
+class DeviceBusy(Exception):
+    """Raised when a device's command queue is full."""
+
+
+class _Bucket:
+    """Rate limiting state of one device."""
+
+    __slots__ = ("theoretical_arrival", "queued")
+
+    def __init__(self):
+        # Time at which the bucket is full again (GCRA)
+        self.theoretical_arrival = 0.0
+        # Commands waiting for their slot
+        self.queued = 0
+
+
+class DeviceRateLimiter:
+    """
+    Per-device token bucket with a small ordered queue.
+
+    Each device accepts `burst` commands at once, then `rate` commands per
+    second. A command arriving when the bucket is empty is given the next
+    free slot and waits for it, so bursts are smoothed out in arrival
+    order instead of piling up on the device; when `queue_size` commands
+    are already waiting, it is rejected with `DeviceBusy`. Callers that
+    can't wait without holding a thread (sync code) are rejected at once
+    instead of queued.
+
+    The bucket is implemented as a generic cell rate algorithm: a single
+    "theoretical arrival time" per device, updated under a lock, which
+    hands out the slots in arrival order.
+
+    Attributes:
+        rate (float): Sustained commands per second per device.
+        burst (int): Commands a device accepts back to back.
+        queue_size (int): Commands allowed to wait for a slot per device.
+    """
+
+    def __init__(self, rate=None, burst=None, queue_size=None):
+        self.rate = rate if rate is not None else getattr(
+            settings, "DEVICE_RATE_LIMIT", 5.0)
+        self.burst = burst if burst is not None else getattr(
+            settings, "DEVICE_RATE_BURST", 3)
+        self.queue_size = queue_size if queue_size is not None else getattr(
+            settings, "DEVICE_QUEUE_SIZE", 8)
+        self._buckets = {}
+        self._queued = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, address, command, queue=True):
+        """
+        Reserves the next slot of a device.
+
+        Args:
+            address (str): The device address.
+            command (str): Metric label of the command.
+            queue (bool): Whether the command may wait for a later slot;
+              if not, it is rejected unless a slot is free now.
+
+        Returns:
+            float: Seconds to wait before sending the command; when
+            positive, `release()` must be called once waited.
+
+        Raises:
+            DeviceBusy: If the device's queue is full, or no slot is free
+            now and `queue` is False.
+        """
+        if not self.rate:
+            return 0.0
+        interval = 1 / self.rate
+        tolerance = (self.burst - 1) * interval
+        now = monotonic()
+        with self._lock:
+            bucket = self._buckets.get(address)
+            if bucket is None:
+                bucket = self._buckets[address] = _Bucket()
+            start = max(now, bucket.theoretical_arrival - tolerance)
+            delay = start - now
+            if delay > 0:
+                if not queue or bucket.queued >= self.queue_size:
+                    DEVICE_COMMANDS_REJECTED.inc(command=command)
+                    raise DeviceBusy(
+                        f"Device {address} is busy, try again later.")
+                bucket.queued += 1
+                self._queued += 1
+                DEVICE_QUEUE_DEPTH.set(self._queued)
+            bucket.theoretical_arrival = (
+                max(bucket.theoretical_arrival, start) + interval)
+        return delay
+
+    def release(self, address):
+        """
+        Leaves a device's queue once the slot returned by `reserve()` is
+        reached.
+
+        Args:
+            address (str): The device address.
+        """
+        with self._lock:
+            bucket = self._buckets[address]
+            bucket.queued -= 1
+            self._queued -= 1
+            DEVICE_QUEUE_DEPTH.set(self._queued)
+            if not bucket.queued and (
+                    bucket.theoretical_arrival < monotonic()):
+                # Idle device, don't keep its state around
+                del self._buckets[address]
+
+
+limiter = DeviceRateLimiter()
@@ -0,0 +1,296 @@
+import base64
+import binascii
+import json
+
+from asgiref.sync import sync_to_async
+from django.db.models import F, Q
+
+from .models import Room, Light, STATE_CHOICES
+
+# Page size of the JSON room/light API, and the largest one allowed
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Rooms fetched per batch when streaming a whole house as NDJSON
+STREAM_BATCH_SIZE = 200
+
+# Fields clients can select with "fields[rooms]" and "fields[lights]"
+ROOM_FIELDS = ("id", "name", "lights")
+LIGHT_FIELDS = ("id", "name", "room", "room_id", "state", "description")
+DEFAULT_LIGHT_FIELDS = ("id", "name", "state")
+
+STATE_NAMES = dict(STATE_CHOICES)
+
+
+class InvalidQuery(ValueError):
+    """Raised for malformed API query parameters (cursor, fields...)."""
+
+
+def encode_cursor(name, pk):
+    """
+    Encodes the position after a row as an opaque cursor.
+
+    Args:
+        name (str): The name of the last row of a page.
+        pk (int): The ID of the last row of a page.
+
+    Returns:
+        str: The URL safe cursor.
+    """
+    raw = json.dumps([name, pk], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor made by `encode_cursor`.
+
+    Args:
+        cursor (str): The cursor sent by the client.
+
+    Returns:
+        tuple: The (name, id) position.
+
+    Raises:
+        InvalidQuery: If the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        name, pk = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise InvalidQuery("Invalid cursor.") from e
+    if not isinstance(name, str) or not isinstance(pk, int):
+        raise InvalidQuery("Invalid cursor.")
+    return name, pk
+
+
+def after(queryset, cursor):
+    """
+    Filters a queryset ordered by (name, id) to the rows after a cursor.
+
+    The row comparison is spelled out as `name > x OR (name = x AND id > y)`
+    so it works on every backend and can use an index on (..., name, id).
+
+    Args:
+        queryset (QuerySet): The queryset to filter.
+        cursor (str or None): The cursor, None for the first page.
+
+    Returns:
+        QuerySet: The filtered queryset.
+    """
+    if not cursor:
+        return queryset
+    name, pk = decode_cursor(cursor)
+    return queryset.filter(Q(name__gt=name) | Q(name=name, id__gt=pk))
+
+
+def parse_limit(value):
+    """
+    Parses the "limit" query parameter.
+
+    Args:
+        value (str or None): The raw parameter.
+
+    Returns:
+        int: The page size, capped to MAX_PAGE_SIZE.
+
+    Raises:
+        InvalidQuery: If the value isn't a positive integer.
+    """
+    if not value:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise InvalidQuery("limit must be an integer.") from None
+    if limit < 1:
+        raise InvalidQuery("limit must be positive.")
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def parse_fields(value, allowed, default):
+    """
+    Parses a sparse fieldset parameter such as "fields[lights]=name,state".
+
+    Args:
+        value (str or None): The raw parameter.
+        allowed (tuple): The selectable fields.
+        default (tuple): The fields returned when the parameter is absent.
+
+    Returns:
+        tuple: The selected fields, in the requested order.
+
+    Raises:
+        InvalidQuery: If an unknown field is requested.
+    """
+    if value is None:
+        return default
+    fields = tuple(field for field in value.split(",") if field)
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise InvalidQuery(
+            f"Unknown fields {', '.join(unknown)}; "
+            f"choose from {', '.join(allowed)}.")
+    return fields
+
+
+def light_columns(fields):
+    """Returns the columns to load for the selected light fields."""
+    columns = {"id", "name"}
+    for field in fields:
+        if field == "room":
+            columns.add("room_name")
+        elif field in ("room_id", "state", "description"):
+            columns.add(field)
+    return columns
+
+
+def serialize_light(row, fields):
+    """
+    Builds the JSON object of a light from its `values()` row.
+
+    Args:
+        row (dict): The light's row.
+        fields (tuple): The selected fields.
+
+    Returns:
+        dict: The light, limited to the selected fields.
+    """
+    data = {}
+    for field in fields:
+        if field == "room":
+            data["room"] = row["room_name"]
+        elif field == "state":
+            data["state"] = STATE_NAMES.get(row["state"])
+        else:
+            data[field] = row[field]
+    return data
+
+
+def light_rows(queryset, fields):
+    """Returns the `values()` queryset loading the selected light fields."""
+    if "room" in fields:
+        queryset = queryset.annotate(room_name=F("room__name"))
+    return queryset.values(*light_columns(fields))
+
+
+def room_page(user, cursor, limit, room_fields, light_fields):
+    """
+    Loads one page of a user's rooms, with their lights, in two queries and
+    without counting the rooms.
+
+    Args:
+        user (User): The owner of the rooms.
+        cursor (str or None): The cursor of the page, None for the first.
+        limit (int): The page size.
+        room_fields (tuple): The selected room fields.
+        light_fields (tuple): The selected fields of the nested lights.
+
+    Returns:
+        tuple: The serialized rooms and the cursor of the next page, None
+        on the last page.
+
+    Raises:
+        InvalidQuery: If the cursor is malformed.
+    """
+    rooms = list(
+        after(Room.objects.filter(user=user), cursor)
+        .order_by("name", "id").values("id", "name")[:limit + 1]
+    )
+    next_cursor = None
+    if len(rooms) > limit:
+        rooms = rooms[:limit]
+        next_cursor = encode_cursor(rooms[-1]["name"], rooms[-1]["id"])
+    return serialize_rooms(rooms, room_fields, light_fields), next_cursor
+
+
+def serialize_rooms(rooms, room_fields, light_fields):
+    """
+    Serializes room rows, loading the lights of all of them in one query
+    when they are selected.
+
+    Args:
+        rooms (list[dict]): The rooms' `values()` rows.
+        room_fields (tuple): The selected room fields.
+        light_fields (tuple): The selected fields of the nested lights.
+
+    Returns:
+        list[dict]: The serialized rooms.
+    """
+    lights_by_room = {}
+    if "lights" in room_fields and rooms:
+        lights = Light.objects.filter(room_id__in=[r["id"] for r in rooms])
+        for row in light_rows(lights.order_by("name", "id"),
+                              light_fields + ("room_id",)):
+            lights_by_room.setdefault(row["room_id"], []).append(
+                serialize_light(row, light_fields))
+
+    results = []
+    for room in rooms:
+        data = {}
+        for field in room_fields:
+            if field == "lights":
+                data["lights"] = lights_by_room.get(room["id"], [])
+            else:
+                data[field] = room[field]
+        results.append(data)
+    return results
+
+
+def light_page(user, cursor, limit, fields, room_id=None):
+    """
+    Loads one page of a user's lights, across all rooms or in one room,
+    ordered by (name, id), without counting them.
+
+    Args:
+        user (User): The owner of the lights.
+        cursor (str or None): The cursor of the page, None for the first.
+        limit (int): The page size.
+        fields (tuple): The selected light fields.
+        room_id (int, optional): Only return the lights of this room.
+
+    Returns:
+        tuple: The serialized lights and the cursor of the next page, None
+        on the last page.
+
+    Raises:
+        InvalidQuery: If the cursor is malformed.
+    """
+    lights = Light.objects.filter(room__user=user)
+    if room_id is not None:
+        lights = lights.filter(room_id=room_id)
+    rows = list(light_rows(after(lights, cursor).order_by("name", "id"),
+                           fields)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["name"], rows[-1]["id"])
+    return [serialize_light(row, fields) for row in rows], next_cursor
+
+
+async def astream_house(user, room_fields, light_fields):
+    """
+    Yields a user's whole house as NDJSON, one room per line.
+
+    Rooms are read in keyset batches of STREAM_BATCH_SIZE, so memory stays
+    flat and no long-lived database cursor is held between batches. The
+    generator is asynchronous, each batch being read in a worker thread,
+    so under ASGI the response is streamed as it is read, rather than
+    consumed whole by Django before the first byte is sent.
+
+    Args:
+        user (User): The owner of the house.
+        room_fields (tuple): The selected room fields.
+        light_fields (tuple): The selected fields of the nested lights.
+
+    Yields:
+        str: One JSON encoded room followed by a newline.
+    """
+    cursor = None
+    while True:
+        rooms, cursor = await sync_to_async(room_page)(
+            user, cursor, STREAM_BATCH_SIZE, room_fields, light_fields)
+        for room in rooms:
+            yield json.dumps(room) + "\n"
+        if cursor is None:
+            return
@@ -0,0 +1,8 @@
+from django.urls import path
+
+from . import consumers
+
+websocket_urlpatterns = [
+    # Persistent command channel opened by the users' devices
+    path("ws/device/", consumers.DeviceConsumer.as_asgi()),
+]
@@ -0,0 +1,145 @@
+from django.db import transaction
+
+from .device_client import adevice_command
+from .house_io import invalidate_house_caches
+from .light_events import light_events
+from .models import Light, Scene, SceneLight, STATE_CHOICES
+
+STATE_NAMES = dict(STATE_CHOICES)
+
+# Device endpoint applying several light commands in one request
+BATCH_PATH = "/control_batch"
+
+
+def scene_members(scene_ids):
+    """
+    Computes the denormalized membership of scenes from their entries.
+
+    Args:
+        scene_ids (iterable): The IDs of the scenes.
+
+    Returns:
+        dict: A [light id, room name, light name, state] list per light,
+        in room and light name order, by scene ID.
+    """
+    members = {scene_id: [] for scene_id in scene_ids}
+    entries = SceneLight.objects.filter(scene_id__in=members).order_by(
+        "light__room__name", "light__name", "light_id")
+    for scene_id, *member in entries.values_list(
+            "scene_id", "light_id", "light__room__name", "light__name",
+            "state"):
+        members[scene_id].append(member)
+    return members
+
+
+def refresh_scene_members(scene_ids):
+    """
+    Recomputes the denormalized membership of scenes, in two queries.
+
+    Args:
+        scene_ids (iterable): The IDs of the scenes.
+    """
+    members = scene_members(set(scene_ids))
+    if members:
+        Scene.objects.bulk_update(
+            [Scene(id=scene_id, members=lights)
+             for scene_id, lights in members.items()],
+            ["members"],
+        )
+
+
+def capture_scene(user, name, light_ids=None):
+    """
+    Saves the current state of a user's lights as a scene, replacing the
+    scene's lights if it already exists.
+
+    Args:
+        user (User): The owner of the scene.
+        name (str): The name of the scene.
+        light_ids (iterable, optional): The lights to include. Defaults to
+          all the user's lights.
+
+    Returns:
+        Scene: The saved scene, with its membership precomputed.
+    """
+    lights = Light.objects.filter(room__user=user)
+    if light_ids is not None:
+        lights = lights.filter(id__in=light_ids)
+    with transaction.atomic():
+        scene, created = Scene.objects.get_or_create(user=user, name=name)
+        states = dict(lights.values_list("id", "state"))
+        if not created:
+            scene.entries.exclude(light_id__in=states).delete()
+        # Upsert the entries without the per-row signals, the membership
+        # is refreshed once below
+        SceneLight.objects.bulk_create(
+            [SceneLight(scene=scene, light_id=light_id, state=state)
+             for light_id, state in states.items()],
+            update_conflicts=True,
+            unique_fields=["scene", "light"],
+            update_fields=["state"],
+        )
+        scene.members = scene_members([scene.id])[scene.id]
+        scene.save(update_fields=["members"])
+    return scene
+
+
+def batch_params(members):
+    """
+    Builds the query string of the device command applying a scene: one
+    room, light and action parameter per light, in order.
+
+    Args:
+        members (list): The denormalized membership of the scene.
+
+    Returns:
+        list[tuple]: The query string parameters.
+    """
+    params = []
+    for light_id, room_name, light_name, state in members:
+        params += [("room", room_name), ("light", light_name),
+                   ("action", STATE_NAMES.get(state, "off"))]
+    return params
+
+
+async def send_scene(scene, address):
+    """
+    Sends every light command of a scene to the device in one request, or
+    one frame if the device has its WebSocket open.
+
+    Args:
+        scene (Scene): The scene to activate.
+        address (str): The device IP address.
+
+    Returns:
+        httpx.Response or DeviceReply: The device's response.
+
+    Raises:
+        httpx.HTTPError: If the device can't be reached.
+        DeviceNotResponding: If the device doesn't acknowledge the frame.
+        DeviceBusy: If too many commands are already queued for the device.
+    """
+    return await adevice_command(scene.user_id, address, BATCH_PATH,
+                                 batch_params(scene.members),
+                                 command="scene")
+
+
+def apply_scene(scene):
+    """
+    Stores the states of a scene's lights, in a single UPDATE query.
+
+    `bulk_update` doesn't send model signals, so the caches are invalidated
+    and the state changes logged here.
+
+    Args:
+        scene (Scene): The activated scene.
+    """
+    Light.objects.bulk_update(
+        [Light(id=light_id, state=state)
+         for light_id, room_name, light_name, state in scene.members],
+        ["state"],
+    )
+    invalidate_house_caches(scene.user_id)
+    light_events.record_many(
+        (light_id, state)
+        for light_id, room_name, light_name, state in scene.members)
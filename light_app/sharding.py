@@ -0,0 +1,241 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import time
+from datetime import timedelta
+from time import monotonic
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .metrics import POLLER_MEMBERS
+from .models import PollerWorker
+
+logger = logging.getLogger("home_control.poller")
+
+# Points of each worker on the hash ring; more points spread the homes
+# more evenly
+RING_REPLICAS = 256
+
+
+def ring_hash(value):
+    """Returns the position of a value on the hash ring."""
+    digest = hashlib.md5(str(value).encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring assigning keys (user IDs) to members (workers).
+
+    Each member is placed at `replicas` pseudo-random points of the ring
+    and owns the keys hashed between its points and the previous ones, so
+    a member joining or leaving only moves about 1/N of the keys, from or
+    to its neighbours, instead of reshuffling them all.
+
+    Attributes:
+        members (list[str]): The members, sorted.
+    """
+
+    def __init__(self, members=(), replicas=RING_REPLICAS):
+        self.members = sorted(set(members))
+        points = sorted(
+            (ring_hash(f"{member}#{replica}"), member)
+            for member in self.members for replica in range(replicas)
+        )
+        self._hashes = [point for point, member in points]
+        self._owners = [member for point, member in points]
+
+    def owner(self, key):
+        """
+        Returns the member owning a key.
+
+        Args:
+            key (object): The key, e.g. a user ID.
+
+        Returns:
+            str or None: The owner, None if the ring is empty.
+        """
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, ring_hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+class DatabaseMembership:
+    """
+    Poller membership list kept in the `PollerWorker` table.
+
+    Attributes:
+        ttl (float): Seconds after which a worker that stopped renewing its
+          membership is considered dead.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def renew(self, name):
+        """Records that a worker is alive."""
+        PollerWorker.objects.update_or_create(
+            name=name, defaults={"last_seen": timezone.now()})
+
+    def members(self):
+        """Returns the names of the live workers, dropping the dead ones."""
+        cutoff = timezone.now() - timedelta(seconds=self.ttl)
+        PollerWorker.objects.filter(last_seen__lt=cutoff).delete()
+        return list(PollerWorker.objects.order_by("name").values_list(
+            "name", flat=True))
+
+    def leave(self, name):
+        """Removes a worker from the list."""
+        PollerWorker.objects.filter(name=name).delete()
+
+
+class RedisMembership:
+    """
+    Poller membership list kept in a Redis sorted set, scored by the time
+    each worker last renewed its membership. Needs the Redis cache backend
+    (REDIS_URL).
+
+    Attributes:
+        ttl (float): Seconds after which a worker that stopped renewing its
+          membership is considered dead.
+        key (str): The Redis key of the sorted set.
+    """
+
+    def __init__(self, ttl, key="poller:members", alias="default"):
+        self.ttl = ttl
+        self.key = key
+        self.alias = alias
+
+    @property
+    def client(self):
+        """The Redis client of the cache backend."""
+        return caches[self.alias]._cache.get_client(write=True)
+
+    def renew(self, name):
+        """Records that a worker is alive."""
+        self.client.zadd(self.key, {name: time.time()})
+
+    def members(self):
+        """Returns the names of the live workers, dropping the dead ones."""
+        client = self.client
+        client.zremrangebyscore(self.key, "-inf", time.time() - self.ttl)
+        return sorted(member.decode()
+                      for member in client.zrange(self.key, 0, -1))
+
+    def leave(self, name):
+        """Removes a worker from the list."""
+        self.client.zrem(self.key, name)
+
+
+def membership_from_settings():
+    """
+    Builds the membership list selected by the `POLLER_MEMBERSHIP` setting.
+
+    Returns:
+        DatabaseMembership or RedisMembership or None: None when the
+        poller isn't sharded.
+    """
+    backend = getattr(settings, "POLLER_MEMBERSHIP", "")
+    ttl = getattr(settings, "POLLER_MEMBERSHIP_TTL", 15)
+    if backend == "db":
+        return DatabaseMembership(ttl)
+    if backend == "redis":
+        return RedisMembership(ttl)
+    return None
+
+
+class PollerShard:
+    """
+    The share of the homes this process' poller probes when several
+    pollers cooperate.
+
+    Every worker renews its entry in a shared membership list (database or
+    Redis) every `refresh_interval` seconds and reads the list back; the
+    homes are partitioned over the live workers by consistent hashing of
+    the user IDs, so every worker computes the same partition, a home is
+    probed by exactly one worker, and a worker joining or dying moves only
+    its share of the homes. A dead worker's homes are taken over once its
+    entry expires; a joining worker waits one refresh interval before
+    polling, by which time the others have seen it and dropped its homes,
+    so no home is probed twice.
+
+    Without a membership list (`POLLER_MEMBERSHIP` unset) the process owns
+    every home.
+
+    Attributes:
+        membership: The shared membership list, or None.
+        name (str): The name of this worker.
+        refresh_interval (float): Seconds between two membership renewals.
+    """
+
+    def __init__(self, membership=None, name=None, refresh_interval=None):
+        self.membership = membership
+        self.name = name or getattr(settings, "POLLER_WORKER_NAME", "") or (
+            f"{socket.gethostname()}:{os.getpid()}")
+        self.refresh_interval = refresh_interval or getattr(
+            settings, "POLLER_MEMBERSHIP_INTERVAL", 5)
+        self.ring = HashRing([self.name])
+        self._joined_at = None
+        self._next_refresh = 0
+
+    @property
+    def enabled(self):
+        return self.membership is not None
+
+    def refresh(self, force=False):
+        """
+        Renews this worker's membership and rebuilds the ring if the live
+        workers changed, at most once per refresh interval.
+
+        Args:
+            force (bool): Refresh even if the interval hasn't elapsed.
+        """
+        now = monotonic()
+        if not self.enabled or (not force and now < self._next_refresh):
+            return
+        self.membership.renew(self.name)
+        members = self.membership.members()
+        if self.name not in members:
+            members.append(self.name)
+        if sorted(members) != self.ring.members:
+            logger.info(f"Poller shards rebalanced over {len(members)} "
+                        f"workers: {', '.join(sorted(members))}")
+            self.ring = HashRing(members)
+        POLLER_MEMBERS.set(len(members))
+        if self._joined_at is None:
+            self._joined_at = now
+        self._next_refresh = now + self.refresh_interval
+
+    def owns(self, user_id):
+        """
+        Tells whether this worker should probe a user's home.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            bool: True if the home belongs to this worker's shard.
+        """
+        if not self.enabled:
+            return True
+        if (self._joined_at is None
+                or monotonic() - self._joined_at < self.refresh_interval):
+            # Let the other workers see this one before taking homes over
+            return False
+        return self.ring.owner(user_id) == self.name
+
+    def leave(self):
+        """Hands this worker's homes over to the others right away."""
+        if self.enabled and self._joined_at is not None:
+            self.membership.leave(self.name)
+            self._joined_at = None
+            self._next_refresh = 0
+
+
+# Shard of this process' poller
+poller_shard = PollerShard(membership_from_settings())
@@ -1,7 +1,20 @@
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
 from django.contrib.auth.models import User
-from .models import UserSettings
+from .models import UserSettings, Room, Light, SceneLight
+from .fragment_cache import bump_room_list_version
+from .snapshots import (
+    invalidate_user_settings, invalidate_lights_snapshot, publish_home_status,
+)
+from .metrics import HOME_STATUS_TRANSITIONS
+from .poll_targets import poll_targets
+from .heartbeats import heartbeats
+from .light_events import light_events
+from .scenes import refresh_scene_members
+
+# Sent when the published online status of a user's home changes.
+# Arguments: user_id, online (bool), previous (bool or None).
+home_status_changed = Signal()
 
 
 @receiver(post_save, sender=User)
@@ -35,6 +48,178 @@ def save_user_settings(sender, instance, **kwargs):
     - **kwargs: Additional keyword arguments.
 
     This function ensures that any changes to the User instance are reflected 
-    in the corresponding UserSettings object.
+    in the corresponding UserSettings object. Only settings loaded through
+    this User instance can have unsaved changes, and only the changed
+    fields are written (see DirtyFieldsMixin): saving a User, e.g. on each
+    login, doesn't query or write the settings otherwise.
+    """
+    if User.usersettings.related.is_cached(instance):
+        instance.usersettings.save()
+
+
+@receiver(post_save, sender=UserSettings)
+def update_poll_target(sender, instance, **kwargs):
+    """
+    Signal receiver that keeps the poller's target index and the heartbeat
+    signing keys in sync when a UserSettings instance is saved.
+
+    Args:
+    - sender: The model class that sends the signal (UserSettings).
+    - instance: The instance of the UserSettings that was saved.
+    - **kwargs: Additional keyword arguments.
+    """
+    poll_targets.update(instance)
+    heartbeats.update(instance)
+
+
+@receiver(post_delete, sender=UserSettings)
+def remove_poll_target(sender, instance, **kwargs):
+    """
+    Signal receiver that drops a user from the poller's target index and
+    the heartbeat signing keys when their UserSettings instance is deleted.
+
+    Args:
+    - sender: The model class that sends the signal (UserSettings).
+    - instance: The instance of the UserSettings that was deleted.
+    - **kwargs: Additional keyword arguments.
+    """
+    poll_targets.remove(instance.user_id)
+    heartbeats.remove(instance.user_id)
+
+
+@receiver(post_save, sender=UserSettings)
+@receiver(post_delete, sender=UserSettings)
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def invalidate_room_list(sender, instance, **kwargs):
+    """
+    Signal receiver that invalidates the cached room list pages of a user
+    when one of their rooms or their settings (theme, language...) change,
+    along with the cached settings or light states.
+
+    Args:
+    - sender: The model class that sends the signal (Room, UserSettings).
+    - instance: The instance that was saved or deleted.
+    - **kwargs: Additional keyword arguments.
+    """
+    bump_room_list_version(instance.user_id)
+    if sender is UserSettings:
+        invalidate_user_settings(instance.user_id)
+    else:
+        invalidate_lights_snapshot()
+
+
+@receiver(post_save, sender=Light)
+@receiver(post_delete, sender=Light)
+def invalidate_room_list_for_light(sender, instance, **kwargs):
+    """
+    Signal receiver that invalidates the cached light states and the room
+    list pages of the owner of a light when the light is saved or deleted.
+
+    Args:
+    - sender: The model class that sends the signal (Light).
+    - instance: The instance of the Light that was saved or deleted.
+    - **kwargs: Additional keyword arguments.
+    """
+    invalidate_lights_snapshot()
+    try:
+        user_id = instance.room.user_id
+    except Room.DoesNotExist:
+        # The room is being deleted too, which invalidates the pages
+        return
+    bump_room_list_version(user_id)
+
+
+@receiver(post_save, sender=Light)
+def log_light_state(sender, instance, created, update_fields, **kwargs):
+    """
+    Signal receiver that appends a light's state to the state change log
+    when a light is created or its state saved (a toggle, an edit). Saves
+    limited to other fields are ignored, as are edits leaving the state
+    unchanged, since only the changed fields are saved (see
+    DirtyFieldsMixin).
+
+    Args:
+    - sender: The model class that sends the signal (Light).
+    - instance: The instance of the Light that was saved.
+    - created: A boolean indicating if a new instance was created.
+    - update_fields: The fields passed to save(), None for all.
+    - **kwargs: Additional keyword arguments.
+    """
+    if created or update_fields is None or "state" in update_fields:
+        light_events.record(instance.id, instance.state)
+
+
+@receiver(post_save, sender=SceneLight)
+@receiver(post_delete, sender=SceneLight)
+def refresh_scene(sender, instance, **kwargs):
+    """
+    Signal receiver that recomputes the denormalized membership of a scene
+    when one of its lights is added, changed or removed (including when
+    the light itself is deleted).
+
+    Args:
+    - sender: The model class that sends the signal (SceneLight).
+    - instance: The instance of the SceneLight that was saved or deleted.
+    - **kwargs: Additional keyword arguments.
+    """
+    refresh_scene_members([instance.scene_id])
+
+
+@receiver(post_save, sender=Light)
+@receiver(post_save, sender=Room)
+def refresh_renamed_scenes(sender, instance, created, update_fields,
+                           **kwargs):
+    """
+    Signal receiver that recomputes the membership of the scenes of a
+    light or room that may have been renamed or moved, since the scenes
+    store the names sent to the device. Saves limited to other fields
+    (e.g. a light's state) are ignored.
+
+    Args:
+    - sender: The model class that sends the signal (Light, Room).
+    - instance: The instance that was saved.
+    - created: A boolean indicating if a new instance was created.
+    - update_fields: The fields passed to save(), None for all.
+    - **kwargs: Additional keyword arguments.
+    """
+    if created or (update_fields is not None
+                   and not {"name", "room"} & set(update_fields)):
+        return
+    if sender is Light:
+        entries = SceneLight.objects.filter(light=instance)
+    else:
+        entries = SceneLight.objects.filter(light__room=instance)
+    refresh_scene_members(entries.values_list("scene_id", flat=True))
+
+
+@receiver(home_status_changed)
+def count_home_status_transition(sender, user_id, online, previous,
+                                 **kwargs):
+    """
+    Signal receiver that counts published home online/offline transitions.
+
+    Args:
+    - sender: The class that sends the signal (HomeStatusTracker).
+    - user_id: The ID of the user owning the home.
+    - online: The new status of the home.
+    - previous: The previous status of the home, None if it was unknown.
+    - **kwargs: Additional keyword arguments.
+    """
+    if previous is not None:
+        HOME_STATUS_TRANSITIONS.inc(status="online" if online else "offline")
+
+
+@receiver(home_status_changed)
+def share_home_status(sender, user_id, online, **kwargs):
+    """
+    Signal receiver that publishes home statuses in the shared cache, so
+    every worker answers check_home_status the same way.
+
+    Args:
+    - sender: The class that sends the signal (HomeStatusTracker).
+    - user_id: The ID of the user owning the home.
+    - online: The new status of the home.
+    - **kwargs: Additional keyword arguments.
     """
-    instance.usersettings.save()
+    publish_home_status(user_id, online)
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+
+
+class _Call:
+    """An in-flight call of `SingleFlight`, shared by its waiters."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Futures of the coroutines waiting for the call, with their loops
+        self.waiters = []
+
+    def outcome(self):
+        """Returns the shared result, or raises the shared exception."""
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one: the first
+    caller runs the function, the others wait for and share its result
+    (or exception).
+
+    Threads (`do`) and coroutines (`ado`), of any event loop, share the
+    same calls: a coroutine can wait for a call made by a thread without
+    blocking its loop, and the other way round.
+
+    Only the calls overlapping in time are collapsed, nothing is cached
+    once the call returns.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        """Returns the in-flight call of a key, and whether it is new."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def _finish(self, key, call):
+        """Ends a call, waking up its threads and coroutines."""
+        with self._lock:
+            del self._calls[key]
+            call.done.set()
+            waiters, call.waiters = call.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._resolve, future)
+
+    @staticmethod
+    def _resolve(future):
+        """Wakes up a coroutine waiting for a call, unless cancelled."""
+        if not future.done():
+            future.set_result(None)
+
+    def do(self, key, function):
+        """
+        Runs `function`, unless a call with the same key is in flight, in
+        which case its result is awaited and returned instead.
+
+        Args:
+            key (hashable): Identifies identical calls.
+            function (callable): The call, without arguments.
+
+        Returns:
+            tuple: The result and whether it was shared from another call.
+
+        Raises:
+            Exception: Whatever the in-flight call raised.
+        """
+        call, leader = self._join(key)
+        if not leader:
+            call.done.wait()
+            return call.outcome(), True
+
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+        return call.result, False
+
+    async def ado(self, key, function):
+        """
+        Async version of `do`: awaits `function()`, unless a call with the
+        same key is in flight, in which case its result is shared instead.
+
+        The call runs in its own task, so a waiter being cancelled (e.g. a
+        client disconnecting) doesn't cancel it for the others.
+
+        Args:
+            key (hashable): Identifies identical calls.
+            function (callable): Returns the coroutine to run.
+
+        Returns:
+            tuple: The result and whether it was shared from another call.
+
+        Raises:
+            Exception: Whatever the in-flight call raised.
+        """
+        loop = asyncio.get_running_loop()
+        call, leader = self._join(key)
+        if leader:
+            await asyncio.shield(loop.create_task(self._lead(key, call,
+                                                             function)))
+            return call.outcome(), False
+
+        future = loop.create_future()
+        with self._lock:
+            if not call.done.is_set():
+                call.waiters.append((loop, future))
+            else:
+                future.set_result(None)
+        await asyncio.shield(future)
+        return call.outcome(), True
+
+    async def _lead(self, key, call, function):
+        """Runs the call of the first coroutine and shares its outcome."""
+        try:
+            call.result = await function()
+        except Exception as e:
+            call.error = e
+        except BaseException as e:
+            # Cancelled with its loop: the waiters get the cancellation
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
@@ -0,0 +1,140 @@
+from .context_processors import home_online_status
+from .models import Light, UserSettings
+from .tiered_cache import tiered_cache
+
+# Namespace of the lights_status snapshot, invalidated by any room or
+# light change
+LIGHTS_NAMESPACE = "lights_status"
+
+# Namespace of the published home statuses, shared by the workers
+HOME_STATUS_NAMESPACE = "home_status"
+
+
+def settings_namespace(user_id):
+    """Returns the cache namespace of a user's settings."""
+    return f"user_settings:{user_id}"
+
+
+def load_user_settings(user):
+    """Loads, or creates, the settings of a user from the database."""
+    user_settings, created = UserSettings.objects.get_or_create(
+        user_id=user.id)
+    return user_settings
+
+
+def get_user_settings(user):
+    """
+    Returns the settings of a user through the two-tier cache.
+
+    The cached instance is a copy: it can be read freely, but forms that
+    save the settings should load them from the database.
+
+    Args:
+        user (User): The authenticated user.
+
+    Returns:
+        UserSettings: The user's settings.
+    """
+    user_settings = tiered_cache.get_or_set(
+        settings_namespace(user.id), "settings",
+        lambda: load_user_settings(user))
+    user_settings.user = user
+    return user_settings
+
+
+async def aget_user_settings(user):
+    """
+    Async version of `get_user_settings`.
+
+    Args:
+        user (User): The authenticated user.
+
+    Returns:
+        UserSettings: The user's settings.
+    """
+    user_settings = await tiered_cache.aget_or_set(
+        settings_namespace(user.id), "settings",
+        lambda: load_user_settings(user))
+    user_settings.user = user
+    return user_settings
+
+
+def invalidate_user_settings(user_id):
+    """Drops the cached settings of a user."""
+    tiered_cache.bump(settings_namespace(user_id))
+
+
+def load_lights_snapshot():
+    """
+    Reads the state of every light, with its room, in a single query.
+
+    Returns:
+        list[dict]: The lights, grouped by room in room name order.
+    """
+    lights = Light.objects.order_by("room__name", "room__id", "id")
+    lights = lights.values_list("room__name", "name", "state")
+    return [
+        {
+            "room": room_name,
+            "light": name,
+            "state": "on" if state == 1 else "off",
+        }
+        for room_name, name, state in lights
+    ]
+
+
+async def alights_snapshot():
+    """
+    Returns the state of every light through the two-tier cache.
+
+    Returns:
+        list[dict]: The lights, grouped by room in room name order.
+    """
+    return await tiered_cache.aget_or_set(
+        LIGHTS_NAMESPACE, "all", load_lights_snapshot)
+
+
+def invalidate_lights_snapshot():
+    """Drops the cached light states."""
+    tiered_cache.bump(LIGHTS_NAMESPACE)
+
+
+def publish_home_status(user_id, online):
+    """
+    Shares the online status of a user's home with every worker.
+
+    Args:
+        user_id (int): The ID of the user.
+        online (bool): The new status.
+    """
+    tiered_cache.set(HOME_STATUS_NAMESPACE, str(user_id), online, None)
+
+
+def home_status(user_id):
+    """
+    Returns the published online status of a user's home, as seen by the
+    worker polling it, falling back to this process's own status.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        bool or None: The status, None if it was never published.
+    """
+    return tiered_cache.get(HOME_STATUS_NAMESPACE, str(user_id),
+                            home_online_status.get(user_id))
+
+
+async def ahome_status(user_id):
+    """
+    Returns the published online status of a user's home, as seen by the
+    worker polling it, falling back to this process's own status.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        bool or None: The status, None if it was never published.
+    """
+    return await tiered_cache.aget(HOME_STATUS_NAMESPACE, str(user_id),
+                                   home_online_status.get(user_id))
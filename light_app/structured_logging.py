@@ -0,0 +1,140 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from .metrics import LOG_RECORDS_DROPPED, LOG_RECORDS_SUPPRESSED
+from .tracing import current_span
+
+# Attributes every LogRecord has; the others come from `extra=` and are
+# written as fields of the JSON record
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord(
+    "", 0, "", 0, "", (), None)).keys()) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line: time, level, logger,
+    message, the fields passed with `extra=`, and the trace of the request
+    or task that logged it (see `tracing.py`), if traced.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(
+                record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES and not name.startswith("_"):
+                entry[name] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        elif record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most one record per `interval` seconds for each source
+    of repeated messages, so e.g. a device that stays offline doesn't log
+    an error every poll interval.
+
+    A source is the logging call site, plus the `rate_key` field if the
+    call passes one with `extra=` (e.g. the device address, so other
+    devices' errors still get through). The next record let through from
+    a source reports how many were suppressed in its `suppressed` field.
+
+    Attributes:
+        interval (float): Seconds between two records of the same source.
+        min_level (int): Records below this level are never limited.
+    """
+
+    def __init__(self, interval=60, min_level="WARNING", max_sources=10000):
+        super().__init__()
+        self.interval = float(interval)
+        self.min_level = logging.getLevelName(min_level)
+        self.max_sources = max_sources
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.min_level or self.interval <= 0:
+            return True
+        source = (record.pathname, record.lineno,
+                  getattr(record, "rate_key", None))
+        now = time.monotonic()
+        with self._lock:
+            allowed_at, suppressed = self._sources.get(source, (0, 0))
+            if now < allowed_at:
+                self._sources[source] = (allowed_at, suppressed + 1)
+                LOG_RECORDS_SUPPRESSED.inc(logger=record.name)
+                return False
+            if len(self._sources) >= self.max_sources:
+                self._sources.clear()
+            self._sources[source] = (now + self.interval, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    Handler putting records on a bounded in-memory queue, written by a
+    background thread: logging never waits for the console or a file in
+    request or poller threads.
+
+    Only the message and the exception are rendered in the logging
+    thread, since arguments may change afterwards; the JSON formatting and
+    the I/O happen in the writer thread. When the queue is full, records
+    are dropped and counted rather than blocking.
+
+    Args:
+        stream: The stream written to. Defaults to stderr.
+        filename (str, optional): A file to append to instead.
+        queue_size (int): Records the queue holds.
+    """
+
+    def __init__(self, stream=None, filename=None, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        if filename:
+            self.target = logging.FileHandler(filename, encoding="utf-8")
+        else:
+            self.target = logging.StreamHandler(stream or sys.stderr)
+        self.listener = QueueListener(self.queue, self.target,
+                                      respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def setFormatter(self, fmt):
+        # Records are formatted by the writer thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        span = current_span()
+        if span is not None:
+            record.trace_id = span.trace_id
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
@@ -0,0 +1,187 @@
+from datetime import datetime, timezone
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection, transaction
+from django.db.models.signals import post_save
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from .light_events import LightEventLog, light_events
+from .models import Light, LightStateEvent, Room
+from .usage import HOUR, usage_report
+
+
+class LightEventsIsolationMixin:
+    """Keeps the shared light event writer from running during tests."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(light_events, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # flush() swaps the list, so clear whichever one is pending then
+        self.addCleanup(lambda: light_events._pending.clear())
+
+
+class DirtyFieldsTests(LightEventsIsolationMixin, TestCase):
+    """Saves of the models using `DirtyFieldsMixin`."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("dirty", password="x")
+        self.room = Room.objects.create(name="Kitchen", user=self.user)
+        self.light = Light.objects.create(name="Ceiling", room=self.room)
+
+    def saved_fields(self, instance):
+        """Saves an instance, returning the update_fields of post_save."""
+        received = []
+
+        def receiver(sender, update_fields, **kwargs):
+            received.append(update_fields)
+
+        post_save.connect(receiver, sender=type(instance))
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                instance.save()
+        finally:
+            post_save.disconnect(receiver, sender=type(instance))
+        self.queries = [query["sql"] for query in queries]
+        return received[0] if received else None
+
+    def test_partial_save(self):
+        light = Light.objects.get(pk=self.light.pk)
+        light.description = "Above the table"
+        self.assertEqual(light.get_dirty_fields(), ["description"])
+        self.assertEqual(self.saved_fields(light), frozenset({"description"}))
+        updates = [sql for sql in self.queries if sql.startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"state"', updates[0])
+        self.assertFalse(light.is_dirty())
+        self.assertEqual(Light.objects.get(pk=light.pk).description,
+                         "Above the table")
+
+    def test_unchanged_save_is_skipped(self):
+        light = Light.objects.get(pk=self.light.pk)
+        light.name = "Ceiling"
+        self.assertFalse(light.is_dirty())
+        with self.assertNumQueries(0):
+            light.save()
+
+    def test_new_instance_full_save(self):
+        light = Light(name="Lamp", room=self.room)
+        self.assertIsNone(light.get_dirty_fields())
+        self.assertIsNone(self.saved_fields(light))
+        self.assertTrue(Light.objects.filter(name="Lamp").exists())
+
+    def test_deleted_row_is_inserted_again(self):
+        light = Light.objects.get(pk=self.light.pk)
+        Light.objects.filter(pk=light.pk).delete()
+        light.state = 1
+        self.assertEqual(self.saved_fields(light), frozenset({"state"}))
+        saved = Light.objects.get(pk=light.pk)
+        self.assertEqual((saved.name, saved.state), ("Ceiling", 1))
+        self.assertFalse(light.is_dirty())
+
+    def test_database_errors_are_raised(self):
+        Room.objects.create(name="Hall", user=self.user)
+        room = Room.objects.get(pk=self.room.pk)
+        room.name = "Hall"
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                room.save()
+
+
+class UsageReportTests(LightEventsIsolationMixin, TestCase):
+    """The usage report over a small fixed history, in UTC."""
+
+    # 2024-01-01 00:00 UTC: the report covers the 1st and the 2nd
+    START = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    NOW = START + 48 * HOUR
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("usage", password="x")
+        kitchen = Room.objects.create(name="Kitchen", user=self.user)
+        hall = Room.objects.create(name="Hall", user=self.user)
+        self.ceiling = Light.objects.create(name="Ceiling", room=kitchen)
+        self.lamp = Light.objects.create(name="Lamp", room=hall)
+        self.spare = Light.objects.create(name="Spare", room=kitchen)
+        self.events([
+            # On since before the period, off at 02:00 on the 1st, on
+            # from 01:00 to 02:30 on the 2nd
+            (self.ceiling, 1, -HOUR),
+            (self.ceiling, 0, 2 * HOUR),
+            (self.ceiling, 1, 25 * HOUR),
+            (self.ceiling, 0, 26.5 * HOUR),
+            # Off since before the period, on from 23:00 on the 2nd
+            (self.lamp, 0, -10 * HOUR),
+            (self.lamp, 3, 47 * HOUR),
+        ])
+
+    def events(self, changes):
+        LightStateEvent.objects.bulk_create(
+            LightStateEvent(light=light, state=state, time=self.START + at)
+            for light, state, at in changes)
+
+    def report(self):
+        return usage_report(self.user, days=2, now=self.NOW)
+
+    def test_period(self):
+        report = self.report()
+        self.assertEqual(report["start"], "2024-01-01T00:00:00+00:00")
+        self.assertEqual(report["timezone"], "UTC")
+        # The changes before the period only give the initial states
+        self.assertEqual(report["events"], 4)
+
+    def test_on_hours(self):
+        report = self.report()
+        self.assertEqual(
+            {light["name"]: light["on_hours"] for light in report["lights"]},
+            {"Ceiling": 3.5, "Lamp": 1.0, "Spare": 0.0})
+        self.assertEqual(
+            {room["name"]: room["on_hours"] for room in report["rooms"]},
+            {"Kitchen": 3.5, "Hall": 1.0})
+
+    def test_hourly_profile(self):
+        profiles = {room["name"]: room["hourly_profile"]
+                    for room in self.report()["rooms"]}
+        kitchen = [0.0] * 24
+        kitchen[:3] = [0.5, 1.0, 0.25]
+        hall = [0.0] * 24
+        hall[23] = 0.5
+        self.assertEqual(profiles, {"Kitchen": kitchen, "Hall": hall})
+
+    def test_daily(self):
+        self.assertEqual(self.report()["daily"], [
+            {"date": "2024-01-01", "on_hours": 2.0},
+            {"date": "2024-01-02", "on_hours": 2.5},
+        ])
+
+    def test_state_carried_in(self):
+        # Lit since before the period, with no change in it
+        self.events([(self.spare, 1, -30 * HOUR)])
+        report = self.report()
+        spare = next(light for light in report["lights"]
+                     if light["name"] == "Spare")
+        self.assertEqual(spare["on_hours"], 48.0)
+        self.assertEqual(report["events"], 4)
+
+
+class LightEventLogTests(LightEventsIsolationMixin, TestCase):
+    """Writes of the light state change log."""
+
+    def test_flush_drops_deleted_lights(self):
+        user = User.objects.create_user("events", password="x")
+        room = Room.objects.create(name="Kitchen", user=user)
+        kept = Light.objects.create(name="Ceiling", room=room)
+        deleted = Light.objects.create(name="Lamp", room=room)
+        log = LightEventLog()
+        with mock.patch.object(log, "start"):
+            log.record_many([(kept.id, 1), (deleted.id, 1)], when=1.0)
+        deleted.delete()
+        self.assertEqual(log.flush(), 1)
+        self.assertEqual(
+            list(LightStateEvent.objects.values_list("light_id", "state")),
+            [(kept.id, 1)])
+        self.assertEqual(log.flush(), 0)
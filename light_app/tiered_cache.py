@@ -0,0 +1,378 @@
+import asyncio
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from .db_router import use_primary
+from .metrics import CACHE_REQUESTS
+
+# Marks a miss, since None is a valid cached value
+MISSING = object()
+
+# Seconds another worker waits for the one recomputing a missing value
+# before recomputing it itself
+RECOMPUTE_LOCK_TIMEOUT = 10
+
+
+class LocalLRU:
+    """
+    Small thread-safe in-process LRU cache whose entries expire after a
+    few seconds.
+
+    Values are stored pickled, so callers get their own copy and can't
+    corrupt the cached one by mutating it (cached model instances...).
+
+    Attributes:
+        max_entries (int): Entries kept before the least recently used one
+          is evicted.
+        ttl (float): Seconds an entry stays valid.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value of a key.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            object: The value, or MISSING if absent or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, data = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+        return pickle.loads(data)
+
+    def set(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries if full.
+
+        Args:
+            key (str): The cache key.
+            value (object): A picklable value.
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drops a key."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self._entries.clear()
+
+
+class TieredCache:
+    """
+    Two-tier cache: an in-process LRU in front of the shared Django cache
+    (Redis in production), with version-key invalidation.
+
+    Values live in namespaces (e.g. "room_list:42"). Every namespace has a
+    version, the time of its last invalidation, stored in the shared cache
+    and embedded in the keys of its values: `bump()` invalidates a whole
+    namespace with a single write, old values simply become unreachable
+    and expire. The local tier keeps values and versions for at most
+    `CACHE_LOCAL_TTL` seconds, which bounds how long another worker can
+    serve a value after an invalidation; the worker that invalidates sees
+    the new version immediately.
+
+    Hits and misses of both tiers are counted in the
+    `home_control_cache_requests_total` metric.
+
+    Attributes:
+        alias (str): The Django cache used as the shared tier.
+    """
+
+    def __init__(self, alias="default"):
+        self.alias = alias
+        self._local = None
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @property
+    def shared(self):
+        """The shared Django cache."""
+        return caches[self.alias]
+
+    @property
+    def local(self):
+        """The in-process tier, created from the settings on first use."""
+        if self._local is None:
+            self._local = LocalLRU(
+                getattr(settings, "CACHE_LOCAL_MAX_ENTRIES", 1024),
+                getattr(settings, "CACHE_LOCAL_TTL", 2),
+            )
+        return self._local
+
+    def version(self, namespace):
+        """
+        Returns the current version of a namespace, starting one if the
+        shared cache has none.
+
+        Args:
+            namespace (str): The namespace.
+
+        Returns:
+            float: The version, the UNIX time of the last invalidation.
+        """
+        version_key = f"version:{namespace}"
+        version = self.local.get(version_key)
+        if version is MISSING:
+            version = self.shared.get(version_key)
+            if version is None:
+                version = time.time()
+                if not self.shared.add(version_key, version, None):
+                    # Another worker started one first
+                    version = self.shared.get(version_key, version)
+            self.local.set(version_key, version)
+        return version
+
+    def bump(self, namespace):
+        """
+        Invalidates every value of a namespace.
+
+        Args:
+            namespace (str): The namespace.
+        """
+        version_key = f"version:{namespace}"
+        version = time.time()
+        self.shared.set(version_key, version, None)
+        self.local.set(version_key, version)
+
+    def make_key(self, namespace, key):
+        """
+        Builds the cache key of a value from the namespace's version.
+
+        Keys the shared backend could reject (too long, whitespace) are
+        hashed.
+
+        Args:
+            namespace (str): The namespace.
+            key (str): The key of the value in the namespace.
+
+        Returns:
+            str: The cache key.
+        """
+        full_key = f"{namespace}:{self.version(namespace)!r}:{key}"
+        if len(full_key) > 200 or not full_key.isprintable() or any(
+                char.isspace() for char in full_key):
+            digest = hashlib.md5(full_key.encode()).hexdigest()
+            full_key = f"{namespace}:h:{digest}"
+        return full_key
+
+    def get(self, namespace, key, default=None):
+        """
+        Returns a cached value, looking in the local tier first.
+
+        Args:
+            namespace (str): The namespace.
+            key (str): The key of the value in the namespace.
+            default (object): Returned on a miss.
+
+        Returns:
+            object: The value, or `default`.
+        """
+        value = self._get(self.make_key(namespace, key))
+        return default if value is MISSING else value
+
+    def set(self, namespace, key, value, timeout=DEFAULT_TIMEOUT):
+        """
+        Stores a value in both tiers.
+
+        Args:
+            namespace (str): The namespace.
+            key (str): The key of the value in the namespace.
+            value (object): A picklable value.
+            timeout (int, optional): Lifetime in the shared tier, in
+              seconds, None for no expiry. Defaults to the backend's
+              default timeout.
+        """
+        cache_key = self.make_key(namespace, key)
+        self._set(cache_key, value, timeout)
+
+    def get_or_set(self, namespace, key, default, timeout=DEFAULT_TIMEOUT):
+        """
+        Returns a cached value, computing and storing it on a miss.
+
+        Only one thread per process, and as far as possible one worker,
+        recomputes a missing value; the others wait for its result instead
+        of all hitting the database at once.
+
+        Args:
+            namespace (str): The namespace.
+            key (str): The key of the value in the namespace.
+            default (callable): Computes the value on a miss.
+            timeout (int, optional): Lifetime in the shared tier, in
+              seconds, None for no expiry. Defaults to the backend's
+              default timeout.
+
+        Returns:
+            object: The cached or computed value.
+        """
+        cache_key = self.make_key(namespace, key)
+        value = self._get(cache_key)
+        if value is not MISSING:
+            return value
+
+        with self._key_lock(cache_key):
+            # Another thread may have filled it while we waited
+            value = self._get(cache_key, count=False)
+            if value is not MISSING:
+                return value
+
+            lock_key = f"lock:{cache_key}"
+            if not self.shared.add(lock_key, 1, RECOMPUTE_LOCK_TIMEOUT):
+                value = self._wait_for(cache_key)
+                if value is not MISSING:
+                    return value
+            try:
+                value = self._compute(cache_key, default, timeout)
+            finally:
+                self.shared.delete(lock_key)
+        return value
+
+    async def aget(self, namespace, key, default=None):
+        """
+        Async version of `get`. Local hits don't leave the event loop.
+        """
+        value = self._local_get(namespace, key)
+        if value is not MISSING:
+            return value
+        return await sync_to_async(self.get)(namespace, key, default)
+
+    async def aget_or_set(self, namespace, key, default,
+                          timeout=DEFAULT_TIMEOUT):
+        """
+        Async version of `get_or_set`, `default` being a sync callable.
+        Local hits don't leave the event loop, and waiting for another
+        worker's recompute sleeps in the event loop rather than in the
+        thread shared by the sync code.
+        """
+        value = self._local_get(namespace, key)
+        if value is not MISSING:
+            return value
+        cache_key = await sync_to_async(self.make_key)(namespace, key)
+        value = await sync_to_async(self._get)(cache_key)
+        if value is not MISSING:
+            return value
+
+        lock_key = f"lock:{cache_key}"
+        if not await self.shared.aadd(lock_key, 1, RECOMPUTE_LOCK_TIMEOUT):
+            value = await self._await_for(cache_key)
+            if value is not MISSING:
+                return value
+        try:
+            return await sync_to_async(self._compute)(
+                cache_key, default, timeout)
+        finally:
+            await self.shared.adelete(lock_key)
+
+    def _local_get(self, namespace, key):
+        """Returns a value if both it and its version are held locally."""
+        version = self.local.get(f"version:{namespace}")
+        if version is MISSING:
+            return MISSING
+        value = self.local.get(f"{namespace}:{version!r}:{key}")
+        if value is not MISSING:
+            CACHE_REQUESTS.inc(tier="local", result="hit")
+        return value
+
+    def _get(self, cache_key, count=True):
+        """Looks a key up in the local tier, then in the shared one."""
+        value = self.local.get(cache_key)
+        if value is not MISSING:
+            if count:
+                CACHE_REQUESTS.inc(tier="local", result="hit")
+            return value
+        if count:
+            CACHE_REQUESTS.inc(tier="local", result="miss")
+
+        value = self.shared.get(cache_key, MISSING)
+        if count:
+            CACHE_REQUESTS.inc(
+                tier="shared", result="miss" if value is MISSING else "hit")
+        if value is not MISSING:
+            self.local.set(cache_key, value)
+        return value
+
+    def _set(self, cache_key, value, timeout):
+        """Stores a value in both tiers."""
+        self.shared.set(cache_key, value, timeout)
+        self.local.set(cache_key, value)
+
+    def _compute(self, cache_key, default, timeout):
+        """Computes a missing value and stores it in both tiers."""
+        # Cached values outlive the request: load them from the primary so
+        # a lagging replica can't leave a stale entry behind until the
+        # next invalidation
+        with use_primary():
+            value = default()
+        self._set(cache_key, value, timeout)
+        return value
+
+    def _wait_for(self, cache_key):
+        """Waits for another worker to store a value it is recomputing."""
+        deadline = time.monotonic() + RECOMPUTE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = self.shared.get(cache_key, MISSING)
+            if value is not MISSING:
+                self.local.set(cache_key, value)
+                return value
+            if self.shared.get(f"lock:{cache_key}") is None:
+                break
+        return MISSING
+
+    async def _await_for(self, cache_key):
+        """Async version of `_wait_for`."""
+        deadline = time.monotonic() + RECOMPUTE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            value = await self.shared.aget(cache_key, MISSING)
+            if value is not MISSING:
+                self.local.set(cache_key, value)
+                return value
+            if await self.shared.aget(f"lock:{cache_key}") is None:
+                break
+        return MISSING
+
+    def _key_lock(self, cache_key):
+        """Returns the in-process lock serializing recomputes of a key."""
+        with self._locks_lock:
+            lock = self._locks.get(cache_key)
+            if lock is None:
+                if len(self._locks) > 1024:
+                    # Drop the locks nobody holds
+                    self._locks = {key: held for key, held in
+                                   self._locks.items() if held.locked()}
+                lock = self._locks[cache_key] = threading.Lock()
+        return lock
+
+
+tiered_cache = TieredCache()
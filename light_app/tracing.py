@@ -0,0 +1,441 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import requests
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+from .metrics import TRACE_SPANS_DROPPED
+
+logger = logging.getLogger("home_control.tracing")
+
+# Span of the current request, task or thread, innermost
+_current_span = ContextVar("current_span", default=None)
+
+# Characters of SQL kept in the db.statement attribute of query spans
+MAX_STATEMENT_LENGTH = 1000
+# Spans sent to the exporter at once
+EXPORT_BATCH_SIZE = 512
+
+# OTLP span kinds
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3, "producer": 4,
+              "consumer": 5}
+
+
+class Span:
+    """
+    One timed operation of a trace, e.g. a request, a query or a device
+    call. Spans of the same trace share its ID and point to their parent.
+
+    Attributes:
+        name (str): What the span times, e.g. "GET toggle_light".
+        trace_id (str): 32 hex digits shared by the spans of the trace.
+        span_id (str): 16 hex digits identifying the span.
+        parent_id (str or None): The ID of the parent span.
+        kind (str): "server", "client", "consumer" or "internal".
+        start_ns (int): Start time, in nanoseconds since the epoch.
+        end_ns (int or None): End time, once ended.
+        attributes (dict): Details, e.g. the SQL or the device address.
+        error (str or None): The error that ended the span, if any.
+    """
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind",
+                 "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name, trace_id, parent_id=None, kind="internal",
+                 attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = random.getrandbits(64).to_bytes(8, "big").hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def traceparent(self):
+        """The W3C `traceparent` header continuing this trace."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set(self, name, value):
+        """Sets an attribute of the span."""
+        self.attributes[name] = value
+
+    def to_dict(self):
+        """Returns the span as a JSON-serializable dict."""
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def parse_traceparent(header):
+    """
+    Parses a W3C `traceparent` header.
+
+    Args:
+        header (str): The header, "00-<trace id>-<parent id>-<flags>".
+
+    Returns:
+        tuple: The trace ID, the parent span ID and whether the caller
+        sampled the trace (its "sampled" flag), or (None, None, False) if
+        the header is missing or invalid.
+    """
+    parts = (header or "").split("-")
+    if (len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16
+            or len(parts[3]) != 2 or parts[1] == "0" * 32):
+        return None, None, False
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None, None, False
+    return parts[1], parts[2], bool(flags & 0x01)
+
+
+class JsonlExporter:
+    """
+    Appends spans to a local file, one JSON object per line, for a
+    collector agent to tail or for reading them directly.
+
+    Attributes:
+        path (str): The file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, spans):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+
+def _otlp_value(value):
+    """Returns an attribute value in OTLP JSON form."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpExporter:
+    """
+    Sends spans to an OpenTelemetry collector (or any OTLP/HTTP endpoint,
+    e.g. Jaeger or Tempo) as OTLP JSON.
+
+    Attributes:
+        endpoint (str): The URL, e.g. "http://localhost:4318/v1/traces".
+        service_name (str): The `service.name` resource attribute.
+        timeout (float): Seconds to wait for the collector.
+    """
+
+    def __init__(self, endpoint, service_name, timeout=5):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def export(self, spans):
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{
+                "key": "service.name",
+                "value": {"stringValue": self.service_name},
+            }]},
+            "scopeSpans": [{
+                "scope": {"name": "light_app.tracing"},
+                "spans": [self._span(span) for span in spans],
+            }],
+        }]}
+        response = self.session.post(self.endpoint, json=payload,
+                                     timeout=self.timeout)
+        response.raise_for_status()
+
+    def _span(self, span):
+        otlp = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": SPAN_KINDS.get(span.kind, 1),
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)}
+                           for key, value in span.attributes.items()],
+            # Status codes: 1 ok, 2 error
+            "status": ({"code": 2, "message": span.error} if span.error
+                       else {"code": 1}),
+        }
+        if span.parent_id:
+            otlp["parentSpanId"] = span.parent_id
+        return otlp
+
+
+class Tracer:
+    """
+    Lightweight in-process tracer.
+
+    Spans are opened with `span()`; each becomes the child of the span
+    current in the request, task or thread, so the queries and device
+    calls of a request nest under its span. Ended spans are queued and
+    exported in batches by a background thread, so tracing adds no I/O to
+    the requests; spans are dropped (and counted) if the exporter can't
+    keep up.
+
+    Whether a trace is recorded is decided once, at its root span, with
+    probability `sample_rate`; a trace continued from a `traceparent` is
+    also recorded if the caller sampled it. Without an exporter, `span()`
+    yields None and costs next to nothing.
+
+    Attributes:
+        exporter: A `JsonlExporter` or `OtlpExporter`, or None.
+        sample_rate (float): Fraction of the traces recorded.
+        export_interval (float): Seconds between two exports.
+    """
+
+    def __init__(self, exporter=None, sample_rate=1.0, queue_size=2048,
+                 export_interval=2.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.export_interval = export_interval
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    @contextmanager
+    def span(self, name, kind="internal", attributes=None, traceparent=None,
+             root=False):
+        """
+        Context manager timing a span of the current trace.
+
+        Args:
+            name (str): The name of the span.
+            kind (str): "server", "client", "consumer" or "internal".
+            attributes (dict, optional): Its attributes.
+            traceparent (str, optional): A W3C `traceparent` header to
+              continue, e.g. an incoming request's.
+            root (bool): Start a trace if there is no current span. Spans
+              of queries and device calls are only recorded within one.
+
+        Yields:
+            Span or None: The span, None if it isn't recorded.
+        """
+        if not self.enabled:
+            yield None
+            return
+        parent = _current_span.get()
+        trace_id, parent_id, sampled = parse_traceparent(traceparent)
+        if trace_id is not None:
+            if not sampled and random.random() >= self.sample_rate:
+                yield None
+                return
+        elif parent is not None:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        elif not root or random.random() >= self.sample_rate:
+            yield None
+            return
+        else:
+            trace_id = random.getrandbits(128).to_bytes(16, "big").hex()
+
+        span = Span(name, trace_id, parent_id, kind, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_ns = time.time_ns()
+            self._record(span)
+
+    def _record(self, span):
+        """Queues an ended span for export."""
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            TRACE_SPANS_DROPPED.inc()
+            return
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        """Starts the export thread."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        """Exports the queued spans."""
+        while True:
+            batch = []
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            try:
+                self.exporter.export(batch)
+            except Exception as e:
+                TRACE_SPANS_DROPPED.inc(len(batch))
+                logger.error(f"Exporting {len(batch)} spans failed: {e}")
+                return
+
+    def _run(self):
+        while not self._stop.wait(self.export_interval):
+            self.flush()
+
+
+class TracedConsumerMixin:
+    """
+    Channels consumer mixin timing each message the consumer handles
+    (WebSocket frames, group messages) in a span. Messages carrying a
+    `traceparent` continue the sender's trace.
+    """
+
+    async def dispatch(self, message):
+        with tracer.span(
+            f"channels {type(self).__name__} {message['type']}",
+            "consumer",
+            {"channels.type": message["type"],
+             "channels.path": self.scope.get("path", "")},
+            traceparent=message.get("traceparent"),
+            root=True,
+        ):
+            await super().dispatch(message)
+
+
+def current_span():
+    """Returns the span of the current request, task or thread, if any."""
+    return _current_span.get()
+
+
+def current_traceparent():
+    """Returns the `traceparent` header continuing the current trace."""
+    span = _current_span.get()
+    return span.traceparent if span is not None else None
+
+
+def tracer_from_settings():
+    """
+    Builds the tracer configured by the `TRACING_*` settings.
+
+    Returns:
+        Tracer: A tracer exporting to the configured file or OTLP endpoint,
+        disabled if `TRACING_EXPORTER` is unset.
+    """
+    backend = getattr(settings, "TRACING_EXPORTER", "")
+    if backend == "file":
+        exporter = JsonlExporter(getattr(settings, "TRACING_FILE",
+                                         "traces.jsonl"))
+    elif backend == "otlp":
+        exporter = OtlpExporter(
+            getattr(settings, "TRACING_OTLP_ENDPOINT",
+                    "http://localhost:4318/v1/traces"),
+            getattr(settings, "TRACING_SERVICE_NAME", "home-control"))
+    else:
+        exporter = None
+    return Tracer(
+        exporter,
+        sample_rate=getattr(settings, "TRACING_SAMPLE_RATE", 1.0),
+        export_interval=getattr(settings, "TRACING_EXPORT_INTERVAL", 2.0),
+    )
+
+
+# Tracer of this process
+tracer = tracer_from_settings()
+
+
+def _trace_query(execute, sql, params, many, context):
+    """Database execute wrapper timing each query in a span."""
+    if _current_span.get() is None:
+        return execute(sql, params, many, context)
+    connection = context["connection"]
+    with tracer.span("db.query", "client", {
+        "db.system": connection.vendor,
+        "db.alias": connection.alias,
+        "db.statement": sql[:MAX_STATEMENT_LENGTH],
+        "db.executemany": many,
+    }):
+        return execute(sql, params, many, context)
+
+
+def install_query_tracing(sender, connection, **kwargs):
+    """
+    Signal receiver installing the query spans on every new database
+    connection, when tracing is enabled.
+    """
+    if tracer.enabled and _trace_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_trace_query)
+
+
+connection_created.connect(install_query_tracing)
+
+
+def device_span(method, address, path, command=None):
+    """
+    Context manager timing an outbound device call in a client span.
+
+    Args:
+        method (str): The HTTP method, or "WS" for WebSocket commands.
+        address (str): The device address.
+        path (str): The endpoint path.
+        command (str, optional): The metric label of the call.
+
+    Yields:
+        Span or None: The span, whose `traceparent` should be sent along.
+    """
+    return tracer.span(f"device {method} {path}", "client", {
+        "device.address": address,
+        "http.method": method,
+        "http.route": path,
+        "device.command": command or path,
+    })
+
+
+def trace_headers(span, headers=None):
+    """
+    Returns request headers carrying a span's trace to the device.
+
+    Args:
+        span (Span or None): The span of the device call.
+        headers (dict, optional): The headers passed by the caller.
+
+    Returns:
+        dict or None: The headers, with `traceparent` when traced.
+    """
+    if span is None:
+        return headers
+    headers = dict(headers or {})
+    headers["traceparent"] = span.traceparent
+    return headers
@@ -40,4 +40,34 @@ urlpatterns = [
     path("check_home_status/", views.check_home_status,
          name="check_home_status"),
     # Route to check the current status of the home (online/offline).
+
+    path("api/rooms/", views.api_rooms, name="api_rooms"),
+    # JSON API listing the user's rooms and their lights (keyset paginated,
+    # or streamed as NDJSON).
+
+    path("api/lights/", views.api_lights, name="api_lights"),
+    # JSON API listing the user's lights (keyset paginated).
+
+    path("api/usage/", views.api_usage, name="api_usage"),
+    # JSON API reporting the usage of the user's lights (on-hours, hourly
+    # and daily profiles) from their state change log.
+
+    path("scenes/save/", views.save_scene, name="save_scene"),
+    # Route to save the current state of the lights as a scene.
+
+    path("scenes/<str:scene_name>/activate/", views.activate_scene,
+         name="activate_scene"),
+    # Route to set every light of a scene to its state at once.
+
+    path("heartbeats/", views.receive_heartbeats, name="heartbeats"),
+    # Route for the devices to push their signed heartbeats.
+
+    path("house/import/", views.house_import, name="house_import"),
+    # Route to import rooms and lights from a CSV or JSON description.
+
+    path("house/export/", views.house_export, name="house_export"),
+    # Route to download the user's rooms and lights as CSV or JSON.
+
+    path("metrics/", views.metrics_view, name="metrics"),
+    # Route exposing the application metrics in the Prometheus text format.
 ]
@@ -0,0 +1,278 @@
+"""
+Usage analytics over the light state change log (see `LightStateEvent`).
+
+The events of a home are extracted as columns (light, state, time) and
+aggregated with NumPy array operations, without a Python loop over the
+events, so months of history aggregate in milliseconds:
+
+- Each event starts an interval ending at the next event of the same
+  light, or at the end of the period; the state of each light at the
+  start of the period is its last change before it.
+- On-hours per light are a weighted `bincount` of the lit intervals, and
+  on-hours per room the same over the lights' rooms.
+- Hourly and daily profiles integrate the lit intervals over local hour
+  boundaries. The lit time before an instant x, summed over intervals
+  [s, e), is count(s < x) * x - sum(s < x) - (count(e < x) * x -
+  sum(e < x)), evaluated at every boundary at once with `searchsorted`
+  over the sorted starts and ends and their cumulative sums. Rooms are
+  handled in the same pass by shifting each room's intervals (and
+  boundaries) into a time range of their own.
+
+NumPy is imported with this module, which views import on first use, so
+it doesn't slow down start-up.
+"""
+import time
+from itertools import chain
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import numpy as np
+from django.db.models import OuterRef, Subquery
+
+from .models import Light, LightStateEvent, Room, UserSettings
+
+# States in which a light is lit
+ON_STATES = (1, 3)
+HOUR = 3600
+DAY = 86400
+# Longest period of a report, in days
+MAX_DAYS = 366
+
+
+def user_timezone(user):
+    """Returns the time zone of a user's settings, UTC if unknown."""
+    name = UserSettings.objects.filter(user=user).values_list(
+        "timezone", flat=True).first()
+    try:
+        return ZoneInfo(name or "UTC")
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo("UTC")
+
+
+def extract(user, start, end):
+    """
+    Extracts the lights of a user and their state changes over a period,
+    as columns, in three queries.
+
+    Args:
+        user (User): The owner of the lights.
+        start (float): UNIX time of the start of the period.
+        end (float): UNIX time of its end.
+
+    Returns:
+        dict: "rooms" and "lights" rows, (ID, name) and (ID, room ID, name,
+        state at start or None) in ID order, and the "light_ids",
+        "states" and "times" arrays of the events in the period, in
+        light and time order (the order of the index).
+    """
+    rooms = list(Room.objects.filter(user=user).order_by("id").values_list(
+        "id", "name"))
+    initial_state = Subquery(
+        LightStateEvent.objects.filter(light=OuterRef("pk"), time__lt=start)
+        .order_by("-time").values("state")[:1])
+    lights = list(
+        Light.objects.filter(room__user=user)
+        .annotate(initial_state=initial_state).order_by("id")
+        .values_list("id", "room_id", "name", "initial_state"))
+    # Filtering on the light IDs (rather than joining the rooms) lets the
+    # database read the events in index order, without sorting them
+    rows = list(
+        LightStateEvent.objects.filter(
+            light_id__in=[row[0] for row in lights],
+            time__gte=start, time__lt=end)
+        .order_by("light_id", "time").values_list("light_id", "state", "time"))
+    # Flattening the rows is cheaper than building an array from tuples
+    events = np.fromiter(chain.from_iterable(rows), dtype=float,
+                         count=3 * len(rows)).reshape(-1, 3)
+    return {
+        "rooms": rooms,
+        "lights": lights,
+        "light_ids": events[:, 0].astype(np.int64),
+        "states": events[:, 1].astype(np.int64),
+        "times": events[:, 2],
+    }
+
+
+def lit_intervals(light_index, states, times, end):
+    """
+    Turns state changes into the intervals during which lights were lit.
+
+    Args:
+        light_index (ndarray): Index of the light of each change.
+        states (ndarray): State set by each change.
+        times (ndarray): Time of each change; the changes of each light
+          must be in time order.
+        end (float): End of the period, closing the last intervals.
+
+    Returns:
+        tuple: The light index, start and end arrays of the lit intervals.
+    """
+    # A stable sort keeps each light's changes in time order
+    order = np.argsort(light_index, kind="stable")
+    light_index, states, times = (
+        light_index[order], states[order], times[order])
+    ends = np.full(len(times), end, dtype=float)
+    same_light = light_index[1:] == light_index[:-1]
+    ends[:-1] = np.where(same_light, times[1:], end)
+    lit = np.isin(states, ON_STATES) & (ends > times)
+    return light_index[lit], times[lit], ends[lit]
+
+
+def lit_seconds_before(starts, ends, points):
+    """
+    Computes, for each point, the total lit time of the intervals before
+    it (see the module docstring).
+
+    Args:
+        starts (ndarray): Starts of the intervals.
+        ends (ndarray): Ends of the intervals.
+        points (ndarray): The points, of any shape.
+
+    Returns:
+        ndarray: The lit seconds before each point.
+    """
+    starts, ends = np.sort(starts), np.sort(ends)
+    start_sums = np.concatenate(([0.0], np.cumsum(starts)))
+    end_sums = np.concatenate(([0.0], np.cumsum(ends)))
+    started = np.searchsorted(starts, points)
+    ended = np.searchsorted(ends, points)
+    return ((started * points - start_sums[started])
+            - (ended * points - end_sums[ended]))
+
+
+def utc_offsets(times, tz):
+    """
+    Returns the UTC offset of a time zone at hourly times, in seconds.
+
+    The offset is looked up once a day, and every hour only on the days
+    it changes (daylight saving time).
+
+    Args:
+        times (ndarray): UNIX times, one hour apart.
+        tz (tzinfo): The time zone.
+
+    Returns:
+        ndarray: The offsets.
+    """
+    def offset(when):
+        return datetime.fromtimestamp(when, tz).utcoffset().total_seconds()
+
+    daily = np.array([offset(when) for when in times[::24]])
+    offsets = np.repeat(daily, 24)[:len(times)]
+    for day in np.flatnonzero(np.diff(daily)):
+        hours = slice(day * 24, (day + 1) * 24 + 1)
+        offsets[hours] = [offset(when) for when in times[hours]]
+    return offsets
+
+
+def hour_edges(start, end, tz):
+    """
+    Returns the local hour boundaries between two times, and the times.
+
+    Args:
+        start (float): UNIX time of the start of the period.
+        end (float): UNIX time of its end.
+        tz (tzinfo): The time zone.
+
+    Returns:
+        ndarray: start, the local hour boundaries, end.
+    """
+    # Local hours start within UTC hours in zones with half hour offsets
+    shift = datetime.fromtimestamp(start, tz).utcoffset().total_seconds()
+    first = start - (start + shift) % HOUR + HOUR
+    return np.concatenate(([start], np.arange(first, end, HOUR), [end]))
+
+
+def usage_report(user, days=30, now=None):
+    """
+    Computes the usage of a user's lights over the last days.
+
+    Args:
+        user (User): The owner of the lights.
+        days (int): Length of the period, at most MAX_DAYS.
+        now (float, optional): UNIX time of the end of the period,
+          defaults to now.
+
+    Returns:
+        dict: The period, the on-hours of each light and room, the
+        average number of lights on in each room at each local hour of
+        the day ("hourly_profile"), and the on-hours of the home on each
+        local day ("daily").
+    """
+    end = time.time() if now is None else now
+    start = end - days * DAY
+    tz = user_timezone(user)
+    data = extract(user, start, end)
+    rooms, lights = data["rooms"], data["lights"]
+
+    light_ids = np.array([row[0] for row in lights], dtype=np.int64)
+    room_ids = np.array([row[0] for row in rooms], dtype=np.int64)
+    light_rooms = np.searchsorted(
+        room_ids, np.array([row[1] for row in lights], dtype=np.int64))
+    initial = np.array([-1 if row[3] is None else row[3] for row in lights],
+                       dtype=np.int64)
+    known = np.flatnonzero(initial >= 0)
+
+    # The state of each light at the start is a change at the start,
+    # before the light's changes in the period
+    light_index, starts, ends = lit_intervals(
+        np.concatenate((known, np.searchsorted(light_ids,
+                                               data["light_ids"]))),
+        np.concatenate((initial[known], data["states"])),
+        np.concatenate((np.full(len(known), start), data["times"])),
+        end,
+    )
+    light_seconds = np.bincount(light_index, weights=ends - starts,
+                                minlength=len(lights))
+    room_seconds = np.bincount(light_rooms, weights=light_seconds,
+                               minlength=len(rooms))
+
+    # Lit seconds per room and local hour: each room's intervals and
+    # boundaries are shifted into a range of their own
+    edges = hour_edges(start, end, tz) - start
+    span = end - start + HOUR
+    room_shifts = np.arange(len(rooms)) * span
+    interval_shifts = room_shifts[light_rooms[light_index]]
+    before = lit_seconds_before(starts - start + interval_shifts,
+                                ends - start + interval_shifts,
+                                edges + room_shifts[:, None])
+    hourly = np.diff(before, axis=1)
+
+    hour_starts = edges[:-1] + start
+    local = hour_starts + utc_offsets(hour_starts, tz)
+    hours = (local // HOUR % 24).astype(np.int64)
+    per_hour = (hours[:, None] == np.arange(24)).astype(float)
+    covered = np.diff(edges) @ per_hour
+    profiles = np.divide(hourly @ per_hour, covered,
+                         out=np.zeros((len(rooms), 24)), where=covered > 0)
+
+    local_days, day_index = np.unique(local // DAY, return_inverse=True)
+    daily = np.bincount(day_index, weights=hourly.sum(axis=0))
+    dates = local_days.astype("datetime64[D]").astype(str)
+
+    def hours_of(seconds):
+        return np.round(seconds / HOUR, 3).tolist()
+
+    return {
+        "start": datetime.fromtimestamp(start, timezone.utc).isoformat(),
+        "end": datetime.fromtimestamp(end, timezone.utc).isoformat(),
+        "timezone": str(tz),
+        "events": len(data["times"]),
+        "lights": [
+            {"id": light_id, "name": name, "room_id": room_id,
+             "on_hours": on_hours}
+            for (light_id, room_id, name, _), on_hours in zip(
+                lights, hours_of(light_seconds))
+        ],
+        "rooms": [
+            {"id": room_id, "name": name, "on_hours": on_hours,
+             "hourly_profile": profile}
+            for (room_id, name), on_hours, profile in zip(
+                rooms, hours_of(room_seconds),
+                np.round(profiles, 3).tolist())
+        ],
+        "daily": [
+            {"date": date, "on_hours": on_hours}
+            for date, on_hours in zip(dates.tolist(), hours_of(daily))
+        ],
+    }
@@ -1,20 +1,46 @@
 import os
-import requests
+import hmac
+import json
+import httpx
+from asgiref.sync import sync_to_async
 
-from django.core.paginator import Paginator
-from django.core.cache import cache
 from django.db import connections
-from django.http import JsonResponse
-from django.shortcuts import render, get_object_or_404, redirect
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
+from django.shortcuts import (
+    render, get_object_or_404, aget_object_or_404, redirect,
+)
 from django.utils.translation import gettext as _
 from django.utils.functional import SimpleLazyObject
+from django.utils.safestring import mark_safe
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_cookie
 
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 
-from .models import Room, Light, UserSettings
+from .models import Room, Light, Scene, UserSettings
 from .forms import RoomForm, LightForm, UserSettingsForm
-from .context_processors import home_online_status, debug
+from .context_processors import debug
+from .device_channel import is_connected as device_connected
+from .device_client import adevice_command, adevice_probe
+from .rate_limit import DeviceBusy
+from .fragment_cache import (
+    render_room_cards, room_list_etag, room_list_last_modified,
+)
+from .metrics import registry
+from .snapshots import alights_snapshot, ahome_status
+from .heartbeats import heartbeats, MAX_BATCH
+from .scenes import capture_scene, send_scene, apply_scene
+from .house_io import InvalidHouse, parse_house, import_house, aexport_house
+from .room_api import (
+    InvalidQuery, ROOM_FIELDS, LIGHT_FIELDS, DEFAULT_LIGHT_FIELDS,
+    parse_limit, parse_fields, room_page, light_page, astream_house,
+)
+from .profiling import profile_store
 
 # Global variables
 user_id = False
@@ -38,12 +64,13 @@ def home(request):
 
 
 @login_required
-def check_home_status(request):
+async def check_home_status(request):
     """
     Returns the current online status of the user's home automation system.
 
-    This function checks the global 'home_online_status' variable for the
-    status of the home system specific to the authenticated user.
+    This function reads the status published by the background poller for
+    the home system specific to the authenticated user, through the shared
+    cache so every worker gives the same answer.
     The status is returned as a JSON response.
 
     Args:
@@ -53,10 +80,55 @@ def check_home_status(request):
         JsonResponse: A JSON object containing the home online status
         for the authenticated user.
     """
-    global home_online_status
-    user_id = request.user.id
+    user = await request.auser()
     return JsonResponse({"home_online_status":
-                         home_online_status.get(user_id)})
+                         await ahome_status(user.id)})
+
+
+def metrics_view(request):
+    """
+    Exposes the application metrics in the Prometheus text format.
+
+    The metrics are only shown to staff users, and to scrapers sending the
+    `METRICS_TOKEN` setting, when set, as a bearer token in the
+    Authorization header.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        HttpResponse: The metrics, or a 403 response for anyone else.
+    """
+    token = getattr(settings, "METRICS_TOKEN", None)
+    scraper = bool(token) and hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(),
+        f"Bearer {token}".encode())
+    if not scraper and not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(),
+                        content_type="text/plain; version=0.0.4")
+
+
+@staff_member_required
+def profiling_view(request):
+    """
+    Admin page showing the per-view timings and the slow request samples
+    collected by the profiling middleware.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        HttpResponse: The rendered profiling page.
+    """
+    context = {
+        **admin.site.each_context(request),
+        "title": _("Request profiling"),
+        "enabled": getattr(settings, "PROFILING_ENABLED", False),
+        "view_stats": profile_store.view_stats(),
+        "samples": list(reversed(profile_store.samples)),
+    }
+    return render(request, "light_app/profiling.html", context)
 
 
 # =============================================================================
@@ -107,12 +179,19 @@ def user_settings_view(request):
 # =============================================================================
 
 @login_required
+@vary_on_cookie
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=room_list_etag,
+           last_modified_func=room_list_last_modified)
 def room_list_view(request):
     """
     Displays a list of rooms for the authenticated user, with pagination.
 
     Retrieves all rooms associated with the authenticated user and paginates
     the result to show 3 rooms per page.It then renders the room list template.
+    The rendered room cards are cached per user and page until a room, a
+    light or the user's settings change, and unchanged pages are answered
+    with 304 Not Modified through their ETag and Last-Modified headers.
 
     Args:
         request: The HTTP request object.
@@ -120,27 +199,22 @@ def room_list_view(request):
     Returns:
         HttpResponse: The rendered rooms list template with paginated rooms.
     """
-    rooms = Room.objects.filter(user=request.user).prefetch_related("lights")
-    paginator = Paginator(rooms, 3)
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
-
     context = {
-        "room_list": page_obj,
-        "is_paginated": page_obj.has_other_pages(),
-        "page_obj": page_obj,
+        "room_cards": mark_safe(render_room_cards(request)),
     }
     return render(request, "light_app/rooms_list.html", context)
 
 # =============================================================================
 
 
-def lights_status(request):
+async def lights_status(request):
     """
     Returns the status of all lights in all rooms.
 
-    Retrieves all rooms and their associated lights, then returns a JSON
-    response containing the state of each light ("on" or "off").
+    Retrieves all lights together with their room in a single query, then
+    returns a JSON response containing the state of each light ("on" or
+    "off"), grouped by room in room name order. The snapshot is cached
+    until a room or a light changes.
 
     Args:
         request: The HTTP request object.
@@ -148,25 +222,232 @@ def lights_status(request):
     Returns:
         JsonResponse: A JSON list containing the status of lights in each room.
     """
-    lights_data = []
-    rooms = Room.objects.all()
-    for room in rooms:
-        lights = room.lights.all()
-        for light in lights:
-            lights_data.append(
-                {
-                    "room": room.name,
-                    "light": light.name,
-                    "state": "on" if light.state == 1 else "off",
-                }
-            )
+    lights_data = await alights_snapshot()
     return JsonResponse(lights_data, safe=False)
 
 # =============================================================================
 
 
 @login_required
-def toggle_light(request, room_name, light_name):
+def api_rooms(request):
+    """
+    JSON API listing the user's rooms with their lights.
+
+    Rooms are ordered by (name, id) and paginated with an opaque keyset
+    cursor instead of OFFSET/COUNT, so every page costs the same however
+    large the house is. Query parameters:
+
+    - cursor: The "next_cursor" of the previous page.
+    - limit: The page size (default 50, at most 500).
+    - fields[rooms]: Comma separated room fields (id, name, lights).
+    - fields[lights]: Comma separated light fields (id, name, room,
+      room_id, state, description).
+    - format: "ndjson" to stream the whole house, one room per line.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        JsonResponse or StreamingHttpResponse: The page of rooms and the
+        next cursor, the NDJSON stream, or a 400 error for invalid
+        parameters.
+    """
+    try:
+        room_fields = parse_fields(request.GET.get("fields[rooms]"),
+                                   ROOM_FIELDS, ROOM_FIELDS)
+        light_fields = parse_fields(request.GET.get("fields[lights]"),
+                                    LIGHT_FIELDS, DEFAULT_LIGHT_FIELDS)
+        if request.GET.get("format") == "ndjson":
+            return StreamingHttpResponse(
+                astream_house(request.user, room_fields, light_fields),
+                content_type="application/x-ndjson",
+            )
+        rooms, next_cursor = room_page(
+            request.user,
+            request.GET.get("cursor"),
+            parse_limit(request.GET.get("limit")),
+            room_fields,
+            light_fields,
+        )
+    except InvalidQuery as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({"results": rooms, "next_cursor": next_cursor})
+
+
+@login_required
+def api_lights(request):
+    """
+    JSON API listing the user's lights, optionally those of one room.
+
+    Lights are ordered by (name, id) and paginated with a keyset cursor.
+    Query parameters:
+
+    - room: Only list the lights of the room with this ID.
+    - cursor: The "next_cursor" of the previous page.
+    - limit: The page size (default 50, at most 500).
+    - fields[lights]: Comma separated light fields (id, name, room,
+      room_id, state, description).
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        JsonResponse: The page of lights and the next cursor, or a 400
+        error for invalid parameters.
+    """
+    try:
+        room_id = request.GET.get("room")
+        if room_id is not None and not room_id.isdigit():
+            raise InvalidQuery("room must be a room ID.")
+        lights, next_cursor = light_page(
+            request.user,
+            request.GET.get("cursor"),
+            parse_limit(request.GET.get("limit")),
+            parse_fields(request.GET.get("fields[lights]"), LIGHT_FIELDS,
+                         DEFAULT_LIGHT_FIELDS + ("room",)),
+            int(room_id) if room_id is not None else None,
+        )
+    except InvalidQuery as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({"results": lights, "next_cursor": next_cursor})
+
+
+@login_required
+def api_usage(request):
+    """
+    JSON API reporting the usage of the user's lights over the last days,
+    computed from the light state change log (see `usage.py`).
+
+    Query parameters:
+
+    - days: The length of the period (default 30, at most 366).
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        JsonResponse: The on-hours of each light and room, the hourly
+        profile of each room and the daily on-hours of the home, or a 400
+        error for invalid parameters.
+    """
+    # NumPy is only loaded by the processes serving reports
+    from .usage import MAX_DAYS, usage_report
+
+    days = request.GET.get("days", "30")
+    if not days.isdigit() or not 1 <= int(days) <= MAX_DAYS:
+        return JsonResponse(
+            {"error": f"days must be between 1 and {MAX_DAYS}."}, status=400)
+    return JsonResponse(usage_report(request.user, int(days)))
+
+# =============================================================================
+
+
+@csrf_exempt
+def receive_heartbeats(request):
+    """
+    Ingests heartbeats pushed by devices (or by a gateway relaying several
+    devices), as an alternative to polling them.
+
+    The body is one heartbeat, or a list of up to MAX_BATCH, as JSON; each
+    beat is authenticated by its own signature (see `heartbeats.py`), so
+    the endpoint needs no session or CSRF token. Beats are applied in the
+    background, in batches.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        JsonResponse: The numbers of accepted and rejected beats; 403 if
+        none was accepted.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST heartbeats."}, status=405)
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON."}, status=400)
+    beats = payload if isinstance(payload, list) else [payload]
+    if len(beats) > MAX_BATCH:
+        return JsonResponse(
+            {"error": f"At most {MAX_BATCH} heartbeats per request."},
+            status=413)
+    accepted, rejected = heartbeats.receive(beats, "http")
+    return JsonResponse({"accepted": accepted, "rejected": rejected},
+                        status=202 if accepted else 403)
+
+# =============================================================================
+
+
+@login_required
+def house_import(request):
+    """
+    Imports a CSV or JSON house description (rooms and their lights) for
+    the authenticated user, in a single transaction.
+
+    The description is sent as the "file" upload of a POST form, or as the
+    request body. The format is taken from the "format" parameter, or from
+    the file extension or content type ("json" by default).
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        JsonResponse: The numbers of rooms and lights created and updated,
+        or a 400 error describing the first invalid entry.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST a house description."},
+                            status=405)
+    upload = request.FILES.get("file")
+    name = upload.name if upload else ""
+    content_type = upload.content_type if upload else request.content_type
+    house_format = (
+        request.GET.get("format") or request.POST.get("format") or (
+            "csv" if name.endswith(".csv") or "csv" in (content_type or "")
+            else "json"))
+    try:
+        data = upload.read() if upload else request.body
+        house = parse_house(data.decode("utf-8-sig"), house_format)
+    except UnicodeDecodeError:
+        return JsonResponse({"error": "The description must be UTF-8."},
+                            status=400)
+    except InvalidHouse as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse(import_house(request.user, house))
+
+
+@login_required
+def house_export(request):
+    """
+    Streams the authenticated user's rooms and lights as a CSV or JSON
+    house description, in the format read by `house_import`.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        StreamingHttpResponse or JsonResponse: The description as an
+        attachment, or a 400 error for an unknown format.
+    """
+    house_format = request.GET.get("format", "json")
+    try:
+        chunks = aexport_house(request.user, house_format)
+    except InvalidHouse as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    response = StreamingHttpResponse(
+        chunks,
+        content_type=(
+            "text/csv" if house_format == "csv" else "application/json"),
+    )
+    response["Content-Disposition"] = (
+        f'attachment; filename="house.{house_format}"')
+    return response
+
+# =============================================================================
+
+
+@login_required
+async def toggle_light(request, room_name, light_name):
     """
     Toggles the state of a light in the specified room.
 
@@ -174,6 +455,7 @@ def toggle_light(request, room_name, light_name):
     toggles the light state (on/off), and communicates the change to the
     ESP32 device if the user's IP address is configured.
     Returns a JSON response for AJAX requests or redirects to the room list.
+    The view is async, so waiting for the device doesn't hold a worker.
 
     Args:
         request: The HTTP request object.
@@ -184,45 +466,56 @@ def toggle_light(request, room_name, light_name):
         JsonResponse or HttpResponse: If the request is AJAX, returns the
         light state in a JSON response, otherwise redirects to the room list.
     """
-    room = get_object_or_404(Room, name=room_name, user=request.user)
-    light = get_object_or_404(Light, room=room, name=light_name)
+    user = await request.auser()
+    room = await aget_object_or_404(Room, name=room_name, user=user)
+    light = await aget_object_or_404(Light, room=room, name=light_name)
 
+    # A device with its WebSocket open needs neither an IP nor a probe
+    connected = await device_connected(user.id)
     user_ip = request.user_ip
-    if not user_ip or user_ip == "none":
+    if not connected and (not user_ip or user_ip == "none"):
         return JsonResponse({"error": "ESP32 IP not configured for user",
                             "action": "go_to_settings"}, status=400,)
     response_text = ""
     action = "off" if light.state == 1 else "on"
 
-    if user_ip:
+    if connected or user_ip:
         try:
-            try:
-                response = requests.get(
-                    f"http://{request.user_ip}", timeout=30)
-                if response.status_code == 200:
-                    home_online = True
-            except requests.exceptions.RequestException as e:
-                home_online = False
-                response_text = f"Server offline: {e}"
+            home_online = connected
+            if not connected:
+                try:
+                    # Concurrent toggles share one liveness probe
+                    response = await adevice_probe(request.user_ip,
+                                                   command="liveness")
+                    if response.status_code == 200:
+                        home_online = True
+                except httpx.HTTPError as e:
+                    response_text = f"Server offline: {e}"
 
             if home_online:
-                response = requests.get(
-                    f"http://{request.user_ip}/control_led",
+                response = await adevice_command(
+                    user.id,
+                    request.user_ip,
+                    "/control_led",
                     params={
                         "room": room_name,
                         "light": light_name,
                         "action": action
                     },
-                    timeout=30,
                 )
 
-                if response.ok:
+                if response.is_success:
                     light.state = 1 if action == "on" else 2
-                    light.save()
+                    await light.asave(update_fields=["state"])
                     response_text = response.json()
                 else:
                     response_text = "Failed to change light state on M5Core2\
                           server."
+        except DeviceBusy as e:
+            # The device's command queue is full, the light is unchanged
+            if request.headers.get("x-requested-with") == "XMLHttpRequest":
+                return JsonResponse({"error": str(e)}, status=429)
+            response_text = str(e)
         except Exception as e:
             response_text = f"Error: {e}"
 
@@ -236,6 +529,88 @@ def toggle_light(request, room_name, light_name):
 # =============================================================================
 
 
+@login_required
+def save_scene(request):
+    """
+    Saves the current state of the authenticated user's lights as a scene.
+
+    Expects a POST with the scene "name" and, optionally, the IDs of the
+    "lights" to include (all the user's lights by default). Saving an
+    existing scene replaces its lights.
+
+    Args:
+        request: The HTTP request object.
+
+    Returns:
+        JsonResponse: The scene name and its number of lights.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST a scene name."}, status=405)
+    name = request.POST.get("name", "").strip()
+    if not name or len(name) > 100:
+        return JsonResponse({"error": "Invalid scene name."}, status=400)
+    light_ids = request.POST.getlist("lights")
+    try:
+        light_ids = [int(light_id) for light_id in light_ids] or None
+    except ValueError:
+        return JsonResponse({"error": "Invalid light ID."}, status=400)
+    scene = capture_scene(request.user, name, light_ids)
+    return JsonResponse({"scene": scene.name, "lights": len(scene.members)})
+
+# =============================================================================
+
+
+@login_required
+async def activate_scene(request, scene_name):
+    """
+    Activates a scene: sets every light of the scene to its state.
+
+    The device gets all the light commands in a single request and, once it
+    accepted them, the states are stored with a single UPDATE, so the cost
+    doesn't depend on the number of lights.
+
+    Args:
+        request: The HTTP request object.
+        scene_name: The name of the scene.
+
+    Returns:
+        JsonResponse or HttpResponse: If the request is AJAX, returns the
+        scene's number of lights and the device response in a JSON response,
+        otherwise redirects to the room list.
+    """
+    user = await request.auser()
+    scene = await aget_object_or_404(Scene, name=scene_name, user=user)
+
+    user_ip = request.user_ip
+    if not await device_connected(user.id) and (
+            not user_ip or user_ip == "none"):
+        return JsonResponse({"error": "ESP32 IP not configured for user",
+                            "action": "go_to_settings"}, status=400,)
+    try:
+        response = await send_scene(scene, user_ip)
+        if response.is_success:
+            await sync_to_async(apply_scene)(scene)
+            response_text = response.json()
+        else:
+            response_text = "Failed to activate the scene on M5Core2 server."
+    except DeviceBusy as e:
+        # The device's command queue is full, the lights are unchanged
+        if request.headers.get("x-requested-with") == "XMLHttpRequest":
+            return JsonResponse({"error": str(e)}, status=429)
+        response_text = str(e)
+    except Exception as e:
+        response_text = f"Error: {e}"
+
+    if request.headers.get("x-requested-with") == "XMLHttpRequest":
+        return JsonResponse({"scene": scene.name,
+                             "lights": len(scene.members),
+                             "esp_response": response_text})
+
+    return redirect("room_list")
+
+# =============================================================================
+
+
 @login_required
 def add_room(request):
     """